@@ -1,3 +1,5 @@
+import asyncio
+
 import dotenv
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
@@ -7,6 +9,7 @@ from starlette.exceptions import HTTPException as StarletteHTTPException
 import models
 from models import auth
 from routers import provider, public, review, service, socket, customer
+from services.search_indexer import SearchIndexer, SearchReindexer
 from utils.exceptions import AppExceptionCase, app_exception_handler
 from utils.request_exceptions import (
     http_exception_handler,
@@ -74,6 +77,18 @@ async def startup_event():
     if hasattr(models.storage, "reload"):
         print("Reloading DB")
         await models.storage.reload()
+    if await models.es.ensure_index():
+        # First start against this cluster: the index was just created empty,
+        # and only this worker created it. Fill it in the background like
+        # `python main.py reindex-search` would, searches return nothing until then.
+        app.state.search_reindex = asyncio.create_task(SearchReindexer().run(resume=False))
+    search_indexer = SearchIndexer()
+    if search_indexer.enabled:
+        app.state.search_indexer = asyncio.create_task(search_indexer.run())
+    app.state.socket_backplane = asyncio.create_task(socket.socket_manager.run())
+    if models.media_storage.spool_mode:
+        # Keep a reference so the worker task is not garbage collected
+        app.state.media_spool_worker = asyncio.create_task(models.media_storage.run_spool_worker())
 
 
 @app.get("/")
@@ -13,8 +13,66 @@ def check_env():
 
 async def main():
     check_env()
-    uvicorn.run("app:app", port=5000, log_level="info", reload=True)
+    # Protocol-level pings drop dead chat sockets, see SocketManager
+    uvicorn.run("app:app", port=5000, log_level="info", reload=True, ws_ping_interval=20, ws_ping_timeout=20)
+
+
+async def backfill_prices(args: argparse.Namespace):
+    """Recompute the denormalized price summary of every provider"""
+    check_env()
+    import models
+    await models.storage.reload()
+    updated = await models.storage.backfill_price_summaries()
+    print(f"Backfilled price summary for {updated} providers")
+
+
+async def repair_ratings(args: argparse.Namespace):
+    """Recompute every rating counter from scratch and report the drift"""
+    check_env()
+    import models
+    await models.storage.reload()
+    report = await models.storage.repair_rating_aggregates()
+    for model, repaired in report.items():
+        print(f"{model}: repaired {repaired} rating aggregates")
+
+
+async def backfill_conversations(args: argparse.Namespace):
+    """Rebuild every chat conversation, last message and unread count from the messages"""
+    check_env()
+    import models
+    await models.storage.reload()
+    written = await models.storage.rebuild_conversations()
+    print(f"Rebuilt {written} conversations")
+
+
+async def reindex_search(args: argparse.Namespace):
+    """Rebuild the provider search index into a new index and swap the alias"""
+    check_env()
+    import models
+    from services.search_indexer import SearchReindexer
+    await models.storage.reload()
+    await models.es.ensure_index()
+    reindexer = SearchReindexer(batch_size=args.batch_size, workers=args.workers)
+    state = await reindexer.run(resume=not args.restart)
+    print(f"Indexed {state.indexed} providers into {state.index}, {state.failed} failed")
+
+
+COMMANDS = {
+    "backfill-prices": backfill_prices,
+    "repair-ratings": repair_ratings,
+    "reindex-search": reindex_search,
+    "backfill-conversations": backfill_conversations,
+}
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Service Hub API")
+    parser.add_argument("command", nargs="?", choices=["serve", *COMMANDS], default="serve")
+    parser.add_argument("--batch-size", type=int, default=500, help="reindex-search: providers per bulk request")
+    parser.add_argument("--workers", type=int, default=4, help="reindex-search: concurrent bulk requests")
+    parser.add_argument("--restart", action="store_true", help="reindex-search: ignore an interrupted run")
+    args = parser.parse_args()
+    if args.command == "serve":
+        asyncio.run(main())
+    else:
+        asyncio.run(COMMANDS[args.command](args))
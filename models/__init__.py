@@ -1,10 +1,42 @@
+import os
+
 from models.engine.db_storage import DBStorage
 from models.engine.media_storage import MediaStorage
-from services.elastic import ElasticSearchConfig
 
-storage = DBStorage()
+# STORAGE_CACHE: "none" (default), "redis" (uses REDIS_URL) or "memory";
+# it also selects the search result cache. A memory cache is only
+# invalidated by writes of its own process, so it is for single-worker
+# deployments: with several workers, use "redis"
+storage_cache = os.getenv("STORAGE_CACHE", "none").lower()
+redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
+if storage_cache == "none":
+    storage = DBStorage()
+    search_cache = None
+else:
+    from models.engine.cache import InMemoryCache, RedisCache
+    from models.engine.cached_storage import CachedDBStorage
+    from models.engine.search_cache import SearchResultCache
+
+    storage = CachedDBStorage(
+        RedisCache(redis_url)
+        if storage_cache == "redis" else InMemoryCache()
+    )
+    search_cache = SearchResultCache(
+        RedisCache(redis_url, namespace="servicehub:search:")
+        if storage_cache == "redis" else InMemoryCache(max_entries=2000),
+        ttl=int(os.getenv("SEARCH_CACHE_TTL", "30")),
+    )
 media_storage = MediaStorage()
-es = ElasticSearchConfig()
+# SEARCH_BACKEND: "elasticsearch" (default) or "memory", an in-process index
+# loaded from MongoDB at startup, for development and small deployments
+if os.getenv("SEARCH_BACKEND", "elasticsearch").lower() == "memory":
+    from services.memory_search import InMemorySearchBackend
+
+    es = InMemorySearchBackend()
+else:
+    from services.elastic import ElasticSearchConfig
+
+    es = ElasticSearchConfig()
 
 from models.engine.auth import AuthEngine as VerificationAuth, AuthEngine
 from models.engine.email_client import EmailClient
@@ -2,7 +2,7 @@
 import uuid
 from datetime import datetime
 
-from beanie import Document, Link
+from beanie import Delete, Document, Insert, Link, Replace, Save, SaveChanges, Update, after_event, before_event
 from fastapi.encoders import jsonable_encoder
 from pydantic import ConfigDict, Field
 
@@ -38,6 +38,20 @@ class BaseModel(Document):
     async def delete_obj(self):
         return await models.storage.delete(self)
 
+    @before_event(Insert, Replace, Save, SaveChanges)
+    def _touch(self):
+        """
+        Every document write moves `updated_at`, which search indexing relies on.
+        Partial updates (`set`, `update`) only write their own expression: they
+        must `$set` `updated_at` themselves.
+        """
+        self.updated_at = datetime.utcnow()
+
+    @after_event(Insert, Replace, Save, SaveChanges, Update, Delete)
+    async def _invalidate_cache(self):
+        """Keep the storage cache coherent with writes made through Beanie directly"""
+        await models.storage.invalidate(self)
+
     async def to_dict(self):
         return jsonable_encoder(self.model_dump())
 
@@ -0,0 +1,37 @@
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from beanie import Indexed, PydanticObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from models.base_model import BaseModel
+
+
+class Conversation(BaseModel):
+    """
+    Chat between two users, updated with every message sent or read, so
+    listing chat rooms and counting unread messages never reads the
+    messages collection.
+    """
+    key: Indexed(str, unique=True)  # See `key_of`
+    participants: List[PydanticObjectId]
+    # User id -> {"id", "email", "role"}, as of their last message
+    users: Dict[str, dict] = {}
+    # Latest message, as stored in the messages collection with links flattened to ids
+    last_message: Optional[dict] = None
+    last_message_at: Optional[datetime] = None
+    # User id -> number of messages of this conversation they haven't read;
+    # may be briefly negative, see SocketManager._record_read
+    unread: Dict[str, int] = {}
+
+    class Settings:
+        use_state_management = True
+        # Back the room listing of a user, newest conversation first
+        indexes = [
+            IndexModel([("participants", ASCENDING), ("last_message_at", DESCENDING)]),
+        ]
+
+    @staticmethod
+    def key_of(user_id: PydanticObjectId | str, other_user_id: PydanticObjectId | str) -> str:
+        """Key of the conversation of two users, whoever sent the message"""
+        return ":".join(sorted((str(user_id), str(other_user_id))))
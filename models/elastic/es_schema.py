@@ -1,11 +1,66 @@
 # es_schemas.py
 
+from datetime import datetime, timezone
+
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import Any, ClassVar, List, Optional, Dict
 import models
 from models.attributes import BusinessCategory, Subcategory
 
 
+class SearchCard(BaseModel):
+    """A search result card, stored pre-rendered in the search document"""
+    id: str
+    title: str
+    provider: str
+    providerInitials: str
+    description: str
+    rating: float
+    reviews: int
+    image: str
+    price: str
+    priceRange: List[float]
+    location: str
+    categories: List[List[Subcategory]]
+    mainCategory: str
+    availableNow: bool = True
+
+    @classmethod
+    def from_provider(cls, provider: Any, price_range: Optional[tuple[float, float]] = None) -> "SearchCard":
+        """
+        Render the card of a provider.
+
+        :param provider: A ServiceProvider or any projection with the card fields.
+        :param price_range: The (min, max) service price of the provider, if any.
+        """
+        from models.service_provider import ServiceProvider
+
+        initials = "".join(word[0] for word in provider.name.split()[:2]).upper()
+        price_str, price_range = ServiceProvider.format_price_range(price_range)
+        #available_now = is_provider_available_now(provider)
+
+        return cls(
+            id=str(provider.id),
+            title=provider.name,
+            provider=provider.name,
+            providerInitials=initials,
+            description=provider.description or "",
+            rating=provider.averageRating or 0.0,
+            reviews=provider.reviewCount or 0,
+            image=provider.image if hasattr(provider, "image_url") else "/placeholder.svg?height=200&width=300",
+            price=price_str,
+            priceRange=price_range,
+            location=provider.address.city if provider.address else "Unknown",
+            categories=list(provider.category.values()) if provider.category else [],
+            mainCategory=(
+                list(provider.category.keys())[0]
+                if hasattr(provider, "category") and isinstance(provider.category, dict) and provider.category
+                else "General"
+            ),
+            availableNow=True,
+        )
+
+
 class ServiceProviderSearchDoc(BaseModel):
     id: str
     name: str
@@ -16,4 +71,41 @@ class ServiceProviderSearchDoc(BaseModel):
     service_titles: List[str]
     service_descriptions: List[str]
     category_titles: List[str]
-    category_descriptions: List[str]
\ No newline at end of file
+    category_descriptions: List[str]
+    # Filter and sort fields, so a search never needs a second trip to MongoDB
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    averageRating: Optional[float] = None
+    reviewCount: Optional[int] = None
+    geo_point: Optional[Dict[str, float]] = None  # {"lat": ..., "lon": ...}
+    created_at: Optional[datetime] = None
+    # Stored only, returned as is by /search
+    card: Optional[SearchCard] = None
+    # `updated_at` of the provider the card was rendered from; a provider
+    # with a newer `updated_at` has a stale search document
+    source_updated_at: Optional[datetime] = None
+    # External ES version: an indexing run never overwrites a newer document
+    version: Optional[int] = None
+    # Completion suggester inputs: [{"input": [...], "weight": ...}]
+    suggest: List[Dict[str, Any]] = []
+
+    # Provider names rank above service and category titles in suggestions
+    SUGGEST_WEIGHTS: ClassVar[Dict[str, int]] = {"name": 2, "title": 1}
+
+    @classmethod
+    def suggest_inputs(cls, name: str, titles: List[str]) -> List[Dict[str, Any]]:
+        inputs = [{"input": [name], "weight": cls.SUGGEST_WEIGHTS["name"]}]
+        titles = list(dict.fromkeys(title for title in titles if title))
+        if titles:
+            inputs.append({"input": titles, "weight": cls.SUGGEST_WEIGHTS["title"]})
+        return inputs
+
+    @staticmethod
+    def version_of(*updated_at: datetime) -> int:
+        """Version of a document built from sources updated at `updated_at`: the latest, in ms"""
+        return max(int(_as_utc(value).timestamp() * 1000) for value in updated_at if value)
+
+
+def _as_utc(value: datetime) -> datetime:
+    # Naive datetimes are UTC everywhere in this app (datetime.utcnow)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
@@ -0,0 +1,118 @@
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+
+class CacheBackend(ABC):
+    """Key/value byte cache used by CachedDBStorage and SearchResultCache"""
+
+    @abstractmethod
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        pass
+
+    @abstractmethod
+    async def set_many(self, items: Dict[str, bytes], ttl: int):
+        pass
+
+    @abstractmethod
+    async def delete(self, keys: Iterable[str]):
+        pass
+
+    @abstractmethod
+    async def clear(self, prefix: str = ""):
+        pass
+
+    @abstractmethod
+    async def counter(self, key: str) -> int:
+        """Current value of a counter, 0 if never incremented. Counters never expire"""
+        pass
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        pass
+
+
+class InMemoryCache(CacheBackend):
+    """Per-process LRU cache with a TTL on every entry"""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._counters: Dict[str, int] = {}
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        now = time.monotonic()
+        values = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                self._entries.pop(key, None)
+                values.append(None)
+                continue
+            self._entries.move_to_end(key)
+            values.append(entry[1])
+        return values
+
+    async def set_many(self, items: Dict[str, bytes], ttl: int):
+        expires_at = time.monotonic() + ttl
+        for key, value in items.items():
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, keys: Iterable[str]):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def clear(self, prefix: str = ""):
+        for key in [k for k in self._entries if k.startswith(prefix)]:
+            del self._entries[key]
+
+    async def counter(self, key: str) -> int:
+        return self._counters.get(key, 0)
+
+    async def incr(self, key: str) -> int:
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+
+class RedisCache(CacheBackend):
+    """Cache shared by every worker, stored in Redis"""
+
+    def __init__(self, url: str, namespace: str = "servicehub:storage:"):
+        import redis.asyncio as redis
+
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        if not keys:
+            return []
+        return await self.client.mget([self.namespace + key for key in keys])
+
+    async def set_many(self, items: Dict[str, bytes], ttl: int):
+        if not items:
+            return
+        async with self.client.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                pipe.set(self.namespace + key, value, ex=ttl)
+            await pipe.execute()
+
+    async def delete(self, keys: Iterable[str]):
+        keys = [self.namespace + key for key in keys]
+        if keys:
+            await self.client.delete(*keys)
+
+    async def clear(self, prefix: str = ""):
+        keys = [key async for key in self.client.scan_iter(match=f"{self.namespace}{prefix}*")]
+        if keys:
+            await self.client.delete(*keys)
+
+    async def counter(self, key: str) -> int:
+        value = await self.client.get(self.namespace + key)
+        return int(value) if value is not None else 0
+
+    async def incr(self, key: str) -> int:
+        return await self.client.incr(self.namespace + key)
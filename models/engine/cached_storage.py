@@ -0,0 +1,182 @@
+from collections import Counter
+from typing import Dict, List, Optional, Type, Union
+
+import bson
+from beanie import Document, Link, PydanticObjectId
+from beanie.odm.operators.find.comparison import In
+from beanie.odm.utils.dump import get_dict
+from beanie.odm.utils.parsing import parse_obj
+from bson.binary import UuidRepresentation
+from bson.codec_options import CodecOptions
+
+from models.engine.cache import CacheBackend, InMemoryCache
+from models.engine.db_storage import DBStorage, Projection, classes
+
+CODEC_OPTIONS = CodecOptions(uuid_representation=UuidRepresentation.STANDARD)
+
+
+class CachedDBStorage(DBStorage):
+    """
+    DBStorage with a read-through cache in front of `get` and `get_by_reference`.
+
+    Documents are cached by id. Reference lookups (e.g. provider by `user_id`)
+    only cache the matching ids, so a document update invalidates a single
+    key no matter how many references point at it. Only models listed in
+    `ttls` are cached, and lookups with `fetch_links=True` or a projection
+    always go to MongoDB.
+    """
+
+    # Seconds a cached entry stays valid, per model
+    DEFAULT_TTLS = {
+        "ServiceProvider": 60,
+        "Customer": 300,
+        "User": 60,
+        "Category": 60,
+    }
+
+    def __init__(self, cache: Optional[CacheBackend] = None, ttls: Optional[Dict[str, int]] = None):
+        super().__init__()
+        self.cache = cache or InMemoryCache()
+        self.ttls = ttls if ttls is not None else dict(self.DEFAULT_TTLS)
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+
+    def cache_stats(self) -> dict:
+        """Hit and miss counters per model, for tuning TTLs and cache size"""
+        return {
+            name: {
+                "hits": self.hits[name],
+                "misses": self.misses[name],
+                "hit_rate": self.hits[name] / ((self.hits[name] + self.misses[name]) or 1),
+            }
+            for name in sorted(set(self.hits) | set(self.misses))
+        }
+
+    async def get(self, cls: Type[Document] | str, obj_id: PydanticObjectId, fetch_links: bool = False):
+        model = classes.get(cls) if isinstance(cls, str) else cls
+        if model is None or fetch_links or model.__name__ not in self.ttls:
+            return await super().get(cls, obj_id, fetch_links=fetch_links)
+        docs = await self._get_many_by_id(model, [PydanticObjectId(obj_id)])
+        return docs[0] if docs else None
+
+    async def get_by_reference(
+            self,
+            cls: Type[Document],
+            reference_field: str,
+            reference_id: Union[str, PydanticObjectId],
+            fetch_links: bool = False, batch: bool = False,
+            projection: Optional[Projection] = None
+    ) -> Optional[Document] or list[Document]:
+        model = classes.get(cls) if isinstance(cls, str) else cls
+        if (fetch_links or projection is not None or model.__name__ not in self.ttls
+                or reference_field not in (model.get_link_fields() or {})):
+            return await super().get_by_reference(cls, reference_field, reference_id, fetch_links, batch, projection)
+
+        reference_id = PydanticObjectId(reference_id)
+        key = self._reference_key(model, reference_field, reference_id, batch)
+        cached, = await self.cache.get_many([key])
+        if cached is not None:
+            obj_ids = bson.decode(cached)["ids"]
+            docs = await self._get_many_by_id(model, obj_ids)
+            # A referenced document vanished: fall through and rebuild the entry
+            if len(docs) == len(obj_ids):
+                return docs if batch else docs[0]
+
+        self.misses[model.__name__] += 1
+        result = await super().get_by_reference(model, reference_field, reference_id, batch=batch)
+        docs = result if batch else [result] if result else []
+        # Misses are not cached, a profile may be created right after the lookup
+        if docs:
+            ttl = self.ttls[model.__name__]
+            await self.cache.set_many({key: bson.encode({"ids": [doc.id for doc in docs]})}, ttl)
+            await self.cache.set_many({self._id_key(model, doc.id): self._encode(doc) for doc in docs}, ttl)
+        return result
+
+    async def new(self, obj: Document):
+        await super().new(obj)
+        await self.invalidate(obj)
+
+    async def update(self, obj: Document):
+        await super().update(obj)
+        await self.invalidate(obj)
+
+    async def delete(self, obj: Document):
+        result = await super().delete(obj)
+        await self.invalidate(obj)
+        return result
+
+    async def delete_by_filter(self, cls: Type[Document], field, values: list):
+        result = await super().delete_by_filter(cls, field, values)
+        # The deleted ids are unknown, drop everything cached for the model
+        await self.cache.clear(f"{cls.__name__}:")
+        return result
+
+    async def batch_save(self, cls: Type[Document], objects: list[Document]):
+        result = await super().batch_save(cls, objects)
+        for obj in objects:
+            await self.invalidate(obj)
+        return result
+
+    async def batch_update(self, objects: list[Document]):
+        result = await super().batch_update(objects)
+        for obj in objects:
+            await self.invalidate(obj)
+        return result
+
+    async def invalidate(self, obj: Document):
+        model = type(obj)
+        if model.__name__ not in self.ttls:
+            return
+        keys = [self._id_key(model, obj.id)] if obj.id else []
+        for field in model.get_link_fields() or {}:
+            ref_id = self._link_id(getattr(obj, field, None))
+            if ref_id is not None:
+                keys.append(self._reference_key(model, field, ref_id, batch=True))
+                keys.append(self._reference_key(model, field, ref_id, batch=False))
+        await self.cache.delete(keys)
+
+    async def invalidate_ids(self, cls: Type[Document], obj_ids: List[PydanticObjectId]):
+        if cls.__name__ in self.ttls:
+            await self.cache.delete([self._id_key(cls, obj_id) for obj_id in obj_ids])
+
+    async def _get_many_by_id(self, model: Type[Document], obj_ids: List[PydanticObjectId]) -> List[Document]:
+        name = model.__name__
+        cached = await self.cache.get_many([self._id_key(model, obj_id) for obj_id in obj_ids])
+        docs: Dict[PydanticObjectId, Document] = {
+            obj_id: self._decode(model, value)
+            for obj_id, value in zip(obj_ids, cached) if value is not None
+        }
+        self.hits[name] += len(docs)
+        missing = [obj_id for obj_id in obj_ids if obj_id not in docs]
+        self.misses[name] += len(missing)
+
+        if missing:
+            fetched = await model.find(In(model.id, missing)).to_list()
+            await self.cache.set_many(
+                {self._id_key(model, doc.id): self._encode(doc) for doc in fetched}, self.ttls[name])
+            docs.update({doc.id: doc for doc in fetched})
+        return [docs[obj_id] for obj_id in obj_ids if obj_id in docs]
+
+    @staticmethod
+    def _id_key(model: Type[Document], obj_id) -> str:
+        return f"{model.__name__}:id:{obj_id}"
+
+    @staticmethod
+    def _reference_key(model: Type[Document], field: str, ref_id, batch: bool) -> str:
+        return f"{model.__name__}:ref:{field}:{ref_id}:{'many' if batch else 'one'}"
+
+    @staticmethod
+    def _link_id(value) -> Optional[PydanticObjectId]:
+        if isinstance(value, Link):
+            return value.ref.id
+        if isinstance(value, Document):
+            return value.id
+        return None
+
+    @staticmethod
+    def _encode(doc: Document) -> bytes:
+        return bson.encode(get_dict(doc, to_db=True), codec_options=CODEC_OPTIONS)
+
+    @staticmethod
+    def _decode(model: Type[Document], value: bytes) -> Document:
+        return parse_obj(model, bson.decode(value, codec_options=CODEC_OPTIONS))
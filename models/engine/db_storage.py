@@ -1,26 +1,62 @@
 import asyncio
-from typing import List, Optional, Type, Union
+import math
+from datetime import datetime
+from functools import lru_cache
+from typing import List, Optional, Sequence, Type, Union
 from beanie import Document, PydanticObjectId
 import motor.motor_asyncio
 from beanie.odm.operators.find.comparison import In
+from beanie.odm.utils.parsing import parse_obj
 from fastapi_users.db import BeanieUserDatabase
+from pydantic import BaseModel as PydanticModel, Field, create_model
+from pymongo import UpdateOne
 
 from models.appointment import Appointment
 from models.attributes import BusinessCategory, Subcategory
+from models.conversation import Conversation
 from models.customer import Customer
 from models.engine.interface import AbstractStorageEngine
+from models.media_job import MediaUploadJob
 from models.message import Message
 from models.review import Review
+from models.search_indexer_state import SearchIndexerState
 from models.service import Category, ServiceItem
 from models.service_provider import Certification, Insurance, ServiceProvider
 # Example class registry (like your `classes`)
 from models.user import User
-from models.elastic.es_schema import ServiceProviderSearchDoc
+from models.elastic.es_schema import SearchCard, ServiceProviderSearchDoc
+from utils.pagination import decode_cursor, encode_cursor, keyset_filter, keyset_sort
 
 classes = {"User": User, "ServiceProvider": ServiceProvider, "Customer": Customer,
             "Certification": Certification, "Insurance": Insurance,
            "Category": Category, "ServiceItem": ServiceItem,
-           "Appointment": Appointment, "Review": Review, "Message": Message}  # Add other models as needed
+           "Appointment": Appointment, "Review": Review, "Message": Message,
+           "MediaUploadJob": MediaUploadJob, "SearchIndexerState": SearchIndexerState,
+           "Conversation": Conversation}  # Add other models as needed
+
+# A projection is either a Pydantic model or a list of field names of the queried document
+Projection = Union[Type[PydanticModel], Sequence[str]]
+
+
+@lru_cache(maxsize=None)
+def projection_model(cls: Type[Document], fields: tuple[str, ...]) -> Type[PydanticModel]:
+    """Build (once) a Pydantic projection model holding only `fields` of `cls`"""
+    definitions = {
+        name: (cls.model_fields[name].annotation, cls.model_fields[name])
+        for name in fields if name != "id"
+    }
+    return create_model(
+        f"{cls.__name__}Projection",
+        id=(PydanticObjectId, Field(alias="_id")),
+        **definitions,
+    )
+
+
+def resolve_projection(cls: Type[Document], projection: Optional[Projection]) -> Optional[Type[PydanticModel]]:
+    if projection is None or isinstance(projection, type):
+        return projection
+    return projection_model(cls, tuple(projection))
+
 
 class DBStorage(AbstractStorageEngine):
     """Implements the same interface as FileStorage but using Beanie ODM"""
@@ -33,8 +69,12 @@ class DBStorage(AbstractStorageEngine):
         from beanie import init_beanie
         await init_beanie(database=self.db, document_models=list(classes.values()))
 
-    async def all(self, cls: Union[Type[Document], str] = None):
-        """Returns all documents, optionally filtered by class"""
+    def get_model(self, name: str) -> Optional[Type[Document]]:
+        """Resolve a registered document class by name"""
+        return classes.get(name)
+
+    async def all(self, cls: Union[Type[Document], str] = None, projection: Optional[Projection] = None):
+        """Returns all documents, optionally filtered by class and projected"""
         if cls is None:
             results = []
             for model in classes.values():
@@ -42,7 +82,7 @@ class DBStorage(AbstractStorageEngine):
             return results
         if isinstance(cls, str):
             cls = classes.get(cls)
-        return await cls.find_all().to_list()
+        return await cls.find_all(projection_model=resolve_projection(cls, projection)).to_list()
 
     async def new(self, obj: Document):
         """Add (or update) an object in DB"""
@@ -115,7 +155,8 @@ class DBStorage(AbstractStorageEngine):
             cls: Type[Document],
             reference_field: str,
             reference_id: Union[str, PydanticObjectId],
-            fetch_links: bool = False, batch: bool = False
+            fetch_links: bool = False, batch: bool = False,
+            projection: Optional[Projection] = None
     ) -> Optional[Document] or list[Document]:
         """Get document by a reference (Link) field like `user_id`.
 
@@ -123,6 +164,7 @@ class DBStorage(AbstractStorageEngine):
         :param reference_field: The reference field name (e.g., "user_id")
         :param reference_id: The id to match (string or ObjectId)
         :param fetch_links: Whether to resolve linked documents
+        :param projection: Projection model or field names to load instead of full documents
         :return: The first matching document or None
         """
         cls = classes.get(cls) if isinstance(cls, str) else cls
@@ -130,30 +172,361 @@ class DBStorage(AbstractStorageEngine):
             reference_id = PydanticObjectId(reference_id)
 
         field = getattr(cls, reference_field)
-        result = cls.find(field.id == reference_id, fetch_links=fetch_links)
+        result = cls.find(field.id == reference_id, fetch_links=fetch_links,
+                          projection_model=resolve_projection(cls, projection))
         return await result.first_or_none() if not batch else await result.to_list()
 
     async def index_search_document(self, provider: ServiceProvider) -> ServiceProviderSearchDoc:
-        await provider.fetch_all_links()
-        service_items = await ServiceItem.find(ServiceItem.provider_id.id == provider.id).to_list()
-        categories = await Category.find(Category.provider_id.id == provider.id).to_list()
+        projection = {"title": 1, "description": 1, "price": 1, "updated_at": 1}
+        service_items = await ServiceItem.get_motor_collection().find(
+            {"provider_id.$id": provider.id}, projection).to_list(length=None)
+        categories = await Category.get_motor_collection().find(
+            {"provider_id.$id": provider.id}, projection).to_list(length=None)
+        return self._search_document(provider, service_items, categories)
+
+    async def search_documents(self, match: dict, limit: Optional[int] = None) -> List[ServiceProviderSearchDoc]:
+        """
+        Build the search documents of many providers with one aggregation.
+
+        Services and categories are joined with `$lookup` instead of being
+        queried provider by provider.
 
+        :param match: Filter on the providers collection.
+        :param limit: Max number of providers, taken in `_id` order.
+        """
+        projection = {"$project": {"title": 1, "description": 1, "price": 1, "updated_at": 1}}
+        pipeline = [{"$match": match}, {"$sort": {"_id": 1}}]
+        if limit is not None:
+            pipeline.append({"$limit": limit})
+        pipeline += [
+            {"$lookup": {
+                "from": ServiceItem.get_motor_collection().name,
+                "localField": "_id",
+                "foreignField": "provider_id.$id",
+                "pipeline": [projection],
+                "as": "_service_items",
+            }},
+            {"$lookup": {
+                "from": Category.get_motor_collection().name,
+                "localField": "_id",
+                "foreignField": "provider_id.$id",
+                "pipeline": [projection],
+                "as": "_categories",
+            }},
+        ]
+        rows = await ServiceProvider.get_motor_collection().aggregate(pipeline).to_list(length=None)
+        docs = []
+        for row in rows:
+            service_items, categories = row.pop("_service_items"), row.pop("_categories")
+            docs.append(self._search_document(parse_obj(ServiceProvider, row), service_items, categories))
+        return docs
+
+    @classmethod
+    def _search_document(cls, provider: ServiceProvider, service_items: List[dict],
+                         categories: List[dict]) -> ServiceProviderSearchDoc:
         category: BusinessCategory = next(iter(provider.category), None)
         subcategories: List[Subcategory] = provider.category.get(category, []) if category else []
 
-        doc = ServiceProviderSearchDoc(
+        price_range = provider.stored_price_range
+        if provider.active_service_count is None and service_items:
+            # Summary not backfilled yet, the items are at hand anyway
+            prices = [s["price"] for s in service_items]
+            price_range = (min(prices), max(prices))
+
+        return ServiceProviderSearchDoc(
             id=str(provider.id),
             name=provider.name,
             description=provider.description,
             phone=provider.phone,
             category=category,
             subcategories=subcategories,
-            service_titles=[s.title for s in service_items],
-            service_descriptions=[s.description for s in service_items],
-            category_titles=[c.title for c in categories],
-            category_descriptions=[c.description for c in categories],
+            service_titles=[s["title"] for s in service_items],
+            service_descriptions=[s["description"] for s in service_items],
+            category_titles=[c["title"] for c in categories],
+            category_descriptions=[c["description"] for c in categories],
+            min_price=price_range[0] if price_range else None,
+            max_price=price_range[1] if price_range else None,
+            averageRating=provider.averageRating,
+            reviewCount=provider.reviewCount,
+            geo_point=cls._geo_point(provider),
+            created_at=provider.created_at,
+            card=SearchCard.from_provider(provider, price_range),
+            suggest=ServiceProviderSearchDoc.suggest_inputs(
+                provider.name,
+                [s["title"] for s in service_items] + [c["title"] for c in categories]),
+            source_updated_at=provider.updated_at,
+            version=ServiceProviderSearchDoc.version_of(
+                provider.updated_at,
+                *(s.get("updated_at") for s in service_items),
+                *(c.get("updated_at") for c in categories),
+            ),
+        )
+
+    @staticmethod
+    def _geo_point(provider: ServiceProvider) -> Optional[dict]:
+        """ES geo_point of a provider; GeoJSON stores [lng, lat]"""
+        location = provider.address.location if provider.address else None
+        if not location:
+            return None
+        lng, lat = location.coordinates
+        return {"lat": lat, "lon": lng}
+
+    async def get_many(
+            self,
+            cls: Type[Document] | str,
+            obj_ids: List[PydanticObjectId],
+            projection: Optional[Projection] = None
+    ) -> list:
+        """
+        Get many documents by id with one `$in` query.
+
+        :param cls: The document class.
+        :param obj_ids: The ids to load; the result follows this order.
+        :param projection: Projection model or field names to load instead of full documents.
+        :return: The documents found, missing ids are skipped.
+        """
+        cls = classes.get(cls) if isinstance(cls, str) else cls
+        if not obj_ids:
+            return []
+        docs = await cls.find(In(cls.id, list(obj_ids)),
+                              projection_model=resolve_projection(cls, projection)).to_list()
+        by_id = {doc.id: doc for doc in docs}
+        return [by_id[obj_id] for obj_id in obj_ids if obj_id in by_id]
+
+    async def get_price_summaries(self, provider_ids: List[PydanticObjectId]) -> dict[PydanticObjectId, dict]:
+        """
+        Compute the service price summary for many providers at once.
+
+        :param provider_ids: The provider ids to summarize.
+        :return: A dict of provider id -> {"min_price", "max_price", "active_service_count"}.
+                 Providers without any service are absent.
+        """
+        if not provider_ids:
+            return {}
+        pipeline = [
+            {"$match": {"provider_id.$id": {"$in": list(provider_ids)}}},
+            {"$group": {
+                "_id": "$provider_id.$id",
+                "min_price": {"$min": "$price"},
+                "max_price": {"$max": "$price"},
+                "active_service_count": {"$sum": {"$cond": [{"$eq": ["$status", "active"]}, 1, 0]}},
+            }},
+        ]
+        rows = await ServiceItem.get_motor_collection().aggregate(pipeline).to_list(length=None)
+        return {row.pop("_id"): row for row in rows}
+
+    async def get_price_ranges(
+            self,
+            provider_ids: List[PydanticObjectId]
+    ) -> dict[PydanticObjectId, tuple[float, float]]:
+        """
+        Resolve the min and max service price for many providers at once.
+
+        :param provider_ids: The provider ids to resolve.
+        :return: A dict of provider id -> (min price, max price). Providers
+                 without priced services are absent.
+        """
+        summaries = await self.get_price_summaries(provider_ids)
+        return {
+            provider_id: (summary["min_price"], summary["max_price"])
+            for provider_id, summary in summaries.items()
+            if summary["min_price"] is not None
+        }
+
+    async def update_price_summary(self, provider_id: PydanticObjectId):
+        """Recompute the denormalized price summary stored on a provider"""
+        await self._write_price_summaries([provider_id])
+
+    async def backfill_price_summaries(self, batch_size: int = 500) -> int:
+        """
+        Recompute the denormalized price summary of every provider.
+
+        :param batch_size: Number of providers summarized per aggregation.
+        :return: The number of providers updated.
+        """
+        updated = 0
+        batch = []
+        async for doc in ServiceProvider.get_motor_collection().find({}, {"_id": 1}):
+            batch.append(doc["_id"])
+            if len(batch) >= batch_size:
+                updated += await self._write_price_summaries(batch)
+                batch = []
+        if batch:
+            updated += await self._write_price_summaries(batch)
+        return updated
+
+    async def _write_price_summaries(self, provider_ids: List[PydanticObjectId]) -> int:
+        summaries = await self.get_price_summaries(provider_ids)
+        empty = {"min_price": None, "max_price": None, "active_service_count": 0}
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne({"_id": provider_id}, {"$set": {**summaries.get(provider_id, empty), "updated_at": now}})
+            for provider_id in provider_ids
+        ]
+        result = await ServiceProvider.get_motor_collection().bulk_write(operations, ordered=False)
+        await self.invalidate_ids(ServiceProvider, provider_ids)
+        return result.matched_count
+
+    async def apply_rating_delta(
+            self,
+            service_id: PydanticObjectId,
+            provider_id: PydanticObjectId,
+            sum_delta: float,
+            count_delta: int
+    ):
+        """
+        Atomically adjust the rating counters of a service item and its provider.
+
+        The averages are derived from the counters inside the same update, so
+        concurrent review writes can never leave them out of sync. Documents
+        whose counters were never seeded get them recomputed from the reviews
+        instead; `python main.py repair-ratings` seeds them all at once.
+
+        :param service_id: The reviewed service item.
+        :param provider_id: The provider owning the service item.
+        :param sum_delta: Change to apply to the sum of ratings.
+        :param count_delta: Change to apply to the number of ratings.
+        """
+        await asyncio.gather(
+            self._apply_rating_delta(ServiceItem, service_id, "service_id", "rating", sum_delta, count_delta),
+            self._apply_rating_delta(ServiceProvider, provider_id, "provider_id", "averageRating",
+                                     sum_delta, count_delta),
         )
-        return doc
+        await self.invalidate_ids(ServiceItem, [service_id])
+        await self.invalidate_ids(ServiceProvider, [provider_id])
+
+    async def _apply_rating_delta(self, cls: Type[Document], obj_id: PydanticObjectId, link_field: str,
+                                  average_field: str, sum_delta: float, count_delta: int):
+        result = await cls.get_motor_collection().update_one(
+            {"_id": obj_id, "rating_count": {"$type": "number"}},
+            self._rating_delta_pipeline(sum_delta, count_delta, average_field))
+        if result.matched_count:
+            return
+        # Counters never seeded (documents older than them, or no review yet):
+        # a delta would overwrite the stored average, so count every review
+        # instead; the one being written is already saved or deleted
+        rows = await Review.get_motor_collection().aggregate([
+            {"$match": {f"{link_field}.$id": obj_id}},
+            {"$group": {"_id": None, "rating_sum": {"$sum": "$rating"}, "rating_count": {"$sum": 1}}},
+        ]).to_list(length=None)
+        totals = rows[0] if rows else {"rating_sum": 0, "rating_count": 0}
+        await cls.get_motor_collection().update_one(
+            {"_id": obj_id, "rating_count": {"$not": {"$type": "number"}}},
+            {"$set": self._rating_fields(average_field, totals["rating_sum"], totals["rating_count"])})
+
+    @staticmethod
+    def _rating_fields(average_field: str, rating_sum: float, count: int) -> dict:
+        return {
+            "rating_sum": rating_sum,
+            "rating_count": count,
+            average_field: rating_sum / count if count else 0,
+            "reviewCount": count,
+            "updated_at": datetime.utcnow(),
+        }
+
+    @staticmethod
+    def _rating_delta_pipeline(sum_delta: float, count_delta: int, average_field: str) -> list[dict]:
+        return [
+            {"$set": {
+                "rating_sum": {"$add": [{"$ifNull": ["$rating_sum", 0]}, sum_delta]},
+                "rating_count": {"$add": [{"$ifNull": ["$rating_count", 0]}, count_delta]},
+            }},
+            {"$set": {
+                average_field: {"$cond": [
+                    {"$gt": ["$rating_count", 0]},
+                    {"$divide": ["$rating_sum", "$rating_count"]},
+                    0
+                ]},
+                "reviewCount": "$rating_count",
+                "updated_at": "$$NOW",
+            }},
+        ]
+
+    async def repair_rating_aggregates(self) -> dict[str, int]:
+        """
+        Recompute every rating counter from the reviews collection.
+
+        :return: A dict of model name -> number of documents whose stored
+                 counters were wrong and have been repaired.
+        """
+        report = {}
+        targets = ((ServiceItem, "service_id", "rating"), (ServiceProvider, "provider_id", "averageRating"))
+        for cls, link_field, average_field in targets:
+            pipeline = [{"$group": {
+                "_id": f"${link_field}.$id",
+                "rating_sum": {"$sum": "$rating"},
+                "rating_count": {"$sum": 1},
+            }}]
+            rows = await Review.get_motor_collection().aggregate(pipeline).to_list(length=None)
+            totals = {row["_id"]: row for row in rows}
+
+            operations, repaired_ids = [], []
+            projection = {"rating_sum": 1, "rating_count": 1}
+            async for doc in cls.get_motor_collection().find({}, projection):
+                expected = totals.get(doc["_id"], {"rating_sum": 0, "rating_count": 0})
+                if (doc.get("rating_count") == expected["rating_count"]
+                        and math.isclose(doc.get("rating_sum") or 0, expected["rating_sum"])):
+                    continue
+                count = expected["rating_count"]
+                repaired_ids.append(doc["_id"])
+                operations.append(UpdateOne({"_id": doc["_id"]}, {
+                    "$set": self._rating_fields(average_field, expected["rating_sum"], count)}))
+
+            if operations:
+                await cls.get_motor_collection().bulk_write(operations, ordered=False)
+                await self.invalidate_ids(cls, repaired_ids)
+            report[cls.__name__] = len(operations)
+        return report
+
+    async def rebuild_conversations(self) -> int:
+        """
+        Recompute every Conversation from the messages collection.
+
+        :return: The number of conversations written.
+        """
+        pipeline = [
+            {"$sort": {"created_at": 1, "_id": 1}},  # So `$last` is the latest message
+            {"$group": {
+                "_id": {"sender": "$sender_id.$id", "receiver": "$receiver_id.$id"},
+                "last_message": {"$last": "$$ROOT"},
+                "unread": {"$sum": {"$cond": ["$read", 0, 1]}},
+            }},
+        ]
+        conversations = {}
+        async for row in Message.get_motor_collection().aggregate(pipeline, allowDiskUse=True):
+            sender, receiver = row["_id"]["sender"], row["_id"]["receiver"]
+            last = {**row["last_message"], "sender_id": sender, "receiver_id": receiver}
+            conversation = conversations.setdefault(Conversation.key_of(sender, receiver), {
+                "participants": sorted({sender, receiver}),
+                "unread": {str(sender): 0, str(receiver): 0},
+                "last_message": None,
+            })
+            conversation["unread"][str(receiver)] += row["unread"]
+            if conversation["last_message"] is None or last["created_at"] > conversation["last_message"]["created_at"]:
+                conversation["last_message"] = last
+
+        user_ids = list({user_id for conversation in conversations.values() for user_id in conversation["participants"]})
+        users = {
+            str(user.id): {"id": str(user.id), "email": user.email, "role": user.role}
+            for user in await self.get_many(User, user_ids, projection=["email", "role"])
+        }
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne({"key": key}, {
+                "$set": {
+                    **conversation,
+                    "users": {str(user_id): users[str(user_id)]
+                              for user_id in conversation["participants"] if str(user_id) in users},
+                    "last_message_at": conversation["last_message"]["created_at"],
+                    "updated_at": now,
+                },
+                "$setOnInsert": {"created_at": now},
+            }, upsert=True)
+            for key, conversation in conversations.items()
+        ]
+        if operations:
+            await Conversation.get_motor_collection().bulk_write(operations, ordered=False)
+        return len(operations)
 
     async def find_with_count(
         self,
@@ -162,29 +535,96 @@ class DBStorage(AbstractStorageEngine):
         sort: Optional[List[tuple]] = None,
         skip: int = 0,
         limit: int = 10,
-        fetch_links: bool = False
-    ) -> tuple[list[Document], int]:
+        fetch_links: bool = False,
+        projection: Optional[Projection] = None,
+        with_total: bool = True,
+        count_limit: Optional[int] = None
+    ) -> tuple[list[Document], Optional[int]]:
         """
         Find documents with pagination and return total count.
 
+        The page and the total are two queries run concurrently. The page
+        is a sorted find with skip and limit, so the server keeps only the
+        top `skip + limit` documents of the sort, or walks an index in
+        sort order. The total is a `count_documents`, which stays
+        index-only when an index covers the filter.
+
         :param cls: The Beanie document class.
         :param filter_: A dictionary of query filters.
         :param sort: A list of (field, direction) tuples for sorting.
         :param skip: Number of documents to skip (pagination).
         :param limit: Max number of documents to return.
         :param fetch_links: Whether to fetch linked documents.
-        :return: A tuple of (documents list, total count).
+        :param projection: Projection model or field names to load instead of full documents.
+        :param with_total: Whether to count the matching documents at all.
+        :param count_limit: Stop counting after this many documents, for very large collections.
+        :return: A tuple of (documents list, total count or None when `with_total` is False).
         """
         cls = classes.get(cls) if isinstance(cls, str) else cls
-        cursor = cls.find(filter_ or {}, fetch_links=fetch_links)
+        projection_model = resolve_projection(cls, projection)
 
+        cursor = cls.find(filter_ or {}, fetch_links=fetch_links, projection_model=projection_model)
         if sort:
             cursor = cursor.sort(sort)
+        page = cursor.skip(skip).limit(limit).to_list()
+        if not with_total:
+            return await page, None
 
-        total = await cursor.count()
-        results = await cursor.skip(skip).limit(limit).to_list()
-
+        if fetch_links:
+            # Filters may then reference linked fields, only Beanie resolves them
+            count = cls.find(filter_ or {}, fetch_links=True).count()
+        else:
+            count_options = {"limit": count_limit} if count_limit is not None else {}
+            count = cls.get_motor_collection().count_documents(filter_ or {}, **count_options)
+        results, total = await asyncio.gather(page, count)
         return results, total
 
+    async def find_with_cursor(
+        self,
+        cls: Type[Document] | str,
+        filter_: dict = None,
+        sort: Optional[List[tuple]] = None,
+        limit: int = 10,
+        cursor: Optional[str] = None,
+        fetch_links: bool = False,
+        projection: Optional[Projection] = None
+    ) -> tuple[list[Document], Optional[str]]:
+        """
+        Find one page of documents using keyset pagination.
+
+        Unlike `find_with_count` this never skips over or counts documents, so
+        every page costs the same however deep it is.
+
+        :param cls: The Beanie document class.
+        :param filter_: A dictionary of query filters.
+        :param sort: A list of (field, direction) tuples, `_id` is appended as a tiebreaker.
+        :param limit: Max number of documents to return.
+        :param cursor: The `next_cursor` of the previous page, empty or None for the first page.
+        :param fetch_links: Whether to fetch linked documents.
+        :param projection: Projection model or field names to load instead of full documents.
+        :return: A tuple of (documents list, cursor of the next page or None on the last page).
+        :raises InvalidCursor: If the cursor is malformed or was built for another sort.
+        """
+        cls = classes.get(cls) if isinstance(cls, str) else cls
+        sort = keyset_sort(sort)
+        query = filter_ or {}
+        if cursor:
+            query = {"$and": [query, keyset_filter(sort, decode_cursor(cursor, sort))]}
+
+        results = await cls.find(query, fetch_links=fetch_links,
+                                 projection_model=resolve_projection(cls, projection)) \
+            .sort(sort).limit(limit + 1).to_list()
+
+        next_cursor = encode_cursor(results[limit - 1], sort) if len(results) > limit else None
+        return results[:limit], next_cursor
+
+    async def invalidate(self, obj: Document):
+        """Drop cached copies of a document. No-op without a cache layer"""
+        pass
+
+    async def invalidate_ids(self, cls: Type[Document], obj_ids: List[PydanticObjectId]):
+        """Drop cached copies of documents by id. No-op without a cache layer"""
+        pass
+
     async def get_user_db(self):
         yield BeanieUserDatabase(User)
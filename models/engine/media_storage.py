@@ -1,18 +1,50 @@
+import asyncio
 import os
-from typing import Optional
+import shutil
+import socket
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from traceback import print_exc, print_exception
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
 
 import cloudinary
 import cloudinary.uploader
+from beanie import Document
+from beanie.odm.utils.parsing import parse_obj
 from cloudinary.utils import cloudinary_url
 from fastapi import UploadFile
+from pymongo import ReturnDocument
 
+import models
+from models.media_job import MediaUploadJob
 
-class MediaStorage:
+
+class MediaBackend(ABC):
     """
-    Media storage class for handling image and video uploads, transformations,
-    and deletions using Cloudinary.
+    Blocking media backend. Upload results follow Cloudinary's shape and
+    always carry `public_id` and `secure_url`.
     """
 
+    @abstractmethod
+    def upload(self, file: BinaryIO | str, public_id: Optional[str] = None, resource_type: str = "image",
+               timeout: Optional[float] = None) -> dict:
+        """
+        :param timeout: Seconds after which the backend call itself gives up and
+            raises, so a hung upload frees its pool thread.
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, public_id: str, resource_type: str = "image") -> dict:
+        pass
+
+    @abstractmethod
+    def url(self, public_id: str, resource_type: str = "image", **transformations) -> str:
+        pass
+
+
+class CloudinaryBackend(MediaBackend):
     def __init__(self):
         self.cloud_name = os.getenv("CLOUDINARY_CLOUD_NAME")
         self.api_key = os.getenv("CLOUDINARY_API_KEY")
@@ -25,30 +57,301 @@ class MediaStorage:
             secure=True
         )
 
-    def upload_file_from_path(self, file_path: str, public_id: Optional[str] = None, resource_type: str = "image"):
-        """Upload a local file (image or video)."""
+    def upload(self, file: BinaryIO | str, public_id: Optional[str] = None, resource_type: str = "image",
+               timeout: Optional[float] = None) -> dict:
         return cloudinary.uploader.upload(
-            file_path,
+            file,
             public_id=public_id,
-            resource_type=resource_type
+            resource_type=resource_type,
+            timeout=timeout,
         )
 
+    def delete(self, public_id: str, resource_type: str = "image") -> dict:
+        return cloudinary.uploader.destroy(public_id, resource_type=resource_type)
+
+    def url(self, public_id: str, resource_type: str = "image", **transformations) -> str:
+        return cloudinary_url(public_id, resource_type=resource_type, **transformations)[0]
+
+
+class LocalMediaBackend(MediaBackend):
+    """Stores media on the local filesystem, for development, tests and benchmarks"""
+
+    def __init__(self, root: str = "media", base_url: str = "/media"):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, public_id: str, resource_type: str) -> str:
+        return os.path.join(self.root, resource_type, public_id)
+
+    def upload(self, file: BinaryIO | str, public_id: Optional[str] = None, resource_type: str = "image",
+               timeout: Optional[float] = None) -> dict:
+        public_id = public_id or os.urandom(12).hex()
+        path = self._path(public_id, resource_type)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(file, str):
+            shutil.copyfile(file, path)
+        else:
+            with open(path, "wb") as out:
+                shutil.copyfileobj(file, out)
+        return {
+            "public_id": public_id,
+            "resource_type": resource_type,
+            "bytes": os.path.getsize(path),
+            "secure_url": self.url(public_id, resource_type),
+        }
+
+    def delete(self, public_id: str, resource_type: str = "image") -> dict:
+        try:
+            os.remove(self._path(public_id, resource_type))
+            return {"result": "ok"}
+        except FileNotFoundError:
+            return {"result": "not found"}
+
+    def url(self, public_id: str, resource_type: str = "image", **transformations) -> str:
+        return f"{self.base_url}/{resource_type}/{public_id}"
+
+
+class MediaStorage:
+    """
+    Media storage class for handling image and video uploads, transformations,
+    and deletions. Cloudinary is used by default; set MEDIA_BACKEND=local to
+    store files under MEDIA_LOCAL_ROOT instead.
+
+    The async methods run the blocking backend calls on a bounded thread
+    pool so uploads never stall the event loop.
+
+    With MEDIA_UPLOAD_MODE=spool, `stage_many` only writes files to a local
+    spool directory and returns `pending` entries. `schedule` records an
+    upload job per entry once the owning document is saved, and
+    `run_spool_worker` pushes them to the backend in the background,
+    patching each entry's `status` to `ready` (or `failed`) when done.
+    """
+
+    # Retry schedule for spooled uploads: 5s, 10s, 20s, ... capped at 10 minutes
+    SPOOL_MAX_ATTEMPTS = 6
+    SPOOL_BACKOFF_BASE = 5
+    SPOOL_BACKOFF_MAX = 600
+
+    def __init__(self, backend: Optional[MediaBackend] = None, max_workers: Optional[int] = None,
+                 upload_timeout: Optional[float] = None, spool_dir: Optional[str] = None):
+        if backend is None:
+            if os.getenv("MEDIA_BACKEND", "cloudinary").lower() == "local":
+                backend = LocalMediaBackend(os.getenv("MEDIA_LOCAL_ROOT", "media"),
+                                            os.getenv("MEDIA_LOCAL_BASE_URL", "/media"))
+            else:
+                backend = CloudinaryBackend()
+        self.backend = backend
+        self.upload_timeout = upload_timeout or float(os.getenv("MEDIA_UPLOAD_TIMEOUT", "30"))
+        max_workers = max_workers or int(os.getenv("MEDIA_UPLOAD_WORKERS", "4"))
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="media-upload")
+        # One slot per pool thread, held until the backend call returns rather
+        # than until the caller stops waiting: uploads still running past their
+        # timeout keep their thread, so new ones wait instead of queueing up
+        self._upload_slots = asyncio.Semaphore(max_workers)
+        self.spool_mode = os.getenv("MEDIA_UPLOAD_MODE", "direct").lower() == "spool"
+        self.spool_dir = spool_dir or os.getenv("MEDIA_SPOOL_DIR", "media_spool")
+        self.host = socket.gethostname()
+
+    def upload_file_from_path(self, file_path: str, public_id: Optional[str] = None, resource_type: str = "image"):
+        """Upload a local file (image or video)."""
+        return self.backend.upload(file_path, public_id=public_id, resource_type=resource_type)
+
     def upload(self, file: UploadFile, public_id: Optional[str] = None, resource_type: str = "image"):
-        """Upload an in-memory file (e.g., from FastAPI UploadFile)."""
-        return cloudinary.uploader.upload(
-            file.file,
-            public_id=public_id,
-            resource_type=resource_type
+        """Upload an in-memory file (e.g., from FastAPI UploadFile). Blocks the caller."""
+        return self.backend.upload(file.file, public_id=public_id, resource_type=resource_type)
+
+    async def upload_async(self, file: UploadFile | BinaryIO | str, public_id: Optional[str] = None,
+                           resource_type: str = "image", timeout: Optional[float] = None) -> dict:
+        """
+        Upload a file on the worker pool without blocking the event loop.
+
+        :param file: An UploadFile, a binary file object or a local path.
+        :param public_id: The public id of the stored media.
+        :param resource_type: "image", "video" or "raw".
+        :param timeout: Seconds to wait for this file, defaults to MEDIA_UPLOAD_TIMEOUT.
+            The backend call is given the same timeout.
+        :raises asyncio.TimeoutError: If the upload did not finish in time.
+        """
+        source = file.file if isinstance(file, UploadFile) else file
+        timeout = timeout or self.upload_timeout
+        await asyncio.wait_for(self._upload_slots.acquire(), timeout)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, self.backend.upload, source, public_id, resource_type, timeout)
+        future.add_done_callback(self._release_upload_slot)
+        # Shielded: timing out must not mark the future done while its thread still runs
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+    def _release_upload_slot(self, future: asyncio.Future):
+        self._upload_slots.release()
+        if not future.cancelled():
+            future.exception()  # Seen by the caller, or nobody waits anymore: don't warn
+
+    async def upload_many(self, files: List[Tuple[UploadFile | BinaryIO | str, str]],
+                          resource_type: str = "image", timeout: Optional[float] = None) -> List[dict]:
+        """
+        Upload several files concurrently, bounded by the worker pool size.
+
+        :param files: (file, public_id) pairs.
+        :return: The upload results, in the order of `files`.
+        """
+        return await asyncio.gather(*(
+            self.upload_async(file, public_id, resource_type, timeout) for file, public_id in files
+        ))
+
+    async def stage_many(self, files: List[Tuple[UploadFile, str]], resource_type: str = "image") -> List[dict]:
+        """
+        Store the files of a request and return their media entries.
+
+        In direct mode the files are uploaded right away and the entries are
+        `ready`. In spool mode they are only written to the local spool and
+        the entries are `pending` until `schedule` and the worker pick them up.
+
+        :param files: (file, public_id) pairs.
+        :return: {"public_id", "url", "status"} entries, in the order of `files`.
+        """
+        if not self.spool_mode:
+            results = await self.upload_many(files, resource_type)
+            return [{"public_id": r["public_id"], "url": r["secure_url"], "status": "ready"} for r in results]
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self.executor, self._write_spool_file, file.file, public_id, resource_type)
+            for file, public_id in files
+        ))
+        return [{"public_id": public_id, "url": "", "status": "pending"} for _, public_id in files]
+
+    async def schedule(self, doc: Document, field: str, entries: Dict[Any, dict], resource_type: str = "image"):
+        """
+        Queue the pending entries of a saved document for background upload.
+
+        :param doc: The saved document holding the entries.
+        :param field: The dict field of `doc` holding the entries.
+        :param entries: The entries returned by `stage_many`, keyed as in `field`.
+        """
+        jobs = [
+            MediaUploadJob(
+                model=type(doc).__name__,
+                document_id=doc.id,
+                field=field,
+                key=str(key),
+                public_id=entry["public_id"],
+                resource_type=resource_type,
+                spool_path=self._spool_path(entry["public_id"], resource_type),
+                host=self.host,
+            )
+            for key, entry in entries.items() if entry.get("status") == "pending"
+        ]
+        if jobs:
+            await MediaUploadJob.insert_many(jobs)
+
+    async def run_spool_worker(self, poll_interval: float = 2.0):
+        """Upload spooled files forever, as many jobs at a time as the worker pool has threads"""
+        running = set()
+        while True:
+            try:
+                while len(running) < self.max_workers:
+                    job = await self._claim_job()
+                    if job is None:
+                        break
+                    running.add(asyncio.create_task(self._process_job(job)))
+                if not running:
+                    await asyncio.sleep(poll_interval)
+                    continue
+                # Claim more as soon as a job ends, and look for new jobs every poll_interval
+                done, running = await asyncio.wait(running, timeout=poll_interval,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        print_exception(task.exception())
+            except asyncio.CancelledError:
+                for task in running:
+                    task.cancel()
+                raise
+            except Exception:
+                print_exc()
+                await asyncio.sleep(poll_interval)
+
+    def _spool_path(self, public_id: str, resource_type: str) -> str:
+        return os.path.join(self.spool_dir, resource_type, public_id)
+
+    def _write_spool_file(self, file: BinaryIO, public_id: str, resource_type: str):
+        path = self._spool_path(public_id, resource_type)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            shutil.copyfileobj(file, out)
+
+    async def _claim_job(self) -> Optional[MediaUploadJob]:
+        # Jobs left `uploading` by a crashed worker are retried once their lease expires
+        now = datetime.utcnow()
+        raw = await MediaUploadJob.get_motor_collection().find_one_and_update(
+            {"host": self.host, "$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "uploading", "lease_until": {"$lt": now}},
+            ]},
+            {"$set": {
+                "status": "uploading",
+                "lease_until": now + timedelta(seconds=self.upload_timeout * 2),
+                "updated_at": now,
+            }},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER,
         )
+        return parse_obj(MediaUploadJob, raw) if raw else None
+
+    async def _process_job(self, job: MediaUploadJob):
+        try:
+            result = await self.upload_async(job.spool_path, job.public_id, job.resource_type)
+        except Exception as e:
+            job.attempts += 1
+            job.last_error = repr(e)
+            if job.attempts >= self.SPOOL_MAX_ATTEMPTS:
+                job.status = "failed"
+                await self._patch_entry(job, {"public_id": job.public_id, "url": "", "status": "failed"})
+            else:
+                job.status = "pending"
+                delay = min(self.SPOOL_BACKOFF_BASE * 2 ** (job.attempts - 1), self.SPOOL_BACKOFF_MAX)
+                job.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            await job.update_self()
+            if job.status == "failed":
+                # Nothing retries a failed job: keep its error, not its file
+                self._remove_spool_file(job.spool_path)
+            return
+
+        await self._patch_entry(job, {"public_id": result["public_id"], "url": result["secure_url"], "status": "ready"})
+        job.status = "done"
+        await job.update_self()
+        self._remove_spool_file(job.spool_path)
+
+    def _remove_spool_file(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def _patch_entry(self, job: MediaUploadJob, entry: dict):
+        model = models.storage.get_model(job.model)
+        await model.get_motor_collection().update_one(
+            {"_id": job.document_id},
+            {"$set": {f"{job.field}.{job.key}": entry}},
+        )
+        await models.storage.invalidate_ids(model, [job.document_id])
 
     def delete_media(self, public_id: str, resource_type: str = "image"):
         """Delete media by public_id."""
-        return cloudinary.uploader.destroy(public_id, resource_type=resource_type)
+        return self.backend.delete(public_id, resource_type=resource_type)
+
+    async def delete_media_async(self, public_id: str, resource_type: str = "image"):
+        """Delete media by public_id on the worker pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.backend.delete, public_id, resource_type)
 
     def generate_optimized_url(self, public_id: str, resource_type: str = "image"):
         """Generate optimized URL with auto format and quality."""
-        return cloudinary_url(public_id, fetch_format="auto", quality="auto", resource_type=resource_type)[0]
+        return self.backend.url(public_id, resource_type=resource_type, fetch_format="auto", quality="auto")
 
     def generate_cropped_url(self, public_id: str, width: int = 500, height: int = 500, resource_type: str = "image"):
         """Generate auto-cropped URL."""
-        return cloudinary_url(public_id, width=width, height=height, crop="auto", gravity="auto", resource_type=resource_type)[0]
+        return self.backend.url(public_id, resource_type=resource_type, width=width, height=height,
+                                crop="auto", gravity="auto")
@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import json
+from typing import Awaitable, Callable, Optional
+
+from pydantic import BaseModel as PydanticModel
+
+from models.engine.cache import CacheBackend
+
+
+class SearchResultCache:
+    """
+    Cache of search results, keyed by the (normalized) search filters.
+
+    Keys embed the index generation: bumping it after the search index
+    changes makes every older entry unreachable at once, and those entries
+    then age out through the backend's TTL and size bound.
+
+    The generation lives in the cache backend, so with the in-memory backend
+    it is per process: only the process running the search indexer sees its
+    bumps, and neither the API workers nor `reindex-search` reach the other
+    processes, whose entries go stale until their TTL. Use the Redis backend
+    (STORAGE_CACHE=redis) whenever more than one process serves searches.
+
+    Concurrent misses on the same key in this process share a single
+    computation instead of all hitting the search backend.
+    """
+
+    GENERATION_KEY = "search:generation"
+
+    def __init__(self, backend: CacheBackend, ttl: int = 30):
+        self.backend = backend
+        self.ttl = ttl
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def key(self, kind: str, filters: PydanticModel) -> str:
+        """
+        Cache key of a result.
+
+        :param kind: What is cached for these filters, e.g. "page" or "facets".
+        :param filters: The normalized filters; every field takes part in the key.
+        """
+        generation = await self.backend.counter(self.GENERATION_KEY)
+        digest = hashlib.sha1(filters.model_dump_json().encode()).hexdigest()
+        return f"search:{generation}:{kind}:{digest}"
+
+    async def get(self, key: str) -> Optional[dict]:
+        cached, = await self.backend.get_many([key])
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(cached)
+
+    async def set(self, key: str, value: dict):
+        await self.backend.set_many({key: json.dumps(value).encode()}, self.ttl)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[dict]]) -> dict:
+        """Return the cached value of `key`, or compute, store and return it"""
+        cached, = await self.backend.get_many([key])
+        if cached is not None:
+            self.hits += 1
+            return json.loads(cached)
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.hits += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await compute()
+            await self.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Waiters re-raise it; don't warn when there are none
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def bump_generation(self) -> int:
+        """Invalidate every cached result, e.g. after the search index changed"""
+        return await self.backend.incr(self.GENERATION_KEY)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / ((self.hits + self.misses) or 1)}
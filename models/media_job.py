@@ -0,0 +1,31 @@
+from datetime import datetime
+from typing import Literal, Optional
+
+from beanie import PydanticObjectId
+from pydantic import Field
+from pymongo import ASCENDING, IndexModel
+
+from models.base_model import BaseModel
+
+
+class MediaUploadJob(BaseModel):
+    """A spooled file waiting to be pushed to the media backend"""
+    model: str  # Document class owning the media entry, e.g. "ServiceItem"
+    document_id: PydanticObjectId
+    field: str  # e.g. "image_urls" or "attachments"
+    key: str  # Key of the entry inside `field`
+    public_id: str
+    resource_type: str = "image"
+    spool_path: str
+    host: str  # Spool files are local, only this host can upload them
+    status: Literal["pending", "uploading", "done", "failed"] = "pending"
+    attempts: int = 0
+    next_attempt_at: datetime = Field(default_factory=datetime.utcnow)
+    lease_until: Optional[datetime] = None
+    last_error: Optional[str] = None
+
+    class Settings:
+        collection = "media_upload_jobs"
+        indexes = [
+            IndexModel([("host", ASCENDING), ("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+        ]
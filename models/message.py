@@ -2,7 +2,8 @@ from datetime import datetime
 from typing import List, Optional
 from uuid import UUID, uuid4
 
-from beanie import Link
+from beanie import Link, PydanticObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
 from pydantic import BaseModel, Field
 
 from models.base_model import BaseModel
@@ -34,30 +35,61 @@ class Message(BaseModel):
     class Config:
         json_encoders = {datetime: lambda v: v.isoformat(), UUID: lambda v: str(v)}
 
+    class Settings:
+        # Kept from BaseModel.Settings, which this class replaces
+        use_state_management = True
+        # Back the newest-first keyset pagination of chat history
+        indexes = [
+            IndexModel([("sender_id.$id", ASCENDING), ("receiver_id.$id", ASCENDING),
+                        ("created_at", DESCENDING), ("_id", DESCENDING)]),
+        ]
+
+    @staticmethod
+    def link_id(link: "Link | User") -> PydanticObjectId:
+        """Id of a linked user, whether the link was fetched or not"""
+        return link.ref.id if isinstance(link, Link) else link.id
+
+    def snapshot(self) -> dict:
+        """The message as stored, with its links flattened to ids, see Conversation.last_message"""
+        return {
+            "_id": self.id,
+            "sender_id": self.link_id(self.sender_id),
+            "receiver_id": self.link_id(self.receiver_id),
+            "content": self.content,
+            "attachments": [attachment.model_dump(mode="json") for attachment in self.attachments],
+            "read": self.read,
+            "read_at": self.read_at,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
     async def to_read_model(self):
         await self.fetch_link(Message.sender_id)
         await self.fetch_link(Message.receiver_id)
+        return self.build_read_model(self.sender_id, self.receiver_id)
 
+    def build_read_model(self, sender: User, receiver: User) -> dict:
+        """Read model of the message, with its sender and receiver loaded by the caller"""
         # Determine sender and receiver types
-        sender_type = "customer" if self.sender_id.role == "customer" else "provider"
+        sender_type = "customer" if sender.role == "customer" else "provider"
         receiver_type = (
-            "customer" if self.receiver_id.role == "customer" else "provider"
+            "customer" if receiver.role == "customer" else "provider"
         )
 
         return {
             "id": str(self.id),
             "sender": {
-                "id": str(self.sender_id.id),
+                "id": str(sender.id),
                 "type": sender_type,
                 "name": (
-                    self.sender_id.name if hasattr(self.sender_id, "name") else None
+                    sender.name if hasattr(sender, "name") else None
                 ),
             },
             "receiver": {
-                "id": str(self.receiver_id.id),
+                "id": str(receiver.id),
                 "type": receiver_type,
                 "name": (
-                    self.receiver_id.name if hasattr(self.receiver_id, "name") else None
+                    receiver.name if hasattr(receiver, "name") else None
                 ),
             },
             "content": self.content,
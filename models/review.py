@@ -2,6 +2,7 @@ from typing import Dict, List, Optional
 from uuid import UUID
 
 from beanie import Link
+from pymongo import ASCENDING, DESCENDING, IndexModel
 
 from models.base_model import BaseModel
 from models.customer import Customer
@@ -24,6 +25,11 @@ class Review(BaseModel):
 
     class Settings:
         collection = "reviews"
+        # Back the newest-first keyset pagination of reviews
+        indexes = [
+            IndexModel([("provider_id.$id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+            IndexModel([("service_id.$id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+        ]
 
     async def to_read_model(self):
         await self.fetch_link(Review.service_id)
@@ -0,0 +1,29 @@
+from datetime import datetime
+from typing import Optional
+
+from beanie import Indexed, PydanticObjectId
+
+from models.base_model import BaseModel
+
+
+class SearchIndexerState(BaseModel):
+    """
+    Where a search indexer or reindex run left off, so a restart resumes from
+    there, or which process holds the search indexer lease.
+    """
+    name: Indexed(str, unique=True)
+    resume_token: Optional[dict] = None  # Change stream mode
+    since: Optional[datetime] = None  # Poll mode: `updated_at` watermark
+    # Full reindex: target index and last provider written, in `_id` order
+    index: Optional[str] = None
+    last_id: Optional[PydanticObjectId] = None
+    indexed: int = 0
+    failed: int = 0
+    started_at: Optional[datetime] = None
+    # Lease document: the process allowed to run the search indexer, until `lease_expires`
+    lease_owner: Optional[str] = None
+    lease_expires: Optional[datetime] = None
+
+    class Settings:
+        collection = "search_indexer_state"
+        use_state_management = True
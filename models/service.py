@@ -41,6 +41,10 @@ class ServiceItem(BaseModel):
     status: str
     reviewCount: int
     hits: int
+    # Rating counters maintained atomically by DBStorage.apply_rating_delta
+    # Unset on items older than the counters, see DBStorage.apply_rating_delta
+    rating_sum: Optional[float] = None
+    rating_count: Optional[int] = None
 
     async def to_read_model(self) -> "ServiceItemRead":
         await self.fetch_link(ServiceItem.category_id)
@@ -1,6 +1,6 @@
 from typing import Dict, List, Optional
 
-from beanie import Link
+from beanie import Indexed, Link
 from pydantic import field_validator
 import models
 from models.base_model import BaseModel
@@ -54,6 +54,13 @@ class ServiceProvider(BaseModel):
     serviceArea: Optional[str] = None
     averageRating: Optional[float] = None
     reviewCount: Optional[int] = None
+    # Denormalized from ServiceItem, kept up to date by ServiceItemCRUD
+    min_price: Optional[Indexed(float)] = None
+    max_price: Optional[Indexed(float)] = None
+    active_service_count: Optional[int] = None
+    # Rating counters maintained atomically by DBStorage.apply_rating_delta
+    rating_sum: Optional[float] = None
+    rating_count: Optional[int] = None
 
     @classmethod
     @field_validator("category")
@@ -102,23 +109,31 @@ class ServiceProvider(BaseModel):
 
     async def index_document(self):
         es_doc = await models.storage.index_search_document(self)
-        await models.es.client.index(index="service_providers_v2", id=str(self.id), document=es_doc.model_dump())
+        await models.es.index_provider(es_doc)
 
     @classmethod
     async def index_documents(cls, documents: List["ServiceProvider"]):
-        docs = [await models.storage.index_search_document(doc) for doc in documents]
-        await models.es.bulk_index("service_providers_v2", docs)
+        docs = await models.storage.search_documents({"_id": {"$in": [doc.id for doc in documents]}})
+        await models.es.bulk_index(models.es.indices["provider"], docs)
 
     async def get_price_range(self) -> tuple[str, list[float]]:
-        service_items = await models.storage.get_by_reference(
-            "ServiceItem", "provider_id", self.id, fetch_links=True, batch=True)
-        prices = [s.price for s in service_items if s.price is not None]
-
-        if not prices:
+        if self.active_service_count is not None:
+            return self.format_price_range(self.stored_price_range)
+        price_ranges = await models.storage.get_price_ranges([self.id])
+        return self.format_price_range(price_ranges.get(self.id))
+
+    @property
+    def stored_price_range(self) -> Optional[tuple[float, float]]:
+        if self.min_price is None or self.max_price is None:
+            return None
+        return self.min_price, self.max_price
+
+    @staticmethod
+    def format_price_range(price_range: Optional[tuple[float, float]]) -> tuple[str, list[float]]:
+        if not price_range:
             return "$0", [0, 0]
 
-        min_price = min(prices)
-        max_price = max(prices)
+        min_price, max_price = price_range
 
         if min_price == max_price:
             price_str = f"${min_price:.2f}"
@@ -4,6 +4,7 @@ from fastapi import APIRouter, Depends, HTTPException, Query
 
 from models import auth, sms_auth
 from services.search import SearchEngine
+from services.suggest import SuggestEngine
 from models.user import User
 from schemas.generic_schemas import SearchFilters
 from services.service import CategoryCRUD, ServiceItemCRUD
@@ -12,6 +13,9 @@ router = APIRouter(
     tags=["Public"],
     responses={404: {"description": "Not found"}},
 )
+# Shared so its fallback index survives across requests
+suggest_engine = SuggestEngine()
+
 @router.post("/search", response_model=dict)
 async def search_services(search_data: SearchFilters,
         user: User = Depends(auth.optional_current_user)
@@ -22,3 +26,10 @@ async def search_services(search_data: SearchFilters,
         return result.value
     return result.exception_case
 
+
+@router.get("/search/suggest", response_model=dict)
+async def suggest(q: str = Query(..., min_length=1, max_length=100), limit: int = Query(8, ge=1, le=20)):
+    result = await suggest_engine.suggest(q, limit)
+    if result.success:
+        return result.value
+    return result.exception_case
@@ -35,10 +35,11 @@ async def get_provider_reviews(
     provider_id: str,
     page: int = Query(1, ge=1),
     limit: int = Query(10, ge=1, le=50),
+    cursor: Optional[str] = Query(None, description="Opaque cursor, pass an empty value to start cursor mode"),
     user: User = Depends(auth.optional_current_user),
 ):
     result = await ReviewCRUD().get_by_provider(
-        provider_id=provider_id, page=page, limit=limit
+        provider_id=provider_id, page=page, limit=limit, cursor=cursor
     )
     if result.success:
         return result.value
@@ -49,10 +50,11 @@ async def get_service_reviews(
     service_id: str,
     page: int = Query(1, ge=1),
     limit: int = Query(10, ge=1, le=50),
+    cursor: Optional[str] = Query(None, description="Opaque cursor, pass an empty value to start cursor mode"),
     user: User = Depends(auth.optional_current_user),
 ):
     result = await ReviewCRUD().get_service_reviews(
-        service_id=service_id, page=page, limit=limit
+        service_id=service_id, page=page, limit=limit, cursor=cursor
     )
     if result.success:
         return result.value
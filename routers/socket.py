@@ -1,15 +1,25 @@
 import json
+import os
+from traceback import print_exc
+from uuid import uuid4
 
 from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect
 from fastapi_users import BaseUserManager
 
+import models
 from models import auth
 from models.user import User
+from services.backplane import InMemoryBackplane, RedisBackplane
 from services.socket import SocketManager
 from utils.exceptions import AppException
 
 router = APIRouter()
-socket_manager = SocketManager()
+# SOCKET_BACKPLANE: "memory" (default, single worker) or "redis" (uses REDIS_URL),
+# needed as soon as chat runs on more than one worker
+socket_manager = SocketManager(
+    RedisBackplane(models.redis_url)
+    if os.getenv("SOCKET_BACKPLANE", "memory").lower() == "redis" else InMemoryBackplane()
+)
 
 
 @router.websocket("/ws/chat")
@@ -24,7 +34,7 @@ async def websocket_endpoint(websocket: WebSocket, user_manager: BaseUserManager
 
         # Accept the connection
         await websocket.accept()
-        sid = websocket.headers.get("sec-websocket-key", "")
+        sid = websocket.headers.get("sec-websocket-key") or str(uuid4())
 
         # Connect user and store websocket
         await socket_manager.connect(sid, str(user.id), websocket)
@@ -33,8 +43,16 @@ async def websocket_endpoint(websocket: WebSocket, user_manager: BaseUserManager
             while True:
                 # Wait for messages
                 data = await websocket.receive_json()
+                socket_manager.touch(sid, heartbeat=data.get("type") in ("ping", "pong"))
 
-                if data["type"] == "message":
+                if data["type"] == "ping":
+                    socket_manager.send(sid, {"type": "pong"})
+
+                elif data["type"] == "pong":
+                    # Heartbeat answer, see SocketManager._heartbeat
+                    pass
+
+                elif data["type"] == "message":
                     # Handle new message
                     result = await socket_manager.send_message(
                         sender_id=user,
@@ -43,8 +61,8 @@ async def websocket_endpoint(websocket: WebSocket, user_manager: BaseUserManager
                         attachments=data.get("attachments"),
                     )
                     if not result.success:
-                        await websocket.send_json(
-                            {"type": "error", "message": str(result.exception_case)}
+                        socket_manager.send(
+                            sid, {"type": "error", "message": str(result.exception_case)}
                         )
 
                 elif data["type"] == "mark_read":
@@ -53,20 +71,30 @@ async def websocket_endpoint(websocket: WebSocket, user_manager: BaseUserManager
                         user_id=user, sender_id=data["sender_id"]
                     )
                     if not result.success:
-                        await websocket.send_json(
-                            {"type": "error", "message": str(result.exception_case)}
+                        socket_manager.send(
+                            sid, {"type": "error", "message": str(result.exception_case)}
                         )
 
                 elif data["type"] == "get_chat_rooms":
                     # Handle getting chat rooms
                     result = await socket_manager.get_chat_rooms(user)
-                    await websocket.send_json({
+                    socket_manager.send(sid, {
                         "type": "chat_rooms",
                         "data": result.value if result.success else [],
                     })
                     if not result.success:
-                        await websocket.send_json(
-                            {"type": "error", "message": str(result.exception_case)}
+                        socket_manager.send(
+                            sid, {"type": "error", "message": str(result.exception_case)}
+                        )
+
+                elif data["type"] == "get_unread_count":
+                    # Handle getting the unread badge
+                    result = await socket_manager.get_unread_count(user)
+                    if result.success:
+                        socket_manager.send(sid, {"type": "unread_count", "data": result.value})
+                    else:
+                        socket_manager.send(
+                            sid, {"type": "error", "message": str(result.exception_case)}
                         )
 
                 elif data["type"] == "get_chat_history":
@@ -76,18 +104,29 @@ async def websocket_endpoint(websocket: WebSocket, user_manager: BaseUserManager
                         other_user_id=data["other_user_id"],
                         page=data.get("page", 1),
                         limit=data.get("limit", 50),
+                        cursor=data.get("cursor"),
                     )
                     if result.success:
-                        await websocket.send_json(
-                            {"type": "chat_history", "data": result.value}
+                        socket_manager.send(
+                            sid, {"type": "chat_history", "data": result.value}
                         )
                     else:
-                        await websocket.send_json(
-                            {"type": "error", "message": str(result.exception_case)}
+                        socket_manager.send(
+                            sid, {"type": "error", "message": str(result.exception_case)}
                         )
 
         except WebSocketDisconnect:
             await socket_manager.disconnect(sid)
+        except Exception:
+            # Never leave a failed connection registered
+            print_exc()
+            await socket_manager.disconnect(sid, code=4000)
 
     except Exception as e:
         await websocket.close(code=4000)
+
+
+@router.get("/connections")
+async def get_connections(user: User = Depends(auth.current_superuser)):
+    """WebSocket connections held by the worker serving this request"""
+    return {**socket_manager.registry(), "details": socket_manager.connection_metrics()}
@@ -16,4 +16,8 @@ class SearchFilters(BaseModel):
     sort: str = "relevance"
     page: int = 1
     limit: int = 10
+    # Opaque keyset cursor; when set (even empty) `page` is ignored and `next_cursor` is returned
+    cursor: Optional[str] = None
+    # Also return category, subcategory, price and rating counts
+    facets: bool = False
     user_id: Optional[str] = None
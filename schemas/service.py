@@ -43,6 +43,10 @@ class PublicCategoryRead(PydanticModel):
         from_attributes = True  # Enables compatibility with ORM models
         extra = "ignore"  # Ignore extra fields not defined in the model
 
+class PublicCategoryProjection(PublicCategoryRead):
+    class Settings:
+        projection = {"id": "$_id", "title": 1, "description": 1, "serviceTypes": 1}
+
 class CategorySync(PydanticModel):
     created: List[CategoryCreate]
     updated: List[CategoryCreate]
@@ -100,5 +104,20 @@ class PublicServiceItemRead(PydanticModel):
         from_attributes = True  # Enables compatibility with ORM models
         extra = "ignore"  # Ignore extra fields not defined in the model
 
+class PublicServiceItemProjection(PublicServiceItemRead):
+    class Settings:
+        projection = {
+            "id": "$_id",
+            "title": 1,
+            "description": 1,
+            "category_id": "$category_id.$id",
+            "price": 1,
+            "status": 1,
+            "image_urls": 1,
+            "featured": 1,
+            "rating": 1,
+            "reviewCount": 1,
+        }
+
 class ServiceItemProviderProjection(BaseModel):
     provider_id: PydanticObjectId
\ No newline at end of file
@@ -1,8 +1,9 @@
+import datetime
 from typing import Any, Dict, List, Optional, Annotated
 from uuid import UUID
 
 from beanie import PydanticObjectId
-from pydantic import BaseModel, EmailStr, model_validator
+from pydantic import BaseModel, EmailStr, Field, model_validator
 from pydantic.types import StringConstraints
 
 from models.attributes import BusinessCategory, Subcategory
@@ -112,3 +113,24 @@ class PublicServiceProviderRead(BaseModel):
         orm_mode = True  # Enables compatibility with ORM models
         extra = "ignore"  # Ignore extra fields not defined in the model
 
+
+
+class ServiceProviderCardProjection(BaseModel):
+    """Slim projection of a provider holding only what a search result card shows"""
+    id: PydanticObjectId = Field(alias="_id")
+    name: str
+    description: str
+    category: Dict[BusinessCategory, List[Subcategory]]
+    address: Optional[Address] = None
+    averageRating: Optional[float] = None
+    reviewCount: Optional[int] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    active_service_count: Optional[int] = None
+    created_at: Optional[datetime.datetime] = None
+
+    @property
+    def stored_price_range(self) -> Optional[tuple[float, float]]:
+        if self.min_price is None or self.max_price is None:
+            return None
+        return self.min_price, self.max_price
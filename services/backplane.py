@@ -0,0 +1,78 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+from traceback import print_exc
+from typing import Awaitable, Callable, Optional
+
+# Delivers an event to the local sockets of a user: (user_id, event)
+Deliver = Callable[[str, dict], Awaitable[None]]
+
+
+class Backplane(ABC):
+    """
+    Fan-out of WebSocket events between workers.
+
+    SocketManager publishes every event for a user here instead of writing
+    to its own sockets; each worker runs `listen` and delivers the events
+    to the sockets it holds, so the sender's and the recipient's worker
+    no longer need to be the same.
+    """
+
+    @abstractmethod
+    async def publish(self, user_id: str, event: dict):
+        """Send a JSON-safe `event` to every connection of `user_id`, on any worker"""
+        pass
+
+    @abstractmethod
+    async def listen(self, deliver: Deliver):
+        """Call `deliver` for every published event, until cancelled"""
+        pass
+
+
+class InMemoryBackplane(Backplane):
+    """Single-process backplane: events are delivered to this worker only"""
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    async def publish(self, user_id: str, event: dict):
+        if self._deliver is not None:
+            await self._deliver(user_id, event)
+
+    async def listen(self, deliver: Deliver):
+        self._deliver = deliver
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self._deliver = None
+
+
+class RedisBackplane(Backplane):
+    """Backplane shared by every worker and node, over Redis pub/sub"""
+
+    def __init__(self, url: str, channel: str = "servicehub:socket", reconnect_delay: float = 1.0):
+        import redis.asyncio as redis
+
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+
+    async def publish(self, user_id: str, event: dict):
+        await self.client.publish(self.channel, json.dumps({"user_id": user_id, "event": event}))
+
+    async def listen(self, deliver: Deliver):
+        while True:
+            try:
+                async with self.client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        data = json.loads(message["data"])
+                        await deliver(data["user_id"], data["event"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Events published while disconnected are lost, as with any pub/sub
+                print_exc()
+                await asyncio.sleep(self.reconnect_delay)
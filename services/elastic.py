@@ -1,18 +1,78 @@
+from datetime import datetime
 from typing import List, Optional
 
-from elasticsearch import AsyncElasticsearch, helpers
+from elasticsearch import AsyncElasticsearch, BadRequestError, ConflictError, helpers
 
 from models.attributes import BusinessCategory, Subcategory
 from models.elastic.es_schema import ServiceProviderSearchDoc
+from services.search_backend import SearchBackend
 
 
-class ElasticSearchConfig:
+class ElasticSearchConfig(SearchBackend):
     """Configuration for ElasticSearch."""
 
     # ElasticSearch host
     HOST = "http://localhost:9200"
-    # Index names
-    INDEX_PROVIDER = "service_providers_v2"
+    # Index names. Providers are read and written through an alias pointing
+    # at a versioned index, so a full reindex can be swapped in atomically.
+    INDEX_PROVIDER = "service_providers"
+
+    # Managed through an index template applied to every versioned provider
+    # index. Nothing is left to dynamic mapping: filters need `keyword`
+    # fields, and index sorting needs the sort fields known at creation.
+    PROVIDER_SETTINGS = {
+        "analysis": {
+            "analyzer": {
+                # Names and titles: no stemming, accents folded ("café" ~ "cafe")
+                "provider_name": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": ["lowercase", "asciifolding"],
+                },
+                # Free text: also stemmed and stop words dropped
+                "provider_text": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": ["lowercase", "asciifolding", "english_stop", "english_stemmer"],
+                },
+            },
+            "filter": {
+                "english_stop": {"type": "stop", "stopwords": "_english_"},
+                "english_stemmer": {"type": "stemmer", "language": "english"},
+            },
+        },
+        # Segments are stored in the browse order (the empty search fallback
+        # sort), so such queries stop early when totals are not tracked
+        "sort": {
+            "field": ["averageRating", "reviewCount", "id"],
+            "order": ["desc", "desc", "asc"],
+            "missing": ["_last", "_last", "_last"],
+        },
+    }
+    PROVIDER_MAPPINGS = {
+        "dynamic": "strict",
+        "properties": {
+            "id": {"type": "keyword"},
+            "name": {"type": "text", "analyzer": "provider_name"},
+            "description": {"type": "text", "analyzer": "provider_text"},
+            "phone": {"type": "keyword", "index": False},
+            "category": {"type": "keyword"},
+            "subcategories": {"type": "keyword"},
+            "service_titles": {"type": "text", "analyzer": "provider_name"},
+            "service_descriptions": {"type": "text", "analyzer": "provider_text"},
+            "category_titles": {"type": "text", "analyzer": "provider_name"},
+            "category_descriptions": {"type": "text", "analyzer": "provider_text"},
+            "min_price": {"type": "float"},
+            "max_price": {"type": "float"},
+            "averageRating": {"type": "float"},
+            "reviewCount": {"type": "integer"},
+            "geo_point": {"type": "geo_point"},
+            "created_at": {"type": "date"},
+            "card": {"type": "object", "enabled": False},
+            "source_updated_at": {"type": "date"},
+            "suggest": {"type": "completion", "analyzer": "provider_name"},
+        }
+    }
 
     def __init__(self):
         self.client = AsyncElasticsearch(self.HOST)
@@ -20,71 +80,390 @@ class ElasticSearchConfig:
             "provider": self.INDEX_PROVIDER,
         }
 
+    async def ensure_index(self) -> bool:
+        """
+        Install the provider index template, create the index and alias if
+        missing, and check the live mapping still matches the template.
+
+        Every worker calls this at startup. The first index has a fixed
+        name, so workers racing on a fresh deploy all target the same index:
+        one creates it, the others find it there.
+
+        :return: Whether this call created the index, which is then empty.
+        """
+        alias = self.indices["provider"]
+        await self.client.indices.put_index_template(
+            name=alias,
+            index_patterns=[f"{alias}_*"],
+            template={"settings": self.PROVIDER_SETTINGS, "mappings": self.PROVIDER_MAPPINGS},
+        )
+        if not await self.client.indices.exists(index=alias):
+            try:
+                await self.client.indices.create(index=f"{alias}_initial",
+                                                 aliases={alias: {"is_write_index": True}})
+                return True
+            except BadRequestError as e:
+                if e.error != "resource_already_exists_exception":
+                    raise
+        try:
+            # New fields can be added in place; changed ones need a reindex
+            await self.client.indices.put_mapping(index=alias, **self.PROVIDER_MAPPINGS)
+        except BadRequestError:
+            pass
+        for problem in await self.validate_index():
+            print(f"Search index {alias}: {problem}. Run `python main.py reindex-search`")
+        return False
+
+    async def validate_index(self) -> List[str]:
+        """Differences between the live provider index and the template, if any"""
+        alias = self.indices["provider"]
+        problems = []
+        for index, body in (await self.client.indices.get_mapping(index=alias)).items():
+            live = body["mappings"].get("properties", {})
+            for field, expected in self.PROVIDER_MAPPINGS["properties"].items():
+                actual = live.get(field)
+                if actual is None:
+                    problems.append(f"{index}: field {field} is not mapped")
+                elif actual.get("type", "object") != expected["type"]:
+                    problems.append(f"{index}: field {field} is {actual.get('type', 'object')}, "
+                                    f"expected {expected['type']}")
+        for index, body in (await self.client.indices.get_settings(index=alias)).items():
+            if "sort" not in body["settings"]["index"]:
+                problems.append(f"{index}: index sorting is not enabled")
+        return problems
+
+    async def create_versioned_index(self, alias: bool = False) -> str:
+        """
+        Create a new, empty provider index named after the alias and the current
+        time; settings and mappings come from the index template.
+
+        :param alias: Point the provider alias at it right away.
+        :return: The index name.
+        """
+        name = f"{self.indices['provider']}_{datetime.utcnow():%Y%m%d%H%M%S}"
+        aliases = {self.indices["provider"]: {}} if alias else None
+        await self.client.indices.create(index=name, aliases=aliases)
+        return name
+
+    async def index_exists(self, index: str) -> bool:
+        return await self.client.indices.exists(index=index)
+
+    async def begin_bulk_load(self, index: str):
+        # No refreshes or replicas while bulk loading
+        await self.client.indices.put_settings(
+            index=index, settings={"refresh_interval": "-1", "number_of_replicas": 0})
+
+    async def end_bulk_load(self, index: str):
+        await self.client.indices.put_settings(
+            index=index, settings={"refresh_interval": None, "number_of_replicas": None})
+        await self.client.indices.refresh(index=index)
+
+    async def swap_alias(self, index: str) -> List[str]:
+        """
+        Atomically point the provider alias at `index`.
+
+        :return: The indices the alias pointed at before.
+        """
+        alias = self.indices["provider"]
+        previous = []
+        if await self.client.indices.exists_alias(name=alias):
+            previous = list((await self.client.indices.get_alias(name=alias)).keys())
+        actions = [{"remove": {"index": old, "alias": alias}} for old in previous if old != index]
+        actions.append({"add": {"index": index, "alias": alias, "is_write_index": True}})
+        await self.client.indices.update_aliases(actions=actions)
+        return [old for old in previous if old != index]
+
     # elastic/search.py
 
-    async def search_providers(
+    def build_provider_query(
             self,
-            query: Optional[str],
-            category: Optional[BusinessCategory],
-            subcategories: Optional[List[Subcategory]],
-            size: int = 10
-    ) -> List[str]:
+            query: Optional[str] = None,
+            category: Optional[BusinessCategory] = None,
+            subcategories: Optional[List[Subcategory]] = None,
+            price_min: Optional[float] = None,
+            price_max: Optional[float] = None,
+            min_rating: Optional[float] = None,
+            location: Optional[tuple[float, float]] = None,
+            distance: Optional[int] = None,
+    ) -> dict:
+        """
+        Build the provider search query.
+
+        :param location: (longitude, latitude) the providers must have a location near.
+        :param distance: Max distance from `location` in meters.
+        """
         must_clauses = []
+        filter_clauses = []
 
         if query:
             must_clauses.append({
                 "multi_match": {
                     "query": query,
-                    "fields": [
-                        "name^4",
-                        "description^3",
-                        "service_titles^2",
-                        "service_descriptions",
-                        "category_titles^2",
-                        "category_descriptions"
-                    ],
+                    "fields": [f"{field}^{boost}" for field, boost in self.TEXT_FIELDS.items()],
                     "fuzziness": "AUTO"
                 }
             })
 
+        # Exact constraints go in filter context: not scored, and cached by ES
+        filter_clauses.extend(self.category_clauses(category, subcategories))
+
+        # A provider matches when its price span overlaps the requested range
+        if price_min is not None:
+            filter_clauses.append({"range": {"max_price": {"gte": price_min}}})
+        if price_max is not None:
+            filter_clauses.append({"range": {"min_price": {"lte": price_max}}})
+
+        if min_rating is not None and min_rating > 0.0:
+            filter_clauses.append({"range": {"averageRating": {"gte": min_rating}}})
+
+        if location is not None:
+            filter_clauses.append({"exists": {"field": "geo_point"}})
+            # Same threshold as the former $geoNear maxDistance
+            if distance and distance > 100:
+                lng, lat = location
+                filter_clauses.append({
+                    "geo_distance": {
+                        "distance": f"{distance}m",
+                        "geo_point": {"lat": lat, "lon": lng}
+                    }
+                })
+
+        return {
+            "bool": {
+                "must": must_clauses or [{"match_all": {}}],
+                "filter": filter_clauses
+            }
+        }
+
+    @staticmethod
+    def category_clauses(
+            category: Optional[BusinessCategory],
+            subcategories: Optional[List[Subcategory]]
+    ) -> List[dict]:
+        clauses = []
         if category:
-            must_clauses.append({
+            clauses.append({
                 "term": {
                     "category": category
                 }
             })
 
         if subcategories:
-            must_clauses.append({
+            clauses.append({
                 "terms": {
                     "subcategories": subcategories
                 }
             })
+        return clauses
+
+    def facet_params(self, category: Optional[BusinessCategory],
+                     subcategories: Optional[List[Subcategory]]) -> dict:
+        """
+        Aggregations computing the search facets, and the matching post_filter.
 
-        if not must_clauses:
-            return []
+        The search runs without its category constraints, which are applied
+        as a `post_filter` instead: category counts then cover every
+        category, not just the selected one, while the price and rating
+        facets still count only providers in the selected categories.
+        """
+        category_clauses = self.category_clauses(category, subcategories)
+        params = {"aggs": self.facet_aggregations(category_clauses)}
+        if category_clauses:
+            params["post_filter"] = {"bool": {"filter": category_clauses}}
+        return params
+
+    def facet_aggregations(self, category_clauses: List[dict]) -> dict:
+        return {
+            "categories": {
+                "terms": {"field": "category", "size": len(BusinessCategory)},
+                "aggs": {
+                    "subcategories": {"terms": {"field": "subcategories", "size": len(Subcategory)}}
+                }
+            },
+            "in_categories": {
+                "filter": {"bool": {"filter": category_clauses}},
+                "aggs": {
+                    "price": {
+                        "histogram": {"field": "min_price", "interval": self.PRICE_FACET_INTERVAL,
+                                      "min_doc_count": 1}
+                    },
+                    "rating": {
+                        "range": {
+                            "field": "averageRating",
+                            "ranges": [{"key": f"{stars}+", "from": stars} for stars in self.RATING_FACETS]
+                        }
+                    }
+                }
+            }
+        }
+
+    def rank_provider_query(
+            self,
+            query: dict,
+            location: Optional[tuple[float, float]] = None,
+            ranking: Optional[dict] = None
+    ) -> dict:
+        """
+        Wrap a query in a `function_score` blending its text score with
+        rating, review count, recency and distance, all computed by ES.
+
+        :param query: The query, as returned by `build_provider_query`.
+        :param location: (longitude, latitude) to boost nearby providers, if any.
+        :param ranking: Overrides of `RANKING`.
+        """
+        ranking = {**self.RANKING, **(ranking or {})}
+        functions = []
+        if ranking["rating_weight"]:
+            functions.append({
+                "field_value_factor": {"field": "averageRating", "factor": 0.2, "missing": 0},
+                "weight": ranking["rating_weight"]
+            })
+        if ranking["reviews_weight"]:
+            functions.append({
+                "script_score": {"script": {
+                    "source": "doc['reviewCount'].size() == 0 ? 0"
+                              " : Math.min(1, Math.log10(1 + doc['reviewCount'].value) / 2.5)"
+                }},
+                "weight": ranking["reviews_weight"]
+            })
+        if ranking["recency_weight"]:
+            functions.append({
+                "gauss": {"created_at": {"origin": "now", "scale": ranking["recency_scale"], "decay": 0.5}},
+                "weight": ranking["recency_weight"]
+            })
+        if location is not None and ranking["distance_weight"]:
+            lng, lat = location
+            functions.append({
+                "gauss": {"geo_point": {
+                    "origin": {"lat": lat, "lon": lng},
+                    "scale": ranking["distance_scale"],
+                    "decay": 0.5
+                }},
+                "weight": ranking["distance_weight"]
+            })
+        if not functions:
+            return query
+        return {
+            "function_score": {
+                "query": query,
+                "functions": functions,
+                "score_mode": "sum",
+                "boost_mode": "sum"
+            }
+        }
+
+    async def search_providers(
+            self,
+            query: dict,
+            sort: List[dict],
+            size: int = 10,
+            from_: int = 0,
+            search_after: Optional[list] = None,
+            track_total_hits: bool | int = True,
+            source: List[str] = ("id",),
+            aggs: Optional[dict] = None,
+            post_filter: Optional[dict] = None
+    ) -> tuple[List[dict], Optional[int], Optional[dict]]:
+        """
+        Run one page of a provider search.
+
+        :param query: The query, as returned by `build_provider_query`.
+        :param sort: ES sort clauses; must end with a unique tiebreaker for `search_after`.
+        :param size: Page size.
+        :param from_: Hits to skip, ignored with `search_after`.
+        :param search_after: Sort values of the last hit of the previous page.
+        :param track_total_hits: Count all hits (True), up to a bound (int), or not at all (False).
+        :param source: The `_source` fields to return with each hit.
+        :param aggs: Aggregations to compute over the query's matches.
+        :param post_filter: Filter applied to the hits only, after `aggs` ran.
+        :return: A tuple of (hits, total or None when not tracked, aggregations or None).
+        """
+        params = {}
+        if aggs:
+            params["aggs"] = aggs
+        if post_filter:
+            params["post_filter"] = post_filter
+        if search_after is not None:
+            params["search_after"] = search_after
+        else:
+            params["from_"] = from_
 
         res = await self.client.search(
             index=self.indices["provider"],
-            query={
-                "bool": {
-                    "must": must_clauses
+            query=query,
+            sort=sort,
+            size=size,
+            track_total_hits=track_total_hits,
+            _source=list(source),
+            **params
+        )
+
+        total = res["hits"]["total"]["value"] if track_total_hits is not False else None
+        return res["hits"]["hits"], total, res.get("aggregations")
+
+    async def suggest_providers(self, prefix: str, size: int = 8, timeout: float = 0.5) -> List[dict]:
+        """
+        Completion suggestions for a search box prefix.
+
+        :param timeout: Seconds before giving up, so callers can fall back quickly.
+        :return: [{"id": provider id, "label": matched name or title}]
+        """
+        res = await self.client.options(request_timeout=timeout).search(
+            index=self.indices["provider"],
+            suggest={
+                "providers": {
+                    "prefix": prefix,
+                    "completion": {"field": "suggest", "size": size, "skip_duplicates": True}
                 }
             },
-            size=size,
             _source=["id"]
         )
+        return [
+            {"id": option["_source"]["id"], "label": option["text"]}
+            for option in res["suggest"]["providers"][0]["options"]
+        ]
+
+    async def index_provider(self, doc: ServiceProviderSearchDoc, index: Optional[str] = None):
+        """Index one provider document, unless the index already holds a newer version"""
+        try:
+            await self.client.index(
+                index=index or self.indices["provider"],
+                id=doc.id,
+                document=doc.model_dump(exclude={"version"}),
+                **self._version_params(doc)
+            )
+        except ConflictError:
+            pass
 
-        return [hit["_source"]["id"] for hit in res["hits"]["hits"]]
+    async def bulk_index(self, index:str, docs: List[ServiceProviderSearchDoc], deleted_ids: List[str] = (),
+                         refresh: bool | str = False) -> int:
+        """
+        Bulk index documents into ElasticSearch, skipping those older than the indexed version.
 
-    async def bulk_index(self, index:str, docs: List[ServiceProviderSearchDoc]):
-        """Bulk index documents into ElasticSearch."""
+        :param deleted_ids: Ids of documents to remove in the same bulk request.
+        :param refresh: ES refresh policy, "wait_for" returns once the changes are searchable.
+        :return: The number of documents that failed.
+        """
         actions = [
             {
                 "_index": index,
                 "_id": doc.id,
-                "_source": doc.model_dump()
+                "_source": doc.model_dump(exclude={"version"}),
+                **{f"_{key}": value for key, value in self._version_params(doc).items()}
             }
             for doc in docs
         ]
-        await helpers.async_bulk(self.client, actions)
\ No newline at end of file
+        actions += [{"_op_type": "delete", "_index": index, "_id": id} for id in deleted_ids]
+        _, errors = await helpers.async_bulk(self.client, actions, raise_on_error=False, refresh=refresh)
+        # 409: a newer version is already indexed, 404: deleting a document never indexed
+        errors = [error for error in errors if next(iter(error.values())).get("status") not in (404, 409)]
+        if errors:
+            print(f"Failed to index {len(errors)} documents into {index}: {errors[:3]}")
+        return len(errors)
+
+    @staticmethod
+    def _version_params(doc: ServiceProviderSearchDoc) -> dict:
+        # external_gte lets a rebuild of the same version through (e.g. a mapping change)
+        if doc.version is None:
+            return {}
+        return {"version": doc.version, "version_type": "external_gte"}
@@ -0,0 +1,517 @@
+import math
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from beanie import PydanticObjectId
+
+import models
+from models.attributes import BusinessCategory, Subcategory
+from models.elastic.es_schema import ServiceProviderSearchDoc
+from services.search_backend import SearchBackend
+from utils.trie import PrefixTrie, fold
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, accent-folded word tokens, like the `provider_name` analyzer"""
+    return _TOKEN.findall(fold(text))
+
+
+def trigrams(term: str) -> Set[str]:
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance of `a` and `b`, or `limit + 1` as soon as it exceeds `limit`"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def auto_fuzziness(term: str) -> int:
+    """Elasticsearch `fuzziness: AUTO` edit distance for a term"""
+    return 0 if len(term) <= 2 else 1 if len(term) <= 5 else 2
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distance in meters between two points"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+def _scale(value: str) -> float:
+    """A ranking scale in seconds ("180d") or meters ("10km", "500m")"""
+    number, unit = re.fullmatch(r"([\d.]+)\s*([a-z]+)", value).groups()
+    units = {"d": 86400, "h": 3600, "m": 1, "km": 1000}
+    return float(number) * units[unit]
+
+
+def _gauss(distance: float, scale: float, decay: float = 0.5) -> float:
+    # Same curve as the ES `gauss` decay function: `decay` at `scale`
+    sigma_squared = -scale ** 2 / (2 * math.log(decay))
+    return math.exp(-distance ** 2 / (2 * sigma_squared))
+
+
+@dataclass(frozen=True)
+class MemoryQuery:
+    """A provider query as understood by InMemorySearchBackend"""
+    text: Optional[str] = None
+    category: Optional[str] = None
+    subcategories: Optional[tuple] = None
+    price_min: Optional[float] = None
+    price_max: Optional[float] = None
+    min_rating: Optional[float] = None
+    location: Optional[tuple[float, float]] = None
+    distance: Optional[int] = None
+    # Set by rank_provider_query
+    ranking: Optional[dict] = None
+    origin: Optional[tuple[float, float]] = None
+
+
+class MemoryIndex:
+    """
+    Inverted index of provider search documents.
+
+    Every text field has its own postings (term -> {doc id: term frequency})
+    and length statistics for BM25. A trigram index over the whole
+    vocabulary finds fuzzy candidates without scanning it, and categories
+    and subcategories have plain postings sets for filtering.
+    """
+
+    # BM25 parameters, Elasticsearch defaults
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, fields: Iterable[str]):
+        self.docs: Dict[str, ServiceProviderSearchDoc] = {}
+        self.postings: Dict[str, Dict[str, Dict[str, int]]] = {field: defaultdict(dict) for field in fields}
+        self.lengths: Dict[str, Dict[str, int]] = {field: {} for field in fields}
+        self.total_lengths: Counter = Counter()
+        self.term_docs: Counter = Counter()  # Documents using a term in any field
+        self.trigram_terms: Dict[str, Set[str]] = defaultdict(set)
+        self.category_postings: Dict[str, Set[str]] = defaultdict(set)
+        self.subcategory_postings: Dict[str, Set[str]] = defaultdict(set)
+        self._suggest_trie: Optional[PrefixTrie] = None
+
+    def add(self, doc: ServiceProviderSearchDoc) -> bool:
+        """Index or replace `doc`, unless a newer version is indexed. Returns whether it was applied"""
+        current = self.docs.get(doc.id)
+        if current is not None and doc.version is not None and current.version is not None \
+                and current.version > doc.version:
+            return False
+        self.remove(doc.id)
+        self.docs[doc.id] = doc
+        for field, postings in self.postings.items():
+            tokens = tokenize(" ".join(self._values(doc, field)))
+            self.lengths[field][doc.id] = len(tokens)
+            self.total_lengths[field] += len(tokens)
+            for term, frequency in Counter(tokens).items():
+                postings[term][doc.id] = frequency
+        for term in self._terms(doc):
+            if self.term_docs[term] == 0:
+                for gram in trigrams(term):
+                    self.trigram_terms[gram].add(term)
+            self.term_docs[term] += 1
+        if doc.category:
+            self.category_postings[doc.category.value].add(doc.id)
+        for sub in doc.subcategories or []:
+            self.subcategory_postings[sub.value].add(doc.id)
+        self._suggest_trie = None
+        return True
+
+    def remove(self, doc_id: str):
+        doc = self.docs.pop(doc_id, None)
+        if doc is None:
+            return
+        for field, postings in self.postings.items():
+            self.total_lengths[field] -= self.lengths[field].pop(doc_id, 0)
+            for term in set(tokenize(" ".join(self._values(doc, field)))):
+                postings[term].pop(doc_id, None)
+                if not postings[term]:
+                    del postings[term]
+        for term in self._terms(doc):
+            self.term_docs[term] -= 1
+            if self.term_docs[term] == 0:
+                del self.term_docs[term]
+                for gram in trigrams(term):
+                    self.trigram_terms[gram].discard(term)
+        if doc.category:
+            self.category_postings[doc.category.value].discard(doc_id)
+        for sub in doc.subcategories or []:
+            self.subcategory_postings[sub.value].discard(doc_id)
+        self._suggest_trie = None
+
+    def expand(self, term: str) -> Dict[str, int]:
+        """Indexed terms within `fuzziness: AUTO` of `term`, with their edit distance"""
+        max_edits = auto_fuzziness(term)
+        if max_edits == 0:
+            return {term: 0} if term in self.term_docs else {}
+        grams = trigrams(term)
+        # Each edit destroys at most 3 trigrams
+        needed = max(1, len(grams) - 3 * max_edits)
+        shared = Counter(candidate for gram in grams for candidate in self.trigram_terms.get(gram, ()))
+        expansions = {}
+        for candidate, count in shared.items():
+            if count >= needed:
+                edits = edit_distance(term, candidate, max_edits)
+                if edits <= max_edits:
+                    expansions[candidate] = edits
+        return expansions
+
+    def bm25(self, field: str, term: str) -> Dict[str, float]:
+        """BM25 score of every document containing `term` in `field`"""
+        postings = self.postings[field].get(term)
+        if not postings:
+            return {}
+        count = len(self.lengths[field])
+        average_length = self.total_lengths[field] / count if count else 0
+        idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+        scores = {}
+        for doc_id, frequency in postings.items():
+            norm = 1 - self.B + self.B * self.lengths[field][doc_id] / (average_length or 1)
+            scores[doc_id] = idf * frequency * (self.K1 + 1) / (frequency + self.K1 * norm)
+        return scores
+
+    def suggest_trie(self) -> PrefixTrie:
+        if self._suggest_trie is None:
+            entries = [
+                (group.get("weight", 1), label, doc.id)
+                for doc in self.docs.values() for group in doc.suggest for label in group["input"]
+            ]
+            entries.sort(key=lambda entry: (-entry[0], len(entry[1])))
+            self._suggest_trie = PrefixTrie.build(((label, id) for _, label, id in entries), per_node=50)
+        return self._suggest_trie
+
+    @staticmethod
+    def _values(doc: ServiceProviderSearchDoc, field: str) -> List[str]:
+        value = getattr(doc, field)
+        return value if isinstance(value, list) else [value or ""]
+
+    def _terms(self, doc: ServiceProviderSearchDoc) -> Set[str]:
+        return {term for field in self.postings for term in tokenize(" ".join(self._values(doc, field)))}
+
+
+class InMemorySearchBackend(SearchBackend):
+    """
+    Search backend held in process memory, for development, CI and small
+    deployments without Elasticsearch, and for benchmarking search logic.
+
+    Text queries are scored like the Elasticsearch `multi_match`
+    (best_fields, fuzziness AUTO) with BM25 and the same field boosts,
+    fuzzy terms being found through a trigram index. Filters, sorting,
+    `search_after`, ranking functions, facets and suggestions follow the
+    Elasticsearch backend and return the same response shapes. Analysis is
+    simpler: no stemming or stop words.
+
+    The index starts empty: `ensure_index` loads every provider from
+    MongoDB, and the search indexer of the same process keeps it up to
+    date from there, see SearchIndexer.
+    """
+
+    INDEX_PROVIDER = "service_providers"
+    PER_PROCESS = True
+
+    def __init__(self):
+        self.indices = {
+            "provider": self.INDEX_PROVIDER,
+        }
+        self._indices: Dict[str, MemoryIndex] = {}
+        self._aliases: Dict[str, str] = {}
+        # When `ensure_index` started reading MongoDB: later changes are the indexer's
+        self.loaded_at: Optional[datetime] = None
+
+    def _index(self, name: str) -> MemoryIndex:
+        return self._indices[self._aliases.get(name, name)]
+
+    async def ensure_index(self, batch_size: int = 500) -> bool:
+        alias = self.indices["provider"]
+        if alias in self._aliases:
+            return False
+        self.loaded_at = datetime.utcnow()
+        index = await self.create_versioned_index(alias=True)
+        after = None
+        while True:
+            match = {"_id": {"$gt": after}} if after else {}
+            docs = await models.storage.search_documents(match, limit=batch_size)
+            if not docs:
+                break
+            await self.bulk_index(index, docs)
+            after = PydanticObjectId(docs[-1].id)
+        return False
+
+    async def validate_index(self) -> List[str]:
+        return []
+
+    async def create_versioned_index(self, alias: bool = False) -> str:
+        name = f"{self.indices['provider']}_{datetime.utcnow():%Y%m%d%H%M%S%f}"
+        self._indices[name] = MemoryIndex(self.TEXT_FIELDS)
+        if alias:
+            await self.swap_alias(name)
+        return name
+
+    async def index_exists(self, index: str) -> bool:
+        return index in self._indices or index in self._aliases
+
+    async def swap_alias(self, index: str) -> List[str]:
+        alias = self.indices["provider"]
+        previous = self._aliases.get(alias)
+        self._aliases[alias] = index
+        return [previous] if previous and previous != index else []
+
+    def build_provider_query(
+            self,
+            query: Optional[str] = None,
+            category: Optional[BusinessCategory] = None,
+            subcategories: Optional[List[Subcategory]] = None,
+            price_min: Optional[float] = None,
+            price_max: Optional[float] = None,
+            min_rating: Optional[float] = None,
+            location: Optional[tuple[float, float]] = None,
+            distance: Optional[int] = None,
+    ) -> MemoryQuery:
+        return MemoryQuery(
+            text=query or None,
+            category=category.value if category else None,
+            subcategories=tuple(sub.value for sub in subcategories) if subcategories else None,
+            price_min=price_min,
+            price_max=price_max,
+            min_rating=min_rating if min_rating is not None and min_rating > 0.0 else None,
+            location=location,
+            distance=distance,
+        )
+
+    def rank_provider_query(self, query: MemoryQuery, location: Optional[tuple[float, float]] = None,
+                            ranking: Optional[dict] = None) -> MemoryQuery:
+        return replace(query, ranking={**self.RANKING, **(ranking or {})}, origin=location)
+
+    def facet_params(self, category: Optional[BusinessCategory],
+                     subcategories: Optional[List[Subcategory]]) -> dict:
+        constraint = self.build_provider_query(category=category, subcategories=subcategories)
+        return {"aggs": constraint, "post_filter": constraint}
+
+    async def search_providers(
+            self,
+            query: MemoryQuery,
+            sort: List[dict],
+            size: int = 10,
+            from_: int = 0,
+            search_after: Optional[list] = None,
+            track_total_hits: bool | int = True,
+            source: List[str] = ("id",),
+            aggs: Optional[MemoryQuery] = None,
+            post_filter: Optional[MemoryQuery] = None
+    ) -> tuple[List[dict], Optional[int], Optional[dict]]:
+        index = self._index(self.indices["provider"])
+        scores = self._match(index, query)
+        aggregations = self._aggregate(index, scores, aggs) if aggs is not None else None
+        if post_filter is not None:
+            allowed = self._filter(index, post_filter, scores)
+            scores = {doc_id: score for doc_id, score in scores.items() if doc_id in allowed}
+
+        keyed = sorted(((self._sort_key(index.docs[doc_id], score, sort), doc_id, score)
+                        for doc_id, score in scores.items()), key=lambda item: item[0])
+        if search_after is not None:
+            after = self._values_key(search_after, sort)
+            keyed = [item for item in keyed if item[0] > after]
+            from_ = 0
+
+        hits = []
+        for key, doc_id, score in keyed[from_:from_ + size]:
+            doc = index.docs[doc_id]
+            dumped = doc.model_dump(mode="json", include=set(source))
+            hits.append({"_id": doc_id, "_score": score, "_source": dumped,
+                         "sort": self._sort_values(doc, score, sort)})
+
+        total = None
+        if track_total_hits is not False:
+            total = len(scores) if track_total_hits is True else min(len(scores), track_total_hits)
+        return hits, total, aggregations
+
+    async def suggest_providers(self, prefix: str, size: int = 8, timeout: float = 0.5) -> List[dict]:
+        index = self._index(self.indices["provider"])
+        suggestions, seen = [], set()
+        for label, doc_id in index.suggest_trie().search(prefix, limit=50):
+            if label in seen:
+                continue  # skip_duplicates
+            seen.add(label)
+            suggestions.append({"id": doc_id, "label": label})
+            if len(suggestions) == size:
+                break
+        return suggestions
+
+    async def index_provider(self, doc: ServiceProviderSearchDoc, index: Optional[str] = None):
+        self._index(index or self.indices["provider"]).add(doc)
+
+    async def bulk_index(self, index: str, docs: List[ServiceProviderSearchDoc], deleted_ids: List[str] = (),
+                         refresh: bool | str = False) -> int:
+        target = self._index(index)
+        for doc in docs:
+            target.add(doc)
+        for doc_id in deleted_ids:
+            target.remove(doc_id)
+        return 0
+
+    def _match(self, index: MemoryIndex, query: MemoryQuery) -> Dict[str, float]:
+        """Score of every matching document"""
+        if query.text:
+            # best_fields: the best boosted field score of each document
+            scores: Dict[str, float] = {}
+            terms = tokenize(query.text)
+            for field, boost in self.TEXT_FIELDS.items():
+                field_scores: Counter = Counter()
+                for term in terms:
+                    best: Dict[str, float] = {}
+                    for expansion in index.expand(term):
+                        for doc_id, score in index.bm25(field, expansion).items():
+                            best[doc_id] = max(best.get(doc_id, 0.0), score)
+                    field_scores.update(best)
+                for doc_id, score in field_scores.items():
+                    scores[doc_id] = max(scores.get(doc_id, 0.0), boost * score)
+        else:
+            scores = dict.fromkeys(index.docs, 1.0)  # match_all
+
+        allowed = self._filter(index, query, scores)
+        scores = {doc_id: score for doc_id, score in scores.items() if doc_id in allowed}
+        if query.ranking:
+            for doc_id in scores:
+                scores[doc_id] += self._boost(index.docs[doc_id], query)
+        return scores
+
+    def _filter(self, index: MemoryIndex, query: MemoryQuery, candidates: Iterable[str]) -> Set[str]:
+        allowed = set(candidates)
+        if query.category:
+            allowed &= index.category_postings.get(query.category, set())
+        if query.subcategories:
+            allowed &= set().union(*(index.subcategory_postings.get(sub, set()) for sub in query.subcategories))
+        matched = set()
+        for doc_id in allowed:
+            doc = index.docs[doc_id]
+            # A provider matches when its price span overlaps the requested range
+            if query.price_min is not None and (doc.max_price is None or doc.max_price < query.price_min):
+                continue
+            if query.price_max is not None and (doc.min_price is None or doc.min_price > query.price_max):
+                continue
+            if query.min_rating is not None and (doc.averageRating is None or doc.averageRating < query.min_rating):
+                continue
+            if query.location is not None:
+                if doc.geo_point is None:
+                    continue
+                if query.distance and query.distance > 100:
+                    lng, lat = query.location
+                    if haversine(lat, lng, doc.geo_point["lat"], doc.geo_point["lon"]) > query.distance:
+                        continue
+            matched.add(doc_id)
+        return matched
+
+    def _boost(self, doc: ServiceProviderSearchDoc, query: MemoryQuery) -> float:
+        """The ranking functions of ElasticSearchConfig.rank_provider_query"""
+        ranking = query.ranking
+        boost = 0.0
+        if ranking["rating_weight"]:
+            boost += ranking["rating_weight"] * 0.2 * (doc.averageRating or 0)
+        if ranking["reviews_weight"] and doc.reviewCount is not None:
+            boost += ranking["reviews_weight"] * min(1.0, math.log10(1 + doc.reviewCount) / 2.5)
+        if ranking["recency_weight"]:
+            age = 0.0
+            if doc.created_at is not None:
+                created_at = doc.created_at if doc.created_at.tzinfo else doc.created_at.replace(tzinfo=timezone.utc)
+                age = (datetime.now(timezone.utc) - created_at).total_seconds()
+            boost += ranking["recency_weight"] * _gauss(age, _scale(ranking["recency_scale"]))
+        if query.origin is not None and ranking["distance_weight"]:
+            distance = 0.0
+            if doc.geo_point is not None:
+                lng, lat = query.origin
+                distance = haversine(lat, lng, doc.geo_point["lat"], doc.geo_point["lon"])
+            boost += ranking["distance_weight"] * _gauss(distance, _scale(ranking["distance_scale"]))
+        return boost
+
+    def _aggregate(self, index: MemoryIndex, scores: Dict[str, float], constraint: MemoryQuery) -> dict:
+        """The aggregations of ElasticSearchConfig.facet_aggregations, in the same shape"""
+        categories: Dict[str, Counter] = defaultdict(Counter)
+        category_counts: Counter = Counter()
+        for doc_id in scores:
+            doc = index.docs[doc_id]
+            if doc.category:
+                category_counts[doc.category.value] += 1
+                categories[doc.category.value].update(sub.value for sub in set(doc.subcategories or []))
+
+        selected = [index.docs[doc_id] for doc_id in self._filter(index, constraint, scores)]
+        interval = self.PRICE_FACET_INTERVAL
+        prices = Counter(math.floor(doc.min_price / interval) * interval
+                         for doc in selected if doc.min_price is not None)
+        return {
+            "categories": {"buckets": [
+                {"key": category, "doc_count": count, "subcategories": {"buckets": [
+                    {"key": sub, "doc_count": sub_count} for sub, sub_count in categories[category].most_common()
+                ]}}
+                for category, count in category_counts.most_common()
+            ]},
+            "in_categories": {
+                "doc_count": len(selected),
+                "price": {"buckets": [
+                    {"key": float(key), "doc_count": prices[key]} for key in sorted(prices)
+                ]},
+                "rating": {"buckets": [
+                    {"key": f"{stars}+", "from": float(stars),
+                     "doc_count": sum(1 for doc in selected if (doc.averageRating or 0) >= stars)}
+                    for stars in self.RATING_FACETS
+                ]},
+            },
+        }
+
+    @staticmethod
+    def _sort_values(doc: ServiceProviderSearchDoc, score: float, sort: List[dict]) -> list:
+        values = []
+        for clause in sort:
+            field, = clause
+            values.append(score if field == "_score" else getattr(doc, field))
+        return [value.isoformat() if isinstance(value, datetime) else value for value in values]
+
+    def _sort_key(self, doc: ServiceProviderSearchDoc, score: float, sort: List[dict]) -> tuple:
+        return self._values_key(self._sort_values(doc, score, sort), sort)
+
+    @staticmethod
+    def _values_key(values: list, sort: List[dict]) -> tuple:
+        # Missing values sort last in both directions, like Elasticsearch
+        key = []
+        for value, clause in zip(values, sort):
+            (_, direction), = clause.items()
+            if value is None:
+                key.append((1, 0))
+            elif isinstance(value, (int, float)):
+                key.append((0, -value if direction == "desc" else value))
+            else:
+                # Strings (ids, dates): only ascending order is used on them
+                key.append((0, value) if direction == "asc" else (0, _Reversed(value)))
+        return tuple(key)
+
+
+class _Reversed:
+    """Inverts the order of a string in a sort key"""
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __lt__(self, other: "_Reversed") -> bool:
+        return self.value > other.value
+
+    def __gt__(self, other: "_Reversed") -> bool:
+        return self.value < other.value
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, _Reversed) and self.value == other.value
@@ -1,4 +1,5 @@
 import uuid
+from datetime import datetime
 
 from beanie import PydanticObjectId
 from fastapi import UploadFile
@@ -37,7 +38,8 @@ class ServiceProviderCRUD(AppCRUD):
         if not profile:
             return ServiceResult(AppException.NotFound({"message": "Service provider not found"}))
 
-        await profile.set(provider_data.model_dump(mode="python"))
+        # `set` bypasses the `_touch` hook: move `updated_at` for search indexing
+        await profile.set({**provider_data.model_dump(mode="python"), "updated_at": datetime.utcnow()})
         return ServiceResult(await profile.to_read_model())
 
     async def get_me(self, user: User) -> ServiceResult:
@@ -95,9 +97,9 @@ class ServiceProviderCRUD(AppCRUD):
 
         id = uuid.uuid4()
         public_id = f"{provider.id}_{id}"
-        result = media_storage.upload(file, public_id=public_id)
+        result = await media_storage.upload_async(file, public_id=public_id)
         provider.profile_picture = result.get("secure_url", "")
-        await provider.set({"profile_picture": provider.profile_picture})
+        await provider.set({"profile_picture": provider.profile_picture, "updated_at": datetime.utcnow()})
         return ServiceResult(await provider.to_read_model())
 
     async def request_phone_verification(self, phone: str) -> ServiceResult:
@@ -4,6 +4,7 @@ from typing import List, Optional
 
 from beanie import PydanticObjectId
 from fastapi import UploadFile
+from pymongo import DESCENDING
 
 import models
 from models.customer import Customer
@@ -13,6 +14,7 @@ from models.user import User
 from schemas.review import ReviewCreate, ReviewUpdate
 from services.app import AppCRUD
 from utils.exceptions import AppException
+from utils.pagination import InvalidCursor
 from utils.service_result import ServiceResult
 
 
@@ -38,14 +40,10 @@ class ReviewCRUD(AppCRUD):
             # Process attachments if any
             attachments = {}
             if files:
-                for file in files:
-                    id = uuid.uuid4()
-                    public_id = f"review_{service.id}_{id}"
-                    result = self.media_storage.upload(file, public_id)
-                    attachments[id] = {
-                        "public_id": public_id,
-                        "url": result["secure_url"],
-                    }
+                ids = [uuid.uuid4() for _ in files]
+                entries = await self.media_storage.stage_many(
+                    [(file, f"review_{service.id}_{id}") for file, id in zip(files, ids)])
+                attachments.update(zip(ids, entries))
 
             # Create review
             review = Review(
@@ -57,25 +55,9 @@ class ReviewCRUD(AppCRUD):
                 attachments=attachments,
             )
             await review.save()
+            await self.media_storage.schedule(review, "attachments", attachments)
 
-            # Update service rating
-            # Calculate new average rating
-            old_count = await Review.find(
-                Review.service_id.id == service.id
-            ).count()
-            old_provider_count = await Review.find(
-                Review.provider_id.id == service.provider_id.id
-            ).count()
-            old_avg = service.rating or 0.0
-            old_prov_avg = service.provider_id.averageRating or 0.0
-
-            new_avg = ((old_avg * old_count) + data.rating) / (old_count + 1)
-            new_prov_avg = ((old_prov_avg * old_provider_count) + data.rating) / (old_provider_count + 1)
-            service.rating = new_avg
-            service.provider_id.averageRating = new_prov_avg
-            service.provider_id.reviewCount = old_provider_count + 1
-            await service.provider_id.save()
-            await service.save()
+            await self.db.apply_rating_delta(service.id, service.provider_id.id, data.rating, 1)
 
             return ServiceResult(await review.to_read_model())
         except Exception as e:
@@ -84,20 +66,18 @@ class ReviewCRUD(AppCRUD):
                 {"message": "Failed to create review", "error": str(e)}
             ))
 
-    async def get_by_provider(self, provider_id: str, page: int = 1, limit: int = 10) -> ServiceResult:
+    async def get_by_provider(
+        self, provider_id: str, page: int = 1, limit: int = 10, cursor: Optional[str] = None
+    ) -> ServiceResult:
         try:
-            skip = (page - 1) * limit
-            reviews = (
-                await Review.find(Review.provider_id.id == PydanticObjectId(provider_id))
-                .sort(-Review.created_at)
-                .skip(skip)
-                .limit(limit)
-                .to_list()
-            )
+            if cursor is not None:
+                return await self._get_reviews_page(
+                    {"provider_id.$id": PydanticObjectId(provider_id)}, limit, cursor)
 
-            total = await Review.find(
-                Review.provider_id.id == PydanticObjectId(provider_id)
-            ).count()
+            # Page and total, queried concurrently
+            reviews, total = await self.db.find_with_count(
+                Review, {"provider_id.$id": PydanticObjectId(provider_id)}, sort=[("created_at", -1)],
+                skip=(page - 1) * limit, limit=limit)
 
             result = {
                 "page": page,
@@ -106,26 +86,24 @@ class ReviewCRUD(AppCRUD):
                 "reviews": [await review.to_read_model() for review in reviews],
             }
             return ServiceResult(result)
+        except InvalidCursor as e:
+            return ServiceResult(AppException.BadRequest({"message": str(e)}))
         except Exception as e:
             print_exc()
             return ServiceResult(AppException.GetItem({"message": "Failed to get reviews by provider", "error": str(e)}))
 
     async def get_service_reviews(
-        self, service_id: str, page: int = 1, limit: int = 10
+        self, service_id: str, page: int = 1, limit: int = 10, cursor: Optional[str] = None
     ) -> ServiceResult:
         try:
-            skip = (page - 1) * limit
-            reviews = (
-                await Review.find(Review.service_id.id == PydanticObjectId(service_id))
-                .sort(-Review.created_at)
-                .skip(skip)
-                .limit(limit)
-                .to_list()
-            )
+            if cursor is not None:
+                return await self._get_reviews_page(
+                    {"service_id.$id": PydanticObjectId(service_id)}, limit, cursor)
 
-            total = await Review.find(
-                Review.service_id.id == PydanticObjectId(service_id)
-            ).count()
+            # Page and total, queried concurrently
+            reviews, total = await self.db.find_with_count(
+                Review, {"service_id.$id": PydanticObjectId(service_id)}, sort=[("created_at", -1)],
+                skip=(page - 1) * limit, limit=limit)
 
             result = {
                 "page": page,
@@ -134,10 +112,22 @@ class ReviewCRUD(AppCRUD):
                 "reviews": [await review.to_read_model() for review in reviews],
             }
             return ServiceResult(result)
+        except InvalidCursor as e:
+            return ServiceResult(AppException.BadRequest({"message": str(e)}))
         except Exception as e:
             print_exc()
             return ServiceResult(AppException.GetItem())
 
+    async def _get_reviews_page(self, query: dict, limit: int, cursor: str) -> ServiceResult:
+        """Newest-first page of reviews in cursor mode: no skip and no total count"""
+        reviews, next_cursor = await self.db.find_with_cursor(
+            Review, query, sort=[("created_at", DESCENDING)], limit=limit, cursor=cursor)
+        return ServiceResult({
+            "limit": limit,
+            "next_cursor": next_cursor,
+            "reviews": [await review.to_read_model() for review in reviews],
+        })
+
     async def update_review(
         self,
         review_id: str,
@@ -154,6 +144,8 @@ class ReviewCRUD(AppCRUD):
             if review.user_id.id != customer.id:
                 return ServiceResult(AppException.Unauthorized({"message": "Unauthorized to update this review"}))
 
+            old_rating = review.rating
+
             # Update fields
             if data.rating is not None:
                 review.rating = data.rating
@@ -161,27 +153,20 @@ class ReviewCRUD(AppCRUD):
                 review.message = data.message
 
             # Process new attachments if any
+            new_attachments = {}
             if files:
-                for file in files:
-                    id = uuid.uuid4()
-                    public_id = f"review_{id}"
-                    result = self.media_storage.upload(file, public_id)
-                    review.attachments[id] = {
-                        "public_id": public_id,
-                        "url": result["secure_url"],
-                    }
+                ids = [uuid.uuid4() for _ in files]
+                entries = await self.media_storage.stage_many(
+                    [(file, f"review_{id}") for file, id in zip(files, ids)])
+                new_attachments = dict(zip(ids, entries))
+                review.attachments.update(new_attachments)
 
             await review.save()
+            await self.media_storage.schedule(review, "attachments", new_attachments)
 
-            # Update service rating
-            service = await self.db.get(ServiceItem, PydanticObjectId(review_id))
-            if service:
-                all_reviews = await Review.find(
-                    Review.service_id.id == service.id
-                ).to_list()
-                new_rating = sum(r.rating for r in all_reviews) / len(all_reviews)
-                service.rating = new_rating
-                await service.save()
+            if review.rating != old_rating:
+                await self.db.apply_rating_delta(
+                    review.service_id.id, review.provider_id.id, review.rating - old_rating, 0)
 
             return ServiceResult(await review.to_read_model())
         except Exception as e:
@@ -198,21 +183,8 @@ class ReviewCRUD(AppCRUD):
             if review.user_id.id != customer.id:
                 return ServiceResult(AppException.Unauthorized({"message": "Unauthorized to delete this review"}))
 
-            service = review.service_id
             await review.delete()
-
-            # Update service rating
-            if service:
-                all_reviews = await Review.find(
-                    Review.service_id.id == service.id
-                ).to_list()
-                if all_reviews:
-                    new_rating = sum(r.rating for r in all_reviews) / len(all_reviews)
-                    service.rating = new_rating
-                else:
-                    service.rating = 0
-                service.reviewCount = len(all_reviews)
-                await service.save()
+            await self.db.apply_rating_delta(review.service_id.id, review.provider_id.id, -review.rating, -1)
 
             return ServiceResult(True)
         except Exception as e:
@@ -1,161 +1,291 @@
+from datetime import datetime
 from traceback import print_exc
-from typing import List, Optional, Set
+from typing import List, Optional
 
 from beanie import PydanticObjectId
 
 import models
 from models.attributes import ALLOWED_SUBCATEGORIES, Subcategory
-from models.service import ServiceItem
+from models.elastic.es_schema import SearchCard
 from models.service_provider import ServiceProvider
 from schemas.generic_schemas import SearchFilters
+from schemas.service_provider import ServiceProviderCardProjection
 from utils.exceptions import AppException
+from utils.pagination import InvalidCursor, pack_cursor, unpack_cursor
 from utils.service_result import ServiceResult
 
 
 class SearchEngine:
-    async def format_provider(self, provider: ServiceProvider) -> dict:
-        initials = "".join(word[0] for word in provider.name.split()[:2]).upper()
+    HIT_SOURCE = ["id", "card", "source_updated_at"]
+    # Result pages fetched and cached together
+    PAGE_BUCKET = 5
+    # Matches counted for the page-mode `total`; past it, the index sort lets
+    # ES stop collecting early, and `total_capped` tells the client
+    DEFAULT_COUNT_LIMIT = 1000
 
-        price_str, price_range = await provider.get_price_range()
-        #available_now = is_provider_available_now(provider)
+    def __init__(self, count_limit: Optional[int] = DEFAULT_COUNT_LIMIT, ranking: Optional[dict] = None,
+                 verify_versions: bool = False):
+        # Stop counting matches after this many providers; None counts them all
+        self.count_limit = count_limit
+        # Overrides of SearchBackend.RANKING for relevance sorting
+        self.ranking = ranking
+        # Check each card against the provider's `updated_at` (one light MongoDB
+        # query per page) instead of trusting the index to be up to date
+        self.verify_versions = verify_versions
 
-        return {
-            "id": str(provider.id),
-            "title": provider.name,
-            "provider": provider.name,
-            "providerInitials": initials,
-            "description": provider.description or "",
-            "rating": provider.averageRating or 0.0,
-            "reviews": provider.reviewCount or 0,
-            "image": provider.image if hasattr(provider, "image_url") else "/placeholder.svg?height=200&width=300",
-            "price": price_str,
-            "priceRange": price_range,
-            "location": provider.address.city if provider.address else "Unknown",
-            "categories": list(provider.category.values()) if provider.category else [],
-            "mainCategory": (
-                list(provider.category.keys())[0]
-                if hasattr(provider, "category") and isinstance(provider.category, dict) and provider.category
-                else "General"
-            ),
-            "availableNow": True
-        }
+    async def format_provider(self, provider: ServiceProvider | ServiceProviderCardProjection,
+                              price_range: Optional[tuple[float, float]] = None) -> dict:
+        return SearchCard.from_provider(provider, price_range).model_dump()
 
     async def search(self, filters: SearchFilters) -> ServiceResult:
         try:
-            candidate_provider_ids: Optional[Set[PydanticObjectId]] = None
-            id_selection_filter_applied = False
-            providers: List[ServiceProvider] = []
-
-            if filters.q or filters.category:
-                sub_categories = ALLOWED_SUBCATEGORIES.get(filters.category, [])
-                if filters.subcategory:
-                    sub_categories = [filters.subcategory]
-                es_ids = await models.es.search_providers(filters.q, filters.category, sub_categories)
-                candidate_provider_ids = set(PydanticObjectId(id) for id in es_ids)
-                id_selection_filter_applied = True
-                if not candidate_provider_ids:
-                    return self._empty_result(filters)
-
-            service_item_filter = {}
-            if filters.price_min is not None:
-                id_selection_filter_applied = True
-                service_item_filter.setdefault("price", {})["$gte"] = filters.price_min
-            if filters.price_max is not None:
-                id_selection_filter_applied = True
-                service_item_filter.setdefault("price", {})["$lte"] = filters.price_max
-
-            if service_item_filter:
-                service_items = await ServiceItem.find(service_item_filter, fetch_links=True).to_list()
-                provider_ids_from_services = {PydanticObjectId(s.provider_id.id) for s in service_items}
-                if candidate_provider_ids is not None:
-                    candidate_provider_ids.intersection_update(provider_ids_from_services)
-                    if not candidate_provider_ids:
-                        return self._empty_result(filters)
-                else:
-                    candidate_provider_ids = provider_ids_from_services
-                    if not candidate_provider_ids:
-                        return self._empty_result(filters)
-
-            provider_filter = {}
-            if candidate_provider_ids is not None:
-                provider_filter["_id"] = {"$in": list(candidate_provider_ids)}
-            elif id_selection_filter_applied:
-                return self._empty_result(filters)
-
-            if filters.rating is not None and filters.rating > 0.0:
-                provider_filter["averageRating"] = {"$gte": filters.rating}
-
-            sort_order = self._get_sort_order(filters.sort, fallback=not id_selection_filter_applied)
-            skip = (filters.page - 1) * filters.limit
-
+            filters = self.normalize(filters)
+            location = None
             if filters.location:
                 try:
                     long, lat = map(float, filters.location.split(","))
-                    geo_near_stage = {
-                        "$geoNear": {
-                            "near": {
-                                "type": "Point",
-                                "coordinates": [long, lat]
-                            },
-                            "distanceField": "distance",
-                            "spherical": True,
-                            "query": provider_filter
-                        }
-                    }
-
-                    # Only add maxDistance if filters.distance is set and > 100
-                    if filters.distance and filters.distance > 100:
-                        geo_near_stage["$geoNear"]["maxDistance"] = filters.distance
-
-                    geo_pipeline = [
-                        geo_near_stage,
-                        {"$sort": dict(sort_order)},
-                        {"$skip": skip},
-                        {"$limit": filters.limit}
-                    ]
-                    raw_results = await ServiceProvider.get_motor_collection().aggregate(geo_pipeline).to_list(length=None)
-                    total = len(raw_results)
-                    providers = [ServiceProvider.model_validate(doc) for doc in raw_results]
                 except ValueError:
                     # Invalid long/lat
                     print_exc()
                     return ServiceResult(AppException.GetItem())
+                location = (long, lat)
+
+            cache = models.search_cache
+            # Facets do not depend on the page, so they are cached on their own
+            facets, facets_key = None, None
+            if filters.facets and cache is not None:
+                facets_key = await cache.key("facets", self._facets_scope(filters))
+                facets = await cache.get(facets_key)
+            with_facets = filters.facets and facets is None
+            computed = {}
+
+            async def fetch(run):
+                page = await run(with_facets)
+                if "facets" in page:
+                    computed["facets"] = page.pop("facets")
+                return page
+
+            page_filters = filters.model_copy(update={"facets": False})
+            if filters.cursor is not None:
+                compute = lambda: fetch(lambda agg: self._cursor_page(filters, location, agg))
+                if cache is not None:
+                    result = await cache.get_or_compute(await cache.key("cursor", page_filters), compute)
+                else:
+                    result = await compute()
+                result = dict(result)
             else:
-                # Fallback: standard query
-                providers, total = await models.storage.find_with_count(
-                    cls=ServiceProvider,
-                    filter_=provider_filter,
-                    sort=sort_order,
-                    skip=skip,
-                    limit=filters.limit,
-                    fetch_links=False
-                )
-
-            return ServiceResult({
-                "page": filters.page,
-                "limit": filters.limit,
-                "total": total,
-                "providers": [await self.format_provider(p) for p in providers]
-            })
+                if cache is None:
+                    page = await fetch(lambda agg: self._page(
+                        filters, location, (filters.page - 1) * filters.limit, filters.limit, agg))
+                    providers = page["providers"]
+                else:
+                    # Pages are cached PAGE_BUCKET at a time, so paging through
+                    # results costs one search every few pages
+                    bucket, index = divmod(filters.page - 1, self.PAGE_BUCKET)
+                    span = self.PAGE_BUCKET * filters.limit
+                    key = await cache.key("page", page_filters.model_copy(update={"page": bucket}))
+                    page = await cache.get_or_compute(key, lambda: fetch(
+                        lambda agg: self._page(filters, location, bucket * span, span, agg)))
+                    providers = page["providers"][index * filters.limit:(index + 1) * filters.limit]
+
+                result = {
+                    "page": filters.page,
+                    "limit": filters.limit,
+                    "total": page["total"],
+                    "total_capped": page.get("total_capped", False),
+                    "providers": providers
+                }
 
+            if filters.facets:
+                facets = facets or computed.get("facets")
+                if facets is None:
+                    # The page was cached but its facets have expired
+                    facets = await self._facets(filters, location)
+                    computed["facets"] = facets
+                if facets_key is not None and "facets" in computed:
+                    await cache.set(facets_key, facets)
+                result["facets"] = facets
+            return ServiceResult(result)
+
+        except InvalidCursor as e:
+            return ServiceResult(AppException.BadRequest({"message": str(e)}))
         except Exception:
             print_exc()
             return ServiceResult(AppException.GetItem())
 
-    def _empty_result(self, filters: SearchFilters) -> ServiceResult:
-        return ServiceResult({
-            "page": filters.page,
+    def normalize(self, filters: SearchFilters) -> SearchFilters:
+        """
+        Canonical form of the filters, so equivalent searches share a cache entry.
+
+        Query text is lowercased with whitespace collapsed (the analyzers
+        ignore both) and coordinates are rounded to about 100 meters.
+        """
+        update = {"user_id": None}
+        if filters.q is not None:
+            update["q"] = " ".join(filters.q.lower().split()) or None
+        if filters.location:
+            try:
+                long, lat = map(float, filters.location.split(","))
+                update["location"] = f"{round(long, 3)},{round(lat, 3)}"
+            except ValueError:
+                pass  # Reported by `search`
+        return filters.model_copy(update=update)
+
+    def _query(self, filters: SearchFilters, location: Optional[tuple[float, float]],
+               with_facets: bool = False) -> tuple[dict, List[dict], dict]:
+        """
+        The ES query, sort and extra search parameters of a search.
+
+        :param with_facets: Compute the facets along with the hits.
+        """
+        sub_categories = None
+        if filters.category:
+            sub_categories = ALLOWED_SUBCATEGORIES.get(filters.category, [])
+        if filters.subcategory:
+            sub_categories = [filters.subcategory]
+
+        params = {}
+        category, query_subcategories = filters.category, sub_categories
+        if with_facets:
+            # Category constraints are applied by the facet params, see facet_params
+            params = models.es.facet_params(filters.category, sub_categories)
+            category, query_subcategories = None, None
+
+        # Filters, sort and pagination all run in one Elasticsearch query
+        query = models.es.build_provider_query(
+            query=filters.q,
+            category=category,
+            subcategories=query_subcategories,
+            price_min=filters.price_min,
+            price_max=filters.price_max,
+            min_rating=filters.rating,
+            location=location,
+            distance=filters.distance,
+        )
+        sort_order = self._get_sort_order(filters)
+        if sort_order[0] == {"_score": "desc"}:
+            query = models.es.rank_provider_query(query, location, self.ranking)
+        return query, sort_order, params
+
+    async def _page(self, filters: SearchFilters, location: Optional[tuple[float, float]],
+                    from_: int, size: int, with_facets: bool = False) -> dict:
+        query, sort_order, params = self._query(filters, location, with_facets)
+        hits, total, aggs = await models.es.search_providers(
+            query, sort_order, size=size, from_=from_,
+            track_total_hits=self.count_limit if self.count_limit is not None else True,
+            source=self.HIT_SOURCE, **params)
+        page = {"total": total, "providers": await self._hydrate(hits),
+                "total_capped": self.count_limit is not None and total is not None and total >= self.count_limit}
+        if aggs is not None:
+            page["facets"] = self._format_facets(aggs)
+        return page
+
+    async def _cursor_page(self, filters: SearchFilters, location: Optional[tuple[float, float]],
+                           with_facets: bool = False) -> dict:
+        query, sort_order, params = self._query(filters, location, with_facets)
+        search_after = unpack_cursor(filters.cursor, sort_order) if filters.cursor else None
+        hits, _, aggs = await models.es.search_providers(
+            query, sort_order, size=filters.limit + 1,
+            search_after=search_after, track_total_hits=False, source=self.HIT_SOURCE, **params)
+        next_cursor = None
+        if len(hits) > filters.limit:
+            hits = hits[:filters.limit]
+            next_cursor = pack_cursor(sort_order, hits[-1]["sort"])
+        page = {
             "limit": filters.limit,
-            "total": 0,
-            "providers": []
-        })
-
-    def _get_sort_order(self, sort: str, fallback: bool = False) -> List:
-        if sort == "relevance" and not fallback:
-            return [("created_at", -1)]
-        elif sort == "rating":
-            return [("rating", -1)]
-        elif sort == "views":
-            return [("reviewCount", -1)]
+            "next_cursor": next_cursor,
+            "providers": await self._hydrate(hits)
+        }
+        if aggs is not None:
+            page["facets"] = self._format_facets(aggs)
+        return page
+
+    async def _facets(self, filters: SearchFilters, location: Optional[tuple[float, float]]) -> dict:
+        """Facets alone, without fetching any hit"""
+        query, sort_order, params = self._query(filters, location, with_facets=True)
+        _, _, aggs = await models.es.search_providers(
+            query, sort_order, size=0, track_total_hits=False, **params)
+        return self._format_facets(aggs)
+
+    def _facets_scope(self, filters: SearchFilters) -> SearchFilters:
+        """The filters that facets depend on; pagination and sort do not matter"""
+        return filters.model_copy(update={"page": 1, "limit": 0, "sort": "relevance", "cursor": None})
+
+    def _format_facets(self, aggs: dict) -> dict:
+        """
+        Resolve facet buckets against ALLOWED_SUBCATEGORIES: every known
+        category and subcategory is listed, with 0 when nothing matched, and
+        values indexed under a category that no longer allows them are dropped.
+        """
+        buckets = {bucket["key"]: bucket for bucket in aggs["categories"]["buckets"]}
+        categories = []
+        for category, allowed in ALLOWED_SUBCATEGORIES.items():
+            bucket = buckets.get(category.value)
+            counts = {sub["key"]: sub["doc_count"] for sub in bucket["subcategories"]["buckets"]} if bucket else {}
+            categories.append({
+                "value": category.value,
+                "count": bucket["doc_count"] if bucket else 0,
+                "subcategories": [{"value": sub.value, "count": counts.get(sub.value, 0)} for sub in allowed],
+            })
+
+        in_categories = aggs["in_categories"]
+        interval = models.es.PRICE_FACET_INTERVAL
+        return {
+            "categories": categories,
+            "price": [
+                {"from": bucket["key"], "to": bucket["key"] + interval, "count": bucket["doc_count"]}
+                for bucket in in_categories["price"]["buckets"]
+            ],
+            "rating": [
+                {"min": bucket["from"], "count": bucket["doc_count"]}
+                for bucket in in_categories["rating"]["buckets"]
+            ],
+        }
+
+    async def _hydrate(self, hits: List[dict]) -> List[dict]:
+        """
+        Cards of the hits, in hit order.
+
+        Cards come straight from the search documents; MongoDB is only read
+        for documents indexed without a card or, with `verify_versions`, for
+        providers updated since their document was built.
+        """
+        ids = [PydanticObjectId(hit["_source"]["id"]) for hit in hits]
+        cards = {id: hit["_source"].get("card") for id, hit in zip(ids, hits)}
+
+        if self.verify_versions:
+            current = await models.storage.get_many(ServiceProvider, ids, projection=["updated_at"])
+            updated_at = {p.id: p.updated_at for p in current}
+            for id, hit in zip(ids, hits):
+                indexed_at = hit["_source"].get("source_updated_at")
+                if id not in updated_at:
+                    cards.pop(id)  # Deleted since indexed
+                elif indexed_at is None or updated_at[id] > datetime.fromisoformat(indexed_at):
+                    cards[id] = None
+
+        missing = [id for id, card in cards.items() if card is None]
+        if missing:
+            providers: List[ServiceProviderCardProjection] = await models.storage.get_many(
+                ServiceProvider, missing, projection=ServiceProviderCardProjection)
+            # Only providers whose price summary has not been backfilled yet need a lookup
+            price_ranges = await models.storage.get_price_ranges(
+                [p.id for p in providers if p.active_service_count is None])
+            for p in providers:
+                cards[p.id] = await self.format_provider(p, price_ranges.get(p.id, p.stored_price_range))
+
+        return [cards[id] for id in ids if cards.get(id) is not None]
+
+    def _get_sort_order(self, filters: SearchFilters) -> List[dict]:
+        """ES sort for the request, ending with `id` so `search_after` has a unique position"""
+        filtered = (filters.q or filters.category or filters.location
+                    or filters.price_min is not None or filters.price_max is not None)
+        if filters.sort == "relevance" and filtered:
+            # Blended text, quality, recency and distance score, see SearchBackend.RANKING
+            sort = [{"_score": "desc"}]
+        elif filters.sort == "rating":
+            sort = [{"averageRating": "desc"}]
+        elif filters.sort == "views":
+            sort = [{"reviewCount": "desc"}]
         else:
-            return [("rating", -1), ("reviewCount", -1)]  # fallback for empty search
\ No newline at end of file
+            sort = [{"averageRating": "desc"}, {"reviewCount": "desc"}]  # fallback for empty search
+        return sort + [{"id": "asc"}]
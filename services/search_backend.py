@@ -0,0 +1,135 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+
+from models.attributes import BusinessCategory, Subcategory
+from models.elastic.es_schema import ServiceProviderSearchDoc
+
+
+class SearchBackend(ABC):
+    """
+    Provider search index, as used by SearchEngine, SuggestEngine and the indexers.
+
+    Queries are built and consumed by the same backend: SearchEngine only
+    passes the objects returned by `build_provider_query`,
+    `rank_provider_query` and `facet_params` back to `search_providers`.
+    Hits, aggregations and sort values follow the Elasticsearch response
+    format whatever the backend.
+    """
+
+    # Searched text fields and their boosts
+    TEXT_FIELDS = {
+        "name": 4,
+        "description": 3,
+        "service_titles": 2,
+        "service_descriptions": 1,
+        "category_titles": 2,
+        "category_descriptions": 1,
+    }
+    # How relevance ranking blends text score with provider quality, recency
+    # and distance. Every signal adds at most its weight to the text score;
+    # a weight of 0 turns the signal off.
+    RANKING = {
+        "rating_weight": 1.0,  # averageRating, 0-5 scaled to 0-1
+        "reviews_weight": 0.5,  # log of reviewCount, saturating around a few hundred reviews
+        "recency_weight": 0.5,
+        "recency_scale": "180d",  # Age at which the recency boost is halved
+        "distance_weight": 1.0,
+        "distance_scale": "10km",  # Distance at which the distance boost is halved
+    }
+    # Facet buckets: starting price in steps of PRICE_FACET_INTERVAL, minimum star rating
+    PRICE_FACET_INTERVAL = 50
+    RATING_FACETS = (4, 3, 2, 1)
+    # Every process holds its own index, which the search indexer of that
+    # process must keep current, see SearchIndexer
+    PER_PROCESS = False
+
+    indices: Dict[str, str]
+
+    @abstractmethod
+    async def ensure_index(self) -> bool:
+        """
+        Make the provider index ready to serve, at startup.
+
+        :return: Whether an empty index was created that still needs a full load.
+        """
+        pass
+
+    @abstractmethod
+    async def validate_index(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    async def create_versioned_index(self, alias: bool = False) -> str:
+        pass
+
+    @abstractmethod
+    async def index_exists(self, index: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def swap_alias(self, index: str) -> List[str]:
+        pass
+
+    async def begin_bulk_load(self, index: str):
+        """Tune `index` for a full load, see SearchReindexer"""
+        pass
+
+    async def end_bulk_load(self, index: str):
+        """Undo `begin_bulk_load` and make everything loaded searchable"""
+        pass
+
+    @abstractmethod
+    def build_provider_query(
+            self,
+            query: Optional[str] = None,
+            category: Optional[BusinessCategory] = None,
+            subcategories: Optional[List[Subcategory]] = None,
+            price_min: Optional[float] = None,
+            price_max: Optional[float] = None,
+            min_rating: Optional[float] = None,
+            location: Optional[tuple[float, float]] = None,
+            distance: Optional[int] = None,
+    ) -> Any:
+        pass
+
+    @abstractmethod
+    def rank_provider_query(self, query: Any, location: Optional[tuple[float, float]] = None,
+                            ranking: Optional[dict] = None) -> Any:
+        pass
+
+    @abstractmethod
+    def facet_params(self, category: Optional[BusinessCategory],
+                     subcategories: Optional[List[Subcategory]]) -> dict:
+        """
+        Extra `search_providers` arguments computing the facets of a query
+        built without its category constraints, which they apply to the hits.
+        """
+        pass
+
+    @abstractmethod
+    async def search_providers(
+            self,
+            query: Any,
+            sort: List[dict],
+            size: int = 10,
+            from_: int = 0,
+            search_after: Optional[list] = None,
+            track_total_hits: bool | int = True,
+            source: List[str] = ("id",),
+            aggs: Optional[Any] = None,
+            post_filter: Optional[Any] = None
+    ) -> tuple[List[dict], Optional[int], Optional[dict]]:
+        pass
+
+    @abstractmethod
+    async def suggest_providers(self, prefix: str, size: int = 8, timeout: float = 0.5) -> List[dict]:
+        pass
+
+    @abstractmethod
+    async def index_provider(self, doc: ServiceProviderSearchDoc, index: Optional[str] = None):
+        pass
+
+    @abstractmethod
+    async def bulk_index(self, index: str, docs: List[ServiceProviderSearchDoc], deleted_ids: List[str] = (),
+                         refresh: bool | str = False) -> int:
+        pass
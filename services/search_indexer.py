@@ -0,0 +1,369 @@
+import asyncio
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from traceback import print_exc
+from typing import Optional, Set
+
+from beanie import PydanticObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+
+import models
+from models.search_indexer_state import SearchIndexerState
+from models.service import Category, ServiceItem
+from models.service_provider import ServiceProvider
+
+
+class SearchIndexer:
+    """
+    Keeps the provider search index in sync with MongoDB.
+
+    Changes to providers, their categories (`services` collection) and their
+    service items are collected per provider, and every `window` seconds the
+    affected providers are rebuilt and pushed in one bulk request. Where it
+    left off is saved after each successful push, so a restart resumes from
+    there instead of needing a full reindex.
+
+    SEARCH_INDEXER selects the change source:
+      - "change_stream" (default): tail a MongoDB change stream; needs a
+        replica set and falls back to polling on a standalone server.
+      - "poll": scan the collections for a newer `updated_at`. Works on any
+        server, e.g. for local development and tests, but cannot see
+        providers being deleted.
+      - "off": do not index in the background.
+
+    Service item and category deletions carry no provider id in the change
+    stream; item deletions are still picked up through the provider's price
+    summary update.
+
+    Every worker starts an indexer, but only the one holding the lease
+    document indexes; the others stand by and take over once it expires.
+    With a per-process search backend (SEARCH_BACKEND=memory) every
+    worker has its own index to keep current instead: each indexer then
+    runs without a lease, following changes from when its backend was
+    loaded, and saves no position. Errors restart the indexer with
+    exponential backoff.
+    """
+
+    STATE_NAME = "service_providers"
+    LEASE_NAME = "lease:service_providers"
+    LEASE_TTL = timedelta(seconds=30)
+    # Category and service item fields the search documents are built from;
+    # updates touching none of them (e.g. hit counters) are not reindexed
+    CHILD_FIELDS = frozenset({"title", "description", "price", "provider_id"})
+    RETRY_MIN = 1.0
+    RETRY_MAX = 60.0
+    # Changes newer than this are left for the next poll, so writes still in
+    # flight when a scan starts are not skipped
+    POLL_LAG = timedelta(seconds=1)
+
+    def __init__(self, mode: Optional[str] = None, window: float = 1.0, max_batch: int = 500,
+                 poll_interval: float = 2.0):
+        self.mode = (mode or os.getenv("SEARCH_INDEXER", "change_stream")).lower()
+        self.window = window
+        self.max_batch = max_batch
+        self.poll_interval = poll_interval
+        self._pending: Set[PydanticObjectId] = set()
+        # Position covering every change in `_pending`
+        self._resume_token: Optional[dict] = None
+        self._since: Optional[datetime] = None
+        self._full = asyncio.Event()
+        self._state: Optional[SearchIndexerState] = None
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @property
+    def per_process(self) -> bool:
+        return models.es.PER_PROCESS
+
+    async def run(self):
+        """Index changes forever, while this process holds the indexer lease"""
+        if self.per_process:
+            print(f"Search indexer running in {self.worker} for its own index")
+            await self._index_forever()
+            return
+        renew_every = self.LEASE_TTL.total_seconds() / 3
+        while True:
+            if await self._acquire_lease():
+                print(f"Search indexer running in {self.worker}")
+                indexing = asyncio.create_task(self._index_forever())
+                try:
+                    while True:
+                        await asyncio.sleep(renew_every)
+                        if not await self._acquire_lease():
+                            print(f"Search indexer lost its lease in {self.worker}")
+                            break
+                finally:
+                    indexing.cancel()
+                    await self._release_lease()
+            await asyncio.sleep(renew_every)
+
+    async def _acquire_lease(self) -> bool:
+        """Take or renew the lease; False while another live process holds it"""
+        now = datetime.utcnow()
+        try:
+            await SearchIndexerState.get_motor_collection().update_one(
+                {"name": self.LEASE_NAME,
+                 "$or": [{"lease_owner": self.worker}, {"lease_expires": {"$lt": now}}]},
+                {"$set": {"lease_owner": self.worker, "lease_expires": now + self.LEASE_TTL, "updated_at": now},
+                 "$setOnInsert": {"created_at": now}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # The lease exists and is held by someone else
+            return False
+        except PyMongoError:
+            print_exc()
+            return False
+
+    async def _release_lease(self):
+        try:
+            await SearchIndexerState.get_motor_collection().update_one(
+                {"name": self.LEASE_NAME, "lease_owner": self.worker},
+                {"$set": {"lease_expires": datetime.utcnow()}},
+            )
+        except PyMongoError:
+            print_exc()
+
+    async def _index_forever(self):
+        """Run the indexer, restarting it with exponential backoff when it fails"""
+        delay = self.RETRY_MIN
+        while True:
+            started = time.monotonic()
+            try:
+                await self._index()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print_exc()
+            if time.monotonic() - started > self.RETRY_MAX:
+                delay = self.RETRY_MIN  # It had been running fine
+            print(f"Search indexer failed, restarting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RETRY_MAX)
+
+    async def _index(self):
+        """Watch or poll for changes until an error"""
+        if self.per_process:
+            # Kept in memory only: the index to catch up is this process's own
+            if self._state is None:
+                self._state = SearchIndexerState(name=self.STATE_NAME, since=models.es.loaded_at)
+        else:
+            self._state = await SearchIndexerState.find_one(SearchIndexerState.name == self.STATE_NAME)
+            if self._state is None:
+                self._state = SearchIndexerState(name=self.STATE_NAME)
+        flusher = asyncio.create_task(self._flush_loop())
+        try:
+            while self.mode == "change_stream":
+                try:
+                    await self._watch()
+                except OperationFailure as e:
+                    if e.code == 40573:
+                        # Change streams are only supported on replica sets
+                        print("Change streams unavailable, search indexer falls back to polling")
+                        break
+                    if e.code not in (260, 280, 286):
+                        raise
+                    # The saved position fell off the oplog
+                    print("Search indexer cannot resume its change stream, "
+                          "changes were missed: run `python main.py reindex-search`")
+                    self._state.resume_token = None
+            await self._poll()
+        finally:
+            flusher.cancel()
+
+    async def flush(self):
+        """Rebuild and push the search documents of the pending providers"""
+        if not self._pending:
+            return
+        provider_ids, self._pending = self._pending, set()
+        resume_token, since = self._resume_token, self._since
+        try:
+            docs = await models.storage.search_documents({"_id": {"$in": list(provider_ids)}})
+            found = {PydanticObjectId(doc.id) for doc in docs}
+            # Wait for the changes to be searchable before invalidating cached results
+            await models.es.bulk_index(
+                models.es.indices["provider"], docs,
+                deleted_ids=[str(id) for id in provider_ids if id not in found], refresh="wait_for")
+            if models.search_cache is not None:
+                await models.search_cache.bump_generation()
+        except Exception:
+            print_exc()
+            # Retry with the next batch; the saved position stays behind these changes
+            self._pending |= provider_ids
+            return
+
+        self._state.resume_token = resume_token
+        self._state.since = since
+        if not self.per_process:
+            await self._state.save()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print_exc()
+
+    def _add(self, provider_id: Optional[PydanticObjectId]):
+        if provider_id is None:
+            return
+        self._pending.add(provider_id)
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+
+    async def _watch(self):
+        provider_collection = ServiceProvider.get_motor_collection().name
+        pipeline = [{"$match": {"ns.coll": {"$in": [
+            provider_collection,
+            Category.get_motor_collection().name,
+            ServiceItem.get_motor_collection().name,
+        ]}}}]
+        async with models.storage.db.watch(pipeline, full_document="updateLookup",
+                                           resume_after=self._state.resume_token) as stream:
+            if self.per_process and self._state.resume_token is None and self._state.since is not None:
+                # Changes made between loading the index and opening the stream
+                await self._scan(self._state.since, datetime.utcnow())
+            async for change in stream:
+                if change["ns"]["coll"] == provider_collection:
+                    self._add(change["documentKey"]["_id"])
+                elif change["operationType"] == "update" and not self._touches(change, self.CHILD_FIELDS):
+                    pass
+                else:
+                    link = (change.get("fullDocument") or {}).get("provider_id")
+                    self._add(link.id if link is not None else None)
+                self._resume_token = stream.resume_token
+
+    @staticmethod
+    def _touches(change: dict, fields: frozenset) -> bool:
+        """Whether an update event changed any of `fields`"""
+        description = change.get("updateDescription") or {}
+        changed = [*description.get("updatedFields", {}), *description.get("removedFields", [])]
+        return any(path.split(".")[0] in fields for path in changed)
+
+    async def _poll(self):
+        since = self._state.since or datetime.utcnow()
+        while True:
+            until = datetime.utcnow() - self.POLL_LAG
+            await self._scan(since, until)
+            since = self._since = until
+            await asyncio.sleep(self.poll_interval)
+
+    async def _scan(self, since: datetime, until: datetime):
+        """Queue the providers changed between `since` and `until`"""
+        query = {"updated_at": {"$gt": since, "$lte": until}}
+        async for doc in ServiceProvider.get_motor_collection().find(query, {"_id": 1}):
+            self._add(doc["_id"])
+        for cls in (Category, ServiceItem):
+            async for doc in cls.get_motor_collection().find(query, {"provider_id": 1}):
+                link = doc.get("provider_id")
+                self._add(link.id if link is not None else None)
+
+
+class SearchReindexer:
+    """
+    Rebuilds the provider search index from scratch without downtime.
+
+    Providers are streamed in `_id` order, `batch_size` at a time, their
+    search documents built with one aggregation per batch, and loaded by
+    `workers` concurrent bulk requests into a fresh versioned index. Searches
+    keep using the current index until the load is done and the alias is
+    swapped over in one atomic step.
+
+    Progress is checkpointed after each batch, so an interrupted run started
+    again with `resume=True` continues into the same index.
+    """
+
+    STATE_NAME = "reindex"
+
+    def __init__(self, batch_size: int = 500, workers: int = 4):
+        self.batch_size = batch_size
+        self.workers = workers
+
+    async def run(self, resume: bool = True) -> SearchIndexerState:
+        """
+        Reindex every provider and swap the alias.
+
+        :param resume: Continue an interrupted run instead of starting over.
+        :return: The final state, holding the index name and the counts.
+        """
+        state = await SearchIndexerState.find_one(SearchIndexerState.name == self.STATE_NAME)
+        if state is not None and not (resume and state.index and await models.es.index_exists(state.index)):
+            await state.delete()
+            state = None
+        if state is None:
+            state = SearchIndexerState(name=self.STATE_NAME, index=await models.es.create_versioned_index(),
+                                       started_at=datetime.utcnow())
+            await state.insert()
+        else:
+            print(f"Resuming reindex into {state.index} after {state.indexed} providers")
+
+        await models.es.begin_bulk_load(state.index)
+        await self._load(state, {"_id": {"$gt": state.last_id}} if state.last_id else {})
+        # Catch up with providers changed while loading
+        await self._load(state, {"updated_at": {"$gte": state.started_at}}, checkpoint=False)
+        await models.es.end_bulk_load(state.index)
+
+        previous = await models.es.swap_alias(state.index)
+        if models.search_cache is not None:
+            await models.search_cache.bump_generation()
+        print(f"{models.es.indices['provider']} now points to {state.index}"
+              + (f", previous: {', '.join(previous)}" if previous else ""))
+        await state.delete()
+        return state
+
+    async def _load(self, state: SearchIndexerState, match: dict, checkpoint: bool = True):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        # Batches finish out of order; only the end of the completed prefix is saved
+        done: dict[int, PydanticObjectId] = {}
+        next_checkpoint = 0
+        started = time.monotonic()
+        loaded = 0
+
+        async def work():
+            nonlocal next_checkpoint, loaded
+            while (item := await queue.get()) is not None:
+                seq, docs = item
+                failed = await models.es.bulk_index(state.index, docs)
+                loaded += len(docs)
+                state.indexed += len(docs) - failed
+                state.failed += failed
+                done[seq] = PydanticObjectId(docs[-1].id)
+                while next_checkpoint in done:
+                    last_id = done.pop(next_checkpoint)
+                    next_checkpoint += 1
+                    if checkpoint:
+                        state.last_id = last_id
+                await state.save()
+                rate = loaded / max(time.monotonic() - started, 1e-6)
+                print(f"Indexed {state.indexed} providers ({rate:.0f}/s), {state.failed} failed")
+
+        async def read():
+            seq, after = 0, None
+            while True:
+                query = {"$and": [match, {"_id": {"$gt": after}}]} if after else match
+                docs = await models.storage.search_documents(query, limit=self.batch_size)
+                if not docs:
+                    break
+                await queue.put((seq, docs))
+                seq, after = seq + 1, PydanticObjectId(docs[-1].id)
+            for _ in range(self.workers):
+                await queue.put(None)
+
+        # A failing batch cancels the whole load; the checkpoint stays before it
+        async with asyncio.TaskGroup() as group:
+            group.create_task(read())
+            for _ in range(self.workers):
+                group.create_task(work())
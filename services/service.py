@@ -11,8 +11,8 @@ from models import media_storage
 from models.service import Category, ServiceItem
 from models.service_provider import ServiceProvider
 from models.user import User
-from schemas.service import CategoryCreate, PublicCategoryRead, PublicServiceItemRead, ServiceItemCreate, \
-    ServiceItemUpdate
+from schemas.service import CategoryCreate, PublicCategoryProjection, PublicServiceItemProjection, \
+    ServiceItemCreate, ServiceItemUpdate
 from services.app import AppCRUD
 from utils.exceptions import AppException
 from utils.service_result import ServiceResult
@@ -103,8 +103,8 @@ class CategoryCRUD(AppCRUD):
             if not provider:
                 return ServiceResult(AppException.NotFound({"message": "Provider not found"}))
 
-            categories = await self.db.get_by_reference(Category, "provider_id", provider.id, batch=True)
-            public_categories = [PublicCategoryRead(**(await cat.to_read_model()).model_dump()) for cat in categories]
+            public_categories = await self.db.get_by_reference(
+                Category, "provider_id", provider.id, batch=True, projection=PublicCategoryProjection)
             return ServiceResult(public_categories)
         except Exception as e:
             print_exc()
@@ -123,24 +123,25 @@ class ServiceItemCRUD(AppCRUD):
         :return: ServiceResult containing the created service item or an error.
         """
         try:
-            image_urls: Dict[str, Dict[str, str]] = {}
+            image_urls: Dict[uuid.UUID, Dict[str, str]] = {}
             provider = await self.db.get_by_reference(ServiceProvider, "user_id", user.id)
             category = await self.db.get(Category, PydanticObjectId(data.category_id))
             if not provider:
                 return ServiceResult(AppException.NotFound("Provider not found"))
 
             if files:
-                for file in files:
-                    id = uuid.uuid4()
-                    public_id = f"{provider.id}_{id}"
-                    result = media_storage.upload(file, public_id)
-                    image_urls[id] = {"public_id": public_id, "url": result["secure_url"]}
+                ids = [uuid.uuid4() for _ in files]
+                entries = await media_storage.stage_many(
+                    [(file, f"{provider.id}_{id}") for file, id in zip(files, ids)])
+                image_urls.update(zip(ids, entries))
 
             service_item = ServiceItem(**data.model_dump(mode="python"), provider_id=provider.id,
                                        reviewCount=0, rating=0)
             service_item.category_id = category
             service_item.image_urls = image_urls
             await service_item.save()
+            await media_storage.schedule(service_item, "image_urls", image_urls)
+            await self.db.update_price_summary(provider.id)
             return ServiceResult(await service_item.to_read_model())
         except Exception as e:
             print_exc()
@@ -154,12 +155,12 @@ class ServiceItemCRUD(AppCRUD):
         :return: ServiceResult indicating success or failure.
         """
         try:
-            service_item: ServiceItem = await self.db.get(ServiceItem, PydanticObjectId(service_item_id))
-            if not service_item:
+            # A bare $inc: a view is not an edit, so `updated_at` stays and search is not reindexed
+            item_id = PydanticObjectId(service_item_id)
+            result = await ServiceItem.get_motor_collection().update_one({"_id": item_id}, {"$inc": {"hits": 1}})
+            if not result.matched_count:
                 return ServiceResult(AppException.NotFound({"message": "Service item not found"}))
-
-            service_item.hits += 1
-            await service_item.save()
+            await self.db.invalidate_ids(ServiceItem, [item_id])
             return ServiceResult(True)
         except Exception as e:
             print_exc()
@@ -173,18 +174,13 @@ class ServiceItemCRUD(AppCRUD):
         :return: ServiceResult containing the list of public service items or an error.
         """
         try:
-            provider = await self.db.get(ServiceProvider, PydanticObjectId(provider_id), fetch_links=True)
+            provider = await self.db.get(ServiceProvider, PydanticObjectId(provider_id))
             if not provider:
                 return ServiceResult(AppException.NotFound({"message": "Provider not found"}))
 
-            service_items = await self.db.get_by_reference(ServiceItem, "provider_id", provider.id, batch=True, fetch_links=True)
-            public_items = [
-                PublicServiceItemRead(
-                    **(await item.to_read_model()).model_dump(),
-                )
-                for item in service_items
-                if item.status == "active"
-            ]
+            service_items = await self.db.get_by_reference(
+                ServiceItem, "provider_id", provider.id, batch=True, projection=PublicServiceItemProjection)
+            public_items = [item for item in service_items if item.status == "active"]
             return ServiceResult(public_items)
         except Exception as e:
             print_exc()
@@ -265,16 +261,17 @@ class ServiceItemCRUD(AppCRUD):
                 if field not in ["provider_id", "id", "_id", "category_id"]:
                     setattr(service_item, field, value)
 
+            new_images = {}
             if files:
                 print("Uploaded file")
-                for file in files:
-                    id = uuid.uuid4()
-                    public_id = f"{provider.id}_{id}"
-                    result = self.media_storage.upload(file, public_id)
-                    optmized_url = self.media_storage.generate_optimized_url(public_id)
-                    print(optmized_url)
-                    service_item.image_urls[id] = {"public_id": public_id, "url": result["secure_url"]}
+                ids = [uuid.uuid4() for _ in files]
+                entries = await self.media_storage.stage_many(
+                    [(file, f"{provider.id}_{id}") for file, id in zip(files, ids)])
+                new_images = dict(zip(ids, entries))
+                service_item.image_urls.update(new_images)
             await service_item.save()
+            await self.media_storage.schedule(service_item, "image_urls", new_images)
+            await self.db.update_price_summary(provider.id)
             return ServiceResult(await service_item.to_read_model())
         except Exception as e:
             print_exc()
@@ -303,6 +300,7 @@ class ServiceItemCRUD(AppCRUD):
 
             result = await service_item.delete_obj()
             print(result)
+            await self.db.update_price_summary(provider.id)
             return ServiceResult(True)
         except Exception as e:
             print_exc()
@@ -339,8 +337,11 @@ class ServiceItemCRUD(AppCRUD):
             new_service_item.status = "draft"
             new_service_item.reviewCount = 0
             new_service_item.rating = 0
+            new_service_item.rating_sum = 0
+            new_service_item.rating_count = 0
 
             await new_service_item.save()
+            await self.db.update_price_summary(provider.id)
             return ServiceResult(await new_service_item.to_read_model())
         except Exception as e:
             print_exc()
@@ -1,47 +1,166 @@
 from beanie.odm.operators.update.general import Set
 
 
+from models.conversation import Conversation
 from models.message import Message, MessageAttachment
 from models.user import User
 from utils.exceptions import AppException
 from utils.result import Result
 
 
+import asyncio
+import os
+import socket
+import time
 from datetime import datetime
 from typing import Dict, List, Optional
 from bson import ObjectId, DBRef
 from beanie import PydanticObjectId
 from fastapi import WebSocket
+from fastapi.encoders import jsonable_encoder
 from traceback import print_exc
 
 
 import models
+from services.backplane import Backplane, InMemoryBackplane
+from services.socket_connection import SocketConnection
 
 
 class SocketManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_connections: Dict[str, List[str]] = {}
+    # Close code of connections reaped by the heartbeat
+    IDLE_CODE = 4003
+
+    def __init__(self, backplane: Optional[Backplane] = None, max_queue: Optional[int] = None,
+                 overflow: Optional[str] = None, send_timeout: Optional[float] = None,
+                 heartbeat_interval: Optional[float] = None, idle_timeout: Optional[float] = None):
+        """
+        :param max_queue: Outbound events buffered per connection (SOCKET_QUEUE_SIZE).
+        :param overflow: What happens when that buffer is full (SOCKET_OVERFLOW),
+            see SocketConnection.
+        :param send_timeout: Seconds before a stuck write drops the connection (SOCKET_SEND_TIMEOUT).
+        :param heartbeat_interval: Seconds of silence before a connection is pinged
+            (SOCKET_HEARTBEAT_INTERVAL).
+        :param idle_timeout: Seconds of silence, pongs included, before a connection
+            is reaped as dead or half-open (SOCKET_IDLE_TIMEOUT).
+
+        Only clients that take part in the JSON heartbeat, having sent a
+        `ping` or `pong` once, are pinged and reaped this way. Clients that
+        only listen never answer it; their dead sockets are found by the
+        WebSocket protocol pings of the server (uvicorn `ws_ping_interval`
+        and `ws_ping_timeout`), which end their receive loop.
+        """
+        # sid -> connection; the connection also holds its user_id, the reverse index
+        self.active_connections: Dict[str, SocketConnection] = {}
+        self.user_connections: Dict[str, set[str]] = {}
         self.db = models.storage
+        # Events go through the backplane so they reach sockets on other workers
+        self.backplane = backplane or InMemoryBackplane()
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv("SOCKET_QUEUE_SIZE", "100"))
+        self.overflow = (overflow or os.getenv("SOCKET_OVERFLOW", SocketConnection.DROP_OLDEST)).lower()
+        self.send_timeout = send_timeout if send_timeout is not None else float(os.getenv("SOCKET_SEND_TIMEOUT", "10"))
+        # Checked here so bad settings fail at startup, not on every connect
+        if self.overflow not in SocketConnection.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown SOCKET_OVERFLOW {self.overflow!r}, "
+                             f"expected one of {', '.join(SocketConnection.OVERFLOW_POLICIES)}")
+        if self.max_queue < 1:
+            raise ValueError(f"SOCKET_QUEUE_SIZE must be at least 1, got {self.max_queue}")
+        if self.send_timeout <= 0:
+            raise ValueError(f"SOCKET_SEND_TIMEOUT must be positive, got {self.send_timeout}")
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None \
+            else float(os.getenv("SOCKET_HEARTBEAT_INTERVAL", "25"))
+        self.idle_timeout = idle_timeout if idle_timeout is not None else float(os.getenv("SOCKET_IDLE_TIMEOUT", "60"))
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
 
     async def connect(self, sid: str, user_id: str, websocket: WebSocket):
-        if user_id not in self.user_connections:
-            self.user_connections[user_id] = []
-        self.user_connections[user_id].append(sid)
+        connection = SocketConnection(sid, user_id, websocket, on_close=self.disconnect,
+                                      max_queue=self.max_queue, overflow=self.overflow,
+                                      send_timeout=self.send_timeout)
+        connection.start()
 
-        self.active_connections[sid] = websocket
+        if user_id not in self.user_connections:
+            self.user_connections[user_id] = set()
+        self.user_connections[user_id].add(sid)
+
+        self.active_connections[sid] = connection
+
+    async def disconnect(self, sid: str, code: int = 1000):
+        connection = self.active_connections.pop(sid, None)
+        if connection is None:
+            return
+        await connection.close(code)
+
+        connections = self.user_connections.get(connection.user_id)
+        if connections is not None:
+            connections.discard(sid)
+            if not connections:
+                del self.user_connections[connection.user_id]
+
+    def touch(self, sid: str, heartbeat: bool = False):
+        """
+        Record that the client of `sid` was heard from.
+
+        :param heartbeat: It sent a heartbeat `ping` or `pong`, so it answers
+            pings and can be reaped when it stops.
+        """
+        connection = self.active_connections.get(sid)
+        if connection is not None:
+            connection.last_seen = time.monotonic()
+            connection.heartbeat = connection.heartbeat or heartbeat
+
+    async def run(self):
+        """Deliver backplane events to the sockets of this worker and reap dead ones, forever"""
+        async with asyncio.TaskGroup() as tasks:
+            tasks.create_task(self.backplane.listen(self.deliver))
+            tasks.create_task(self._heartbeat())
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval / 2)
+            now = time.monotonic()
+            for sid, connection in list(self.active_connections.items()):
+                if not connection.heartbeat:
+                    continue  # Left to protocol-level pings, see __init__
+                silence = now - connection.last_seen
+                if silence > self.idle_timeout:
+                    await self.disconnect(sid, self.IDLE_CODE)
+                elif silence > self.heartbeat_interval:
+                    # The client answers {"type": "pong"}, which touches the connection
+                    connection.send({"type": "ping"})
+
+    async def deliver(self, user_id: str, event: dict):
+        for sid in self.user_connections.get(user_id, []):
+            self.send(sid, event)
+
+    def send(self, sid: str, event: dict) -> bool:
+        """Queue `event` for one local connection, without waiting for the client"""
+        connection = self.active_connections.get(sid)
+        return connection.send(event) if connection is not None else False
+
+    def connection_metrics(self) -> List[dict]:
+        return [connection.metrics() for connection in self.active_connections.values()]
+
+    def registry(self) -> dict:
+        """Connection counts of this worker"""
+        return {
+            "worker": self.worker,
+            "connections": len(self.active_connections),
+            "users": len(self.user_connections),
+            "queued_events": sum(connection.queue.qsize() for connection in self.active_connections.values()),
+        }
 
-    async def disconnect(self, sid: str):
-        if sid in self.active_connections:
-            print(sid)
-            del self.active_connections[sid]
+    async def publish(self, user_id: str, event: dict):
+        await self.backplane.publish(user_id, jsonable_encoder(event))
 
-        for user_id, connections in self.user_connections.items():
-            if sid in connections:
-                connections.remove(sid)
-                if not connections:
-                    del self.user_connections[user_id]
-                break
+    async def publish_stored(self, user_id: str, event: dict):
+        """
+        Publish an event about a change already saved. Delivery is best-effort:
+        a failure is logged, not reported, since the client would retry a
+        write that succeeded. The change still shows in the history and rooms.
+        """
+        try:
+            await self.publish(user_id, event)
+        except Exception:
+            print_exc()
 
     def serialize_document(self, doc):
         if isinstance(doc, list):
@@ -63,23 +182,23 @@ class SocketManager:
             "role": user.role,
         }
 
-    async def serialize_message(self, message) -> dict:
-        await message.fetch_all_links()
+    def serialize_message(self, message: Message) -> dict:
+        # Only the participants' ids are sent: read them from the links, no lookup
         result = {
             "id": str(message.id),
             "created_at": message.created_at.isoformat() if isinstance(message.created_at, datetime) else message.created_at,
             "updated_at": message.updated_at.isoformat() if isinstance(message.updated_at, datetime) else message.updated_at,
-            "sender_id": str(getattr(message.sender_id, 'id', message.sender_id.id)),
-            "receiver_id": str(getattr(message.receiver_id, 'id', message.receiver_id)),
+            "sender_id": str(Message.link_id(message.sender_id)),
+            "receiver_id": str(Message.link_id(message.receiver_id)),
             "content": message.content,
-            "attachments": message.attachments,
+            "attachments": [attachment.model_dump(mode="json") for attachment in message.attachments],
             "read": message.read,
             "read_at": message.read_at.isoformat() if isinstance(message.read_at, datetime) else message.read_at,
         }
         return result
 
-    async def serialize_messages(self, messages: List) -> List[dict]:
-        return [await self.serialize_message(message) for message in messages]
+    def serialize_messages(self, messages: List[Message]) -> List[dict]:
+        return [self.serialize_message(message) for message in messages]
 
     async def send_message(self, sender_id: User, receiver_id: str, content: str, attachments: Optional[List[dict]] = None) -> Result:
         try:
@@ -95,12 +214,11 @@ class SocketManager:
                 created_at=datetime.utcnow(),
             )
             await message.save()
+            await self._record_message(message, sender_id, receiver)
 
-            if receiver_id in self.user_connections:
-                message_data = {"type": "new_message", "data": await message.to_read_model()}
-                for sid in self.user_connections[receiver_id]:
-                    if sid in self.active_connections:
-                        await self.active_connections[sid].send_json(message_data)
+            # Both users are already loaded: no link fetching
+            message_data = {"type": "new_message", "data": message.build_read_model(sender_id, receiver)}
+            await self.publish_stored(receiver_id, message_data)
 
             return Result.success(message)
 
@@ -109,6 +227,7 @@ class SocketManager:
 
     async def mark_messages_read(self, user_id: User, sender_id: str) -> Result:
         try:
+            read_at = datetime.utcnow()
             updated_result = await Message.find(
                 {
                     "sender_id.$id": PydanticObjectId(sender_id),
@@ -116,16 +235,14 @@ class SocketManager:
                     "read": False
                 }
             ).update(
-                Set({"read": True, "read_at": datetime.utcnow()})
+                Set({"read": True, "read_at": read_at})
             )
 
-            if updated_result.modified_count > 0 and sender_id in self.user_connections:
+            if updated_result.modified_count > 0:
+                await self._record_read(PydanticObjectId(user_id.id), PydanticObjectId(sender_id),
+                                        updated_result.modified_count, read_at)
                 notification = {"type": "messages_read", "data": {"user_id": str(user_id.id)}}
-                for sid in self.user_connections[sender_id]:
-                    if sid in self.active_connections:
-                        await self.active_connections[sid].send_json(notification)
-                        print("Sent read notification to", sid)
-
+                await self.publish_stored(sender_id, notification)
 
             return Result.success(updated_result.modified_count)
 
@@ -135,47 +252,107 @@ class SocketManager:
     async def get_chat_rooms(self, user_id: User) -> Result:
         try:
             user_oid = PydanticObjectId(user_id.id)
-            pipeline = [
-                {"$match": {"$or": [
-                    {"sender_id.$id": user_oid},
-                    {"receiver_id.$id": user_oid}
-                ]}},
-                {"$group": {
-                    "_id": {"$cond": [
-                        {"$eq": ["$sender_id.$id", user_oid]},
-                        "$receiver_id.$id",
-                        "$sender_id.$id"
-                    ]},
-                    "last_message": {"$last": "$$ROOT"},
-                    "unread_count": {"$sum": {"$cond": [
-                        {"$and": [
-                            {"$eq": ["$receiver_id.$id", user_oid]},
-                            {"$eq": ["$read", False]}
-                        ]}, 1, 0
-                    ]}}
-                }},
-                {"$lookup": {
-                    "from": "User",
-                    "localField": "_id",
-                    "foreignField": "_id",
-                    "as": "user"
-                }},
-                {"$unwind": "$user"},
-                {"$project": {
-                    "user": {"id": "$user._id", "email": "$user.email", "role": "$user.role"},
-                    "last_message": 1,
-                    "unread_count": 1
-                }}
-            ]
-
-            chat_rooms = await Message.aggregate(pipeline).to_list(None)
+            me = str(user_oid)
+            # A read can create its conversation just before the message's send does
+            conversations = await Conversation.get_motor_collection().find(
+                {"participants": user_oid, "last_message_at": {"$ne": None}}, sort=[("last_message_at", -1)]
+            ).to_list(None)
+
+            chat_rooms = []
+            for conversation in conversations:
+                other = next((str(p) for p in conversation["participants"] if str(p) != me), me)
+                chat_rooms.append({
+                    "_id": other,
+                    "user": conversation.get("users", {}).get(other),
+                    "last_message": conversation.get("last_message"),
+                    # Counters can dip below 0 for a moment, see _record_read
+                    "unread_count": max(0, conversation.get("unread", {}).get(me, 0)),
+                })
             return Result.success(self.serialize_document(chat_rooms))
 
         except Exception as e:
             print_exc()
             return Result.failure(AppException(str(e)))
 
-    async def get_chat_history(self, user_id: User, other_user_id: str, page: int = 1, limit: int = 50) -> Result:
+    async def get_unread_count(self, user_id: User) -> Result:
+        """Unread messages of a user across all conversations"""
+        try:
+            user_oid = PydanticObjectId(user_id.id)
+            rows = await Conversation.get_motor_collection().aggregate([
+                {"$match": {"participants": user_oid}},
+                {"$group": {"_id": None, "unread": {"$sum": {"$max": [0, f"$unread.{user_oid}"]}}}},
+            ]).to_list(None)
+            return Result.success(rows[0]["unread"] if rows else 0)
+
+        except Exception as e:
+            print_exc()
+            return Result.failure(AppException(str(e)))
+
+    async def _record_message(self, message: Message, sender: User, receiver: User):
+        """Make `message` the last one of its conversation and count it unread for the receiver"""
+        key = Conversation.key_of(sender.id, receiver.id)
+        sender_key, receiver_key = str(sender.id), str(receiver.id)
+        now = datetime.utcnow()
+        # A message saved concurrently but older must not become the last message
+        is_latest = {"$gte": [message.created_at, {"$ifNull": ["$last_message_at", message.created_at]}]}
+        await Conversation.get_motor_collection().update_one(
+            {"key": key},
+            [{"$set": {
+                "participants": sorted({sender.id, receiver.id}),
+                "users": {"$mergeObjects": [{"$ifNull": ["$users", {}]}, {"$literal": {
+                    sender_key: self.serialize_user(sender),
+                    receiver_key: self.serialize_user(receiver),
+                }}]},
+                "last_message": {"$cond": [is_latest, {"$literal": message.snapshot()}, "$last_message"]},
+                "last_message_at": {"$cond": [is_latest, message.created_at, "$last_message_at"]},
+                "unread": {"$mergeObjects": [{"$ifNull": ["$unread", {}]}, {
+                    sender_key: {"$ifNull": [f"$unread.{sender_key}", 0]},
+                    receiver_key: {"$add": [{"$ifNull": [f"$unread.{receiver_key}", 0]}, 1]},
+                }]},
+                "created_at": {"$ifNull": ["$created_at", now]},
+                "updated_at": now,
+            }}],
+            upsert=True,
+        )
+
+    async def _record_read(self, reader_id: PydanticObjectId, sender_id: PydanticObjectId, count: int,
+                           read_at: datetime):
+        """
+        Take the `count` messages of `sender_id` marked read at `read_at` off
+        the unread count of `reader_id`.
+
+        Sends add 1 and reads subtract exactly the messages they flipped, so
+        the counter stays exact whatever order the updates land in. It is
+        not clamped when stored: a read landing before the increment of a
+        message it marked takes it briefly below 0, and clamping would then
+        leave it one too high for good. Readers clamp at 0 instead. The
+        update upserts for the same reason. `backfill-conversations`
+        recounts everything from the messages if counters ever need repair.
+        """
+        reader_key = str(reader_id)
+        last_read = {"$and": [
+            {"$eq": ["$last_message.sender_id", sender_id]},
+            {"$lte": ["$last_message.created_at", read_at]},
+        ]}
+        now = datetime.utcnow()
+        await Conversation.get_motor_collection().update_one(
+            {"key": Conversation.key_of(reader_id, sender_id)},
+            [{"$set": {
+                "participants": {"$ifNull": ["$participants", sorted({reader_id, sender_id})]},
+                "unread": {"$mergeObjects": [{"$ifNull": ["$unread", {}]}, {
+                    reader_key: {"$subtract": [{"$ifNull": [f"$unread.{reader_key}", 0]}, count]},
+                }]},
+                "last_message": {"$cond": [
+                    last_read, {"$mergeObjects": ["$last_message", {"read": True, "read_at": read_at}]}, "$last_message"
+                ]},
+                "created_at": {"$ifNull": ["$created_at", now]},
+                "updated_at": now,
+            }}],
+            upsert=True,
+        )
+
+    async def get_chat_history(self, user_id: User, other_user_id: str, page: int = 1, limit: int = 50,
+                               cursor: Optional[str] = None) -> Result:
         try:
             user_oid = PydanticObjectId(user_id.id)
             other_oid = PydanticObjectId(other_user_id)
@@ -186,14 +363,21 @@ class SocketManager:
                 {"sender_id.$id": other_oid, "receiver_id.$id": user_oid},
             ]}
 
-            messages = (await Message.find(query)
-                        .sort("-created_at")
-                        .skip(skip)
-                        .limit(limit)
-                        .to_list())
-
-            total = await Message.find(query).count()
-            serialized = await self.serialize_messages(messages)
+            if cursor is not None:
+                # Cursor mode: walk back in time without skip or a total count
+                messages, next_cursor = await self.db.find_with_cursor(
+                    Message, query, sort=[("created_at", -1)], limit=limit, cursor=cursor)
+                serialized = self.serialize_messages(messages)
+                return Result.success({
+                    "messages": serialized[::-1],
+                    "limit": limit,
+                    "next_cursor": next_cursor,
+                })
+
+            # Page and total, queried concurrently
+            messages, total = await self.db.find_with_count(
+                Message, query, sort=[("created_at", -1)], skip=skip, limit=limit)
+            serialized = self.serialize_messages(messages)
 
             return Result.success({
                 "messages": serialized[::-1],
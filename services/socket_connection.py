@@ -0,0 +1,143 @@
+import asyncio
+import time
+from traceback import print_exc
+from typing import Awaitable, Callable, Optional
+
+from fastapi import WebSocket
+
+
+class SocketConnection:
+    """
+    A chat WebSocket and the bounded queue of events waiting to be written to it.
+
+    Events are enqueued without waiting and written by the connection's own
+    writer task, so a slow or dead client never stalls the sender or the
+    other recipients. When the queue is full, `overflow` decides what gives:
+
+    - "drop_oldest": the oldest queued event is dropped for the new one.
+    - "disconnect": the client is too slow and gets disconnected.
+    - "spill": new events are left to offline storage. Messages are already
+      stored in MongoDB, so the client is only sent a `resync` event once it
+      catches up, telling it to reload its rooms and history.
+    """
+
+    DROP_OLDEST = "drop_oldest"
+    DISCONNECT = "disconnect"
+    SPILL = "spill"
+    OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, SPILL)
+
+    # Close code sent to slow consumers, next to 4000/4001 used by the chat router
+    SLOW_CONSUMER_CODE = 4002
+
+    def __init__(self, sid: str, user_id: str, websocket: WebSocket,
+                 on_close: Callable[[str], Awaitable[None]],
+                 max_queue: int = 100, overflow: str = DROP_OLDEST, send_timeout: float = 10.0):
+        """
+        :param on_close: Called with the sid when the connection drops itself
+            (slow consumer or failed write), to unregister it.
+        :param send_timeout: Seconds a single write may take before the client counts as dead.
+        """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}")
+        self.sid = sid
+        self.user_id = user_id
+        self.websocket = websocket
+        self.on_close = on_close
+        self.overflow = overflow
+        self.send_timeout = send_timeout
+        self.queue: asyncio.Queue[tuple[float, dict]] = asyncio.Queue(maxsize=max_queue)
+        self.writer: Optional[asyncio.Task] = None
+        self._closing: Optional[asyncio.Task] = None
+        self.closed = False
+        # Last time the client was heard from, see SocketManager.touch
+        self.last_seen = time.monotonic()
+        # Whether the client takes part in the JSON heartbeat
+        self.heartbeat = False
+        # Metrics
+        self.connected_at = time.time()
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.max_depth = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+        self._resync = False
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write())
+
+    def send(self, event: dict) -> bool:
+        """Queue `event` for this client without waiting. Returns whether it was queued"""
+        if self.closed:
+            return False
+        if self.queue.full():
+            if self.overflow == self.DROP_OLDEST:
+                self.queue.get_nowait()
+                self.dropped += 1
+            elif self.overflow == self.SPILL:
+                self.spilled += 1
+                self._resync = True
+                return False
+            else:
+                self.dropped += 1
+                if self._closing is None:
+                    # Keep a reference so the task is not garbage collected
+                    self._closing = asyncio.create_task(self._drop(self.SLOW_CONSUMER_CODE))
+                return False
+        self.queue.put_nowait((time.monotonic(), event))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    async def close(self, code: int = 1000):
+        """Stop the writer and close the socket; queued events are discarded"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is not None and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass  # Already closed by the client
+
+    def metrics(self) -> dict:
+        return {
+            "sid": self.sid,
+            "user_id": self.user_id,
+            "connected_at": self.connected_at,
+            "idle": time.monotonic() - self.last_seen,
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "last_send_latency": self.last_latency,
+            "max_send_latency": self.max_latency,
+            "avg_send_latency": self._total_latency / (self.sent or 1),
+        }
+
+    async def _write(self):
+        while True:
+            queued_at, event = await self.queue.get()
+            try:
+                await asyncio.wait_for(self.websocket.send_json(event), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print_exc()
+                await self._drop(self.SLOW_CONSUMER_CODE)
+                return
+            # Latency from enqueue to written, queueing included
+            latency = time.monotonic() - queued_at
+            self.sent += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self._total_latency += latency
+            if self._resync and self.queue.empty():
+                self._resync = False
+                self.queue.put_nowait((time.monotonic(), {"type": "resync", "data": {"missed": self.spilled}}))
+
+    async def _drop(self, code: int):
+        await self.close(code)
+        await self.on_close(self.sid)
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from traceback import print_exc
+from typing import List, Optional
+
+from elasticsearch import ApiError, TransportError
+
+import models
+from models.elastic.es_schema import ServiceProviderSearchDoc
+from models.service import Category, ServiceItem
+from models.service_provider import ServiceProvider
+from utils.exceptions import AppException
+from utils.service_result import ServiceResult
+from utils.trie import PrefixTrie
+
+
+class SuggestEngine:
+    """
+    Type-ahead suggestions for the search box.
+
+    Served by the completion field of the provider search index. When
+    Elasticsearch cannot be reached, an in-process prefix trie over the
+    same labels, rebuilt from MongoDB every `fallback_ttl` seconds, answers
+    instead. One request at a time rebuilds it; the others wait for that
+    build rather than all scanning MongoDB during the outage.
+    """
+
+    def __init__(self, fallback_ttl: int = 300):
+        self.fallback_ttl = fallback_ttl
+        self._trie: Optional[PrefixTrie] = None
+        self._trie_built_at = 0.0
+        self._build_lock = asyncio.Lock()
+
+    async def suggest(self, prefix: str, limit: int = 8) -> ServiceResult:
+        prefix = " ".join(prefix.split())
+        if not prefix:
+            return ServiceResult({"suggestions": []})
+        try:
+            try:
+                suggestions = await models.es.suggest_providers(prefix, limit)
+            except (ApiError, TransportError):
+                print_exc()
+                suggestions = await self._fallback(prefix, limit)
+            return ServiceResult({"suggestions": suggestions})
+        except Exception:
+            print_exc()
+            return ServiceResult(AppException.GetItem())
+
+    async def _fallback(self, prefix: str, limit: int) -> List[dict]:
+        if self._stale():
+            async with self._build_lock:
+                if self._stale():  # Not rebuilt while waiting for the lock
+                    self._trie = await self._build_trie()
+                    self._trie_built_at = time.monotonic()
+        return [{"id": id, "label": label} for label, id in self._trie.search(prefix, limit)]
+
+    def _stale(self) -> bool:
+        return self._trie is None or time.monotonic() - self._trie_built_at > self.fallback_ttl
+
+    async def _build_trie(self) -> PrefixTrie:
+        entries = []
+        weights = ServiceProviderSearchDoc.SUGGEST_WEIGHTS
+        async for doc in ServiceProvider.get_motor_collection().find({}, {"name": 1}):
+            entries.append((weights["name"], doc["name"], str(doc["_id"])))
+        for cls in (ServiceItem, Category):
+            async for doc in cls.get_motor_collection().find({}, {"title": 1, "provider_id": 1}):
+                if doc.get("provider_id") is not None:
+                    entries.append((weights["title"], doc["title"], str(doc["provider_id"].id)))
+        # Same ranking as the completion field: heavier first, then shorter
+        entries.sort(key=lambda entry: (-entry[0], len(entry[1])))
+        return PrefixTrie.build((label, id) for _, label, id in entries)
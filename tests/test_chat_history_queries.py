@@ -0,0 +1,82 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("beanie")
+
+from beanie import Link, PydanticObjectId
+from bson import DBRef
+
+from models.user import User
+from services.socket import SocketManager
+
+
+class CountingStorage:
+    """Storage stub recording every query made through it"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.queries = 0
+
+    async def find_with_count(self, cls, filter_=None, sort=None, skip=0, limit=10, **kwargs):
+        self.queries += 1
+        return self.messages[skip:skip + limit], len(self.messages)
+
+    async def find_with_cursor(self, cls, filter_=None, sort=None, limit=10, cursor=None, **kwargs):
+        self.queries += 1
+        return self.messages[:limit], "next"
+
+
+class StoredMessage:
+    """A message as loaded from MongoDB, with unfetched links"""
+
+    fetches = 0
+
+    def __init__(self, sender: PydanticObjectId, receiver: PydanticObjectId, created_at: datetime):
+        self.id = PydanticObjectId()
+        self.sender_id = Link(DBRef("User", sender), User)
+        self.receiver_id = Link(DBRef("User", receiver), User)
+        self.content = "hello"
+        self.attachments = []
+        self.read = False
+        self.read_at = None
+        self.created_at = self.updated_at = created_at
+
+    async def fetch_link(self, field):
+        StoredMessage.fetches += 1
+
+    async def fetch_all_links(self):
+        StoredMessage.fetches += 1
+
+
+def history_page(size: int, cursor=None):
+    user, other = PydanticObjectId(), PydanticObjectId()
+    now = datetime.utcnow()
+    messages = [StoredMessage(*((user, other) if i % 2 else (other, user)), now - timedelta(minutes=i))
+                for i in range(size)]
+    storage = CountingStorage(messages)
+    manager = SocketManager()
+    manager.db = storage
+    StoredMessage.fetches = 0
+    result = asyncio.run(manager.get_chat_history(User.model_construct(id=user), str(other),
+                                                  limit=size, cursor=cursor))
+    return result, storage, user, other
+
+
+@pytest.mark.parametrize("cursor", [None, ""])
+@pytest.mark.parametrize("size", [1, 50])
+def test_history_page_costs_one_query_whatever_its_size(size, cursor):
+    result, storage, user, other = history_page(size, cursor)
+
+    assert result.success, result.exception_case
+    assert len(result.value["messages"]) == size
+    assert storage.queries == 1
+    assert StoredMessage.fetches == 0
+
+
+def test_history_page_reads_participants_from_links():
+    result, _, user, other = history_page(2)
+
+    participants = {(m["sender_id"], m["receiver_id"]) for m in result.value["messages"]}
+    assert participants == {(str(user), str(other)), (str(other), str(user))}
@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("beanie")
+
+from models.attributes import BusinessCategory, Subcategory
+from models.elastic.es_schema import ServiceProviderSearchDoc
+from services.memory_search import InMemorySearchBackend, MemoryIndex
+from services.search import SearchEngine
+
+
+def search_doc(id: str, name: str = "", description: str = "", **fields) -> ServiceProviderSearchDoc:
+    defaults = {
+        "phone": "",
+        "category": None,
+        "subcategories": [],
+        "service_titles": [],
+        "service_descriptions": [],
+        "category_titles": [],
+        "category_descriptions": [],
+    }
+    return ServiceProviderSearchDoc(id=id, name=name, description=description, **{**defaults, **fields})
+
+
+def backend_with(*docs: ServiceProviderSearchDoc) -> InMemorySearchBackend:
+    backend = InMemorySearchBackend()
+
+    async def load():
+        index = await backend.create_versioned_index(alias=True)
+        await backend.bulk_index(index, list(docs))
+
+    asyncio.run(load())
+    return backend
+
+
+def search(backend: InMemorySearchBackend, query, sort, **kwargs):
+    return asyncio.run(backend.search_providers(query, sort, **kwargs))
+
+
+def test_match_ranks_boosted_fields_first():
+    backend = backend_with(
+        search_doc("description", "Smith and sons", "The plumber of the neighbourhood"),
+        search_doc("name", "Joe the plumber", "Repairs of all kinds"),
+        search_doc("title", "Ace repairs", "Anything at home", service_titles=["Emergency plumber"]),
+        search_doc("other", "Bright sparks", "Electrician"),
+    )
+    index = backend._index(backend.indices["provider"])
+
+    scores = backend._match(index, backend.build_provider_query(query="plumber"))
+
+    assert sorted(scores, key=scores.get, reverse=True) == ["name", "description", "title"]
+
+
+def test_match_without_text_keeps_every_filtered_document():
+    backend = backend_with(
+        search_doc("cheap", min_price=10, max_price=40),
+        search_doc("pricey", min_price=200, max_price=400),
+    )
+    index = backend._index(backend.indices["provider"])
+
+    scores = backend._match(index, backend.build_provider_query(price_max=50))
+
+    assert scores == {"cheap": 1.0}
+
+
+def test_expand_follows_auto_fuzziness():
+    index = MemoryIndex(["name"])
+    for i, name in enumerate(["plumber", "plumbing", "cut", "cat", "ab"]):
+        index.add(search_doc(str(i), name))
+
+    # Long terms allow two edits, short ones one, terms of two letters none
+    assert index.expand("plumbr") == {"plumber": 1}
+    assert index.expand("plubmer") == {"plumber": 2}
+    assert index.expand("cit") == {"cut": 1, "cat": 1}
+    assert index.expand("ac") == {}
+    assert index.expand("ab") == {"ab": 0}
+
+
+def test_fuzzy_query_finds_misspelled_terms():
+    backend = backend_with(search_doc("plumber", "Joe the plumber"), search_doc("other", "Bright sparks"))
+    index = backend._index(backend.indices["provider"])
+
+    scores = backend._match(index, backend.build_provider_query(query="plumbr"))
+
+    assert list(scores) == ["plumber"]
+
+
+def test_values_key_puts_missing_values_last_in_both_directions():
+    sort = [{"averageRating": "desc"}, {"id": "asc"}]
+    keys = [
+        InMemorySearchBackend._values_key([None, "a"], sort),
+        InMemorySearchBackend._values_key([4.5, "b"], sort),
+        InMemorySearchBackend._values_key([4.5, "a"], sort),
+        InMemorySearchBackend._values_key([2.0, "c"], sort),
+    ]
+
+    assert sorted(keys) == [keys[2], keys[1], keys[3], keys[0]]
+    ascending = [{"averageRating": "asc"}]
+    assert InMemorySearchBackend._values_key([None], ascending) > InMemorySearchBackend._values_key([5.0], ascending)
+
+
+def test_search_after_pages_through_every_hit_once():
+    ratings = [4.5, None, 3.0, 4.5, 5.0, None, 1.0]
+    backend = backend_with(*(search_doc(f"p{i}", averageRating=rating) for i, rating in enumerate(ratings)))
+    query = backend.build_provider_query()
+    sort = [{"averageRating": "desc"}, {"id": "asc"}]
+
+    everything, total, _ = search(backend, query, sort, size=len(ratings), source=["id"])
+    paged, search_after = [], None
+    while True:
+        hits, _, _ = search(backend, query, sort, size=2, search_after=search_after,
+                            track_total_hits=False, source=["id"])
+        if not hits:
+            break
+        paged.extend(hits)
+        search_after = hits[-1]["sort"]
+
+    assert total == len(ratings)
+    assert [hit["_id"] for hit in everything] == ["p4", "p0", "p3", "p2", "p6", "p1", "p5"]
+    assert [hit["_id"] for hit in paged] == [hit["_id"] for hit in everything]
+
+
+def test_facets_have_the_elasticsearch_shape():
+    backend = backend_with(
+        search_doc("a", category=BusinessCategory.RESTAURANTS,
+                   subcategories=[Subcategory.CAFE, Subcategory.TAKEOUT], min_price=20, averageRating=4.2),
+        search_doc("b", category=BusinessCategory.RESTAURANTS,
+                   subcategories=[Subcategory.CAFE], min_price=70, averageRating=3.1),
+        search_doc("c", category=BusinessCategory.ELECTRICAL,
+                   subcategories=[Subcategory.ELECTRICAL], min_price=120),
+    )
+    params = backend.facet_params(BusinessCategory.RESTAURANTS, [Subcategory.CAFE])
+
+    hits, _, aggs = search(backend, backend.build_provider_query(), [{"id": "asc"}], size=10, **params)
+
+    assert [hit["_id"] for hit in hits] == ["a", "b"]
+    categories = {bucket["key"]: bucket for bucket in aggs["categories"]["buckets"]}
+    assert {key: bucket["doc_count"] for key, bucket in categories.items()} == {"restaurant": 2, "electrical": 1}
+    assert {sub["key"]: sub["doc_count"] for sub in categories["restaurant"]["subcategories"]["buckets"]} \
+        == {"cafe": 2, "takeout": 1}
+    in_categories = aggs["in_categories"]
+    assert in_categories["doc_count"] == 2
+    assert in_categories["price"]["buckets"] == [{"key": 0.0, "doc_count": 1}, {"key": 50.0, "doc_count": 1}]
+    assert [(bucket["from"], bucket["doc_count"]) for bucket in in_categories["rating"]["buckets"]] \
+        == [(4.0, 1), (3.0, 2), (2.0, 2), (1.0, 2)]
+
+    facets = SearchEngine()._format_facets(aggs)
+    assert {category["value"]: category["count"] for category in facets["categories"]}["restaurant"] == 2
@@ -0,0 +1,87 @@
+import base64
+import binascii
+import hashlib
+from typing import Any, List, Optional
+
+import bson
+from bson.errors import BSONError
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def keyset_sort(sort: Optional[List[tuple]]) -> List[tuple]:
+    """Append `_id` to a sort so every document has a unique, stable position"""
+    sort = list(sort or [])
+    if not any(field == "_id" for field, _ in sort):
+        direction = sort[-1][1] if sort else -1
+        sort.append(("_id", direction))
+    return sort
+
+
+def pack_cursor(sort: List[Any], values: List[Any]) -> str:
+    """
+    Build an opaque cursor from the sort key values of the last item of a page.
+
+    :param sort: The sort specification the values belong to, any BSON encodable list.
+    :param values: The sort key values of the last item.
+    """
+    payload = bson.encode({"s": _sort_signature(sort), "v": values})
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def unpack_cursor(cursor: str, sort: List[Any]) -> List[Any]:
+    """Return the sort key values stored in `cursor`, checking it was built for `sort`"""
+    try:
+        payload = bson.decode(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (BSONError, binascii.Error, ValueError) as e:
+        raise InvalidCursor("Malformed cursor") from e
+    if payload.get("s") != _sort_signature(sort):
+        raise InvalidCursor("Cursor does not match the requested sort order")
+    return payload["v"]
+
+
+def _sort_signature(sort: List[Any]) -> str:
+    return hashlib.sha1(repr(sort).encode()).hexdigest()[:16]
+
+
+def encode_cursor(doc: Any, sort: List[tuple]) -> str:
+    """
+    Build an opaque cursor pointing right after `doc`.
+
+    :param doc: The last document (or projection) of the current page.
+    :param sort: The keyset sort, as returned by `keyset_sort`.
+    """
+    return pack_cursor(sort, [doc.id if field == "_id" else getattr(doc, field) for field, _ in sort])
+
+
+def decode_cursor(cursor: str, sort: List[tuple]) -> List[Any]:
+    """Return the keyset values stored in `cursor`, checking it was built for `sort`"""
+    return unpack_cursor(cursor, sort)
+
+
+def keyset_filter(sort: List[tuple], values: List[Any]) -> dict:
+    """
+    Filter matching the documents that come after `values` in `sort` order.
+
+    For a sort on (a, b) that is: a past value, or a equal and b past value.
+    """
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        after = _after(field, direction, values[i])
+        if after is None:
+            continue
+        clause = {prev_field: values[j] for j, (prev_field, _) in enumerate(sort[:i])}
+        clauses.append({"$and": [clause, after]} if clause else after)
+    return {"$or": clauses} if clauses else {"_id": {"$exists": False}}
+
+
+def _after(field: str, direction: int, value: Any) -> Optional[dict]:
+    # MongoDB sorts null/missing values before everything else, but range
+    # operators never match them, so they need explicit handling.
+    if value is None:
+        return {field: {"$ne": None}} if direction > 0 else None
+    if direction > 0:
+        return {field: {"$gt": value}}
+    return {"$or": [{field: {"$lt": value}}, {field: None}]}
@@ -0,0 +1,54 @@
+import unicodedata
+from typing import Dict, Iterable, List, Tuple
+
+
+def fold(text: str) -> str:
+    """Lowercase and strip accents, like the `lowercase` + `asciifolding` search filters"""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+class _Node:
+    __slots__ = ("children", "top")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.top: List[Tuple[str, str]] = []
+
+
+class PrefixTrie:
+    """
+    Case and accent insensitive prefix index of (label, value) pairs: "cafe"
+    finds "Café", as with the `provider_name` analyzer of the search index.
+
+    Each node keeps the first `per_node` entries below it, so a lookup costs
+    the length of the prefix whatever the number of labels. Entries are
+    kept in insertion order: insert the preferred ones first.
+    """
+
+    def __init__(self, per_node: int = 10):
+        self.per_node = per_node
+        self._root = _Node()
+
+    @classmethod
+    def build(cls, entries: Iterable[Tuple[str, str]], per_node: int = 10) -> "PrefixTrie":
+        trie = cls(per_node)
+        for label, value in entries:
+            trie.insert(label, value)
+        return trie
+
+    def insert(self, label: str, value: str):
+        entry = (label, value)
+        node = self._root
+        for char in fold(label):
+            node = node.children.setdefault(char, _Node())
+            if len(node.top) < self.per_node and entry not in node.top:
+                node.top.append(entry)
+
+    def search(self, prefix: str, limit: int = 10) -> List[Tuple[str, str]]:
+        node = self._root
+        for char in fold(prefix):
+            node = node.children.get(char)
+            if node is None:
+                return []
+        return node.top[:limit]